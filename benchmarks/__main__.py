@@ -0,0 +1,84 @@
+import argparse
+import json
+import os
+import sys
+
+from benchmarks.compare import compare_results, load_results
+from benchmarks.suite import BENCHMARKS, run_suite
+from src.logger import shared_logger
+from src.utils import ensure_output_file
+
+
+DEFAULT_RESULTS = "benchmarks/results/latest.json"
+DEFAULT_BASELINE = "benchmarks/baseline.json"
+
+
+def parse_size(value: str) -> int:
+    """Accepts plain row counts and shorthands like 10k or 1m."""
+    multipliers = {"k": 1000, "m": 1000000}
+    value = value.strip().lower()
+    if value[-1:] in multipliers:
+        return int(float(value[:-1]) * multipliers[value[-1]])
+    return int(value)
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Synthetic-data benchmarks for the ad pipeline.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Run benchmarks and write a JSON results file")
+    run.add_argument("--sizes", default="10k,100k", help="Comma-separated row counts, e.g. 10k,100k,1m")
+    run.add_argument("--only", default=None, help="Comma-separated benchmark names (default: all)")
+    run.add_argument("--seed", type=int, default=0, help="Seed for the synthetic data")
+    run.add_argument("--workdir", default="benchmarks/.data", help="Where synthetic inputs and stage outputs go")
+    run.add_argument("--config", default="config.yaml", help="Pipeline config the stage benchmarks start from")
+    run.add_argument("--output", default=DEFAULT_RESULTS, help="Results JSON file")
+
+    compare = commands.add_parser("compare", help="Compare a results file against a stored baseline")
+    compare.add_argument("results", nargs="?", default=DEFAULT_RESULTS)
+    compare.add_argument("--baseline", default=DEFAULT_BASELINE)
+    compare.add_argument("--max-slowdown", type=float, default=0.1, help="Allowed rows/s drop, as a fraction")
+    compare.add_argument("--max-rss-growth", type=float, default=0.2, help="Allowed peak RSS growth, as a fraction")
+
+    commands.add_parser("list", help="List benchmark names")
+    return parser.parse_args()
+
+def main() -> int:
+    args = parse_args()
+    if args.command == "list":
+        print("\n".join(BENCHMARKS))
+        return 0
+
+    if args.command == "run":
+        names = args.only.split(",") if args.only else list(BENCHMARKS)
+        unknown = set(names) - set(BENCHMARKS)
+        if unknown:
+            shared_logger.error(f"Unknown benchmarks: {sorted(unknown)}")
+            return 2
+        sizes = [parse_size(size) for size in args.sizes.split(",")]
+        results = run_suite(names, sizes, args.seed, args.workdir, args.config)
+        ensure_output_file(args.output)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        shared_logger.info(f"Benchmark results saved: {args.output}")
+        return 1 if any("error" in r for r in results["results"]) else 0
+
+    if not os.path.exists(args.baseline):
+        shared_logger.error(f"No baseline at {args.baseline}; copy a results file there to create one")
+        return 2
+    lines, regressions = compare_results(
+        load_results(args.results),
+        load_results(args.baseline),
+        args.max_slowdown,
+        args.max_rss_growth
+    )
+    print("\n".join(lines))
+    if regressions:
+        shared_logger.error(f"{len(regressions)} regressions: " + "; ".join(regressions))
+        return 1
+    shared_logger.info("No regressions against the baseline")
+    return 0
+
+# python -m benchmarks run --sizes 10k,100k,1m
+# python -m benchmarks compare --baseline benchmarks/baseline.json
+if __name__ == "__main__":
+    sys.exit(main())
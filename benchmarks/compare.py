@@ -0,0 +1,46 @@
+import json
+
+from typing import Dict, List, Tuple
+
+
+def load_results(path: str) -> Dict[Tuple[str, int], dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        results = json.load(f)["results"]
+    return {(r["benchmark"], r["size"]): r for r in results if "error" not in r}
+
+def compare_results(
+    current: Dict[Tuple[str, int], dict],
+    baseline: Dict[Tuple[str, int], dict],
+    max_slowdown: float = 0.1,
+    max_rss_growth: float = 0.2
+) -> Tuple[List[str], List[str]]:
+    """
+    Compares benchmarks present in both runs.
+    Returns (report lines, regressions): a throughput drop beyond `max_slowdown` or a peak RSS
+    increase beyond `max_rss_growth`, both as fractions of the baseline, counts as a regression.
+    """
+    lines, regressions = [], []
+    lines.append(f"{'benchmark':<32} {'rows':>9} {'rows/s':>12} {'baseline':>12} {'change':>8} {'rss MB':>8} {'change':>8}")
+    for key in sorted(current, key=lambda k: (k[1], k[0])):
+        if key not in baseline:
+            continue
+        name, size = key
+        cur, base = current[key], baseline[key]
+        speed_change = cur["rows_per_s"] / base["rows_per_s"] - 1 if base["rows_per_s"] else 0.0
+        rss_change = cur["peak_rss_mb"] / base["peak_rss_mb"] - 1 if base["peak_rss_mb"] else 0.0
+        flags = []
+        if speed_change < -max_slowdown:
+            flags.append("SLOWER")
+        if rss_change > max_rss_growth:
+            flags.append("MORE MEMORY")
+        lines.append(
+            f"{name:<32} {size:>9} {cur['rows_per_s']:>12.1f} {base['rows_per_s']:>12.1f} {speed_change:>+8.1%} "
+            f"{cur['peak_rss_mb']:>8.1f} {rss_change:>+8.1%} {' '.join(flags)}"
+        )
+        if flags:
+            regressions.append(f"{name} ({size} rows): {', '.join(flags).lower()}")
+
+    missing = sorted(set(baseline) - set(current))
+    for name, size in missing:
+        lines.append(f"{name:<32} {size:>9} missing from the current results")
+    return lines, regressions
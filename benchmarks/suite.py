@@ -0,0 +1,342 @@
+import copy
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Callable, Dict, List
+
+from benchmarks.synthetic import GENERATOR_VERSION, write_synthetic_ads
+from src.config import load_config
+from src.logger import shared_logger
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Interpreter launches per startup benchmark, whatever the size
+STARTUP_RUNS = 10
+
+
+@dataclass
+class BenchmarkData:
+    """Synthetic inputs for one benchmark run; files are generated once per size and seed."""
+    rows: int
+    seed: int
+    workdir: str
+    config_path: str
+
+    @property
+    def parsed_path(self) -> str:
+        return os.path.join(self.workdir, "input", f"parsed_v{GENERATOR_VERSION}_{self.rows}_{self.seed}.jsonl")
+
+    @property
+    def transformed_path(self) -> str:
+        return os.path.join(self.workdir, "input", f"transformed_v{GENERATOR_VERSION}_{self.rows}_{self.seed}.jsonl")
+
+    def parsed_records(self) -> List[dict]:
+        with open(self.parsed_path, "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+
+    def transformed_records(self) -> List[dict]:
+        with open(self.transformed_path, "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+
+    def stage_config(self, name: str) -> dict:
+        """
+        The pipeline config with every path moved into a scratch directory, so stage benchmarks
+        never touch data/ and never start from a warm cache.
+        """
+        scratch = os.path.join(self.workdir, "stages", name)
+        shutil.rmtree(scratch, ignore_errors=True)
+        config = copy.deepcopy(load_config(self.config_path))
+        config["paths"].update({
+            "output_file": os.path.basename(self.parsed_path),
+            "storage_format": "jsonl",
+            "parsed_ads_dir": os.path.dirname(self.parsed_path),
+            "transformed_ads_dir": os.path.join(scratch, "transformed"),
+            "quarantine_dir": os.path.join(scratch, "quarantine"),
+            "analysis_output": os.path.join(scratch, "analysis", "top_ads.jsonl"),
+        })
+        transform_cfg = config.setdefault("transform", {})
+        transform_cfg["incremental"] = False
+        cache_cfg = transform_cfg.get("language_cache") or {}
+        cache_cfg["path"] = os.path.join(scratch, "cache", "language.sqlite")
+        transform_cfg["language_cache"] = cache_cfg
+        aggregates_cfg = config.get("aggregates") or {}
+        aggregates_cfg["path"] = os.path.join(scratch, "aggregates", "ads.sqlite")
+        config["aggregates"] = aggregates_cfg
+        return config
+
+
+# A benchmark sets up from BenchmarkData and returns the timed part, which returns the rows it processed
+Benchmark = Callable[[BenchmarkData], Callable[[], int]]
+
+BENCHMARKS: Dict[str, Benchmark] = {}
+
+def benchmark(name: str):
+    def register(fn: Benchmark) -> Benchmark:
+        BENCHMARKS[name] = fn
+        return fn
+    return register
+
+
+@benchmark("extract_dates_from_run_info")
+def bench_extract_dates(data: BenchmarkData):
+    from src.transformer import extract_dates_from_run_info
+    run_dates = [ad["run_dates"] for ad in data.parsed_records()]
+
+    def run():
+        for value in run_dates:
+            extract_dates_from_run_info(value)
+        return len(run_dates)
+    return run
+
+@benchmark("compute_ad_hash")
+def bench_compute_ad_hash(data: BenchmarkData):
+    from src.transformer import compute_ad_hash
+    records = data.transformed_records()
+
+    def run():
+        for record in records:
+            compute_ad_hash(record)
+        return len(records)
+    return run
+
+@benchmark("detect_language")
+def bench_detect_language(data: BenchmarkData):
+    from langdetect import DetectorFactory
+    from src.transformer import detect_language
+    DetectorFactory.seed = data.seed
+    texts = [ad["ad_text"] for ad in data.parsed_records() if ad["ad_text"]]
+
+    def run():
+        for text in texts:
+            detect_language(text)
+        return len(texts)
+    return run
+
+@benchmark("normalize_ad")
+def bench_normalize_ad(data: BenchmarkData):
+    from langdetect import DetectorFactory
+    from src.transformer import normalize_ad
+    DetectorFactory.seed = data.seed
+    records = data.parsed_records()
+
+    def run():
+        for ad in records:
+            normalize_ad(ad)
+        return len(records)
+    return run
+
+@benchmark("cluster_creatives")
+def bench_cluster_creatives(data: BenchmarkData):
+    """Rows/s should hold steady from one size to the next: LSH keeps clustering linear."""
+    from src.clustering import clusterer_from_config
+    records = data.transformed_records()
+    config = load_config(data.config_path)
+    config["clustering"] = {**(config.get("clustering") or {}), "enabled": True}
+
+    def run():
+        clusterer = clusterer_from_config(config)
+        for record in records:
+            clusterer.assign(record)
+        return len(records)
+    return run
+
+@benchmark("aggregate_ads")
+def bench_aggregate_ads(data: BenchmarkData):
+    """Adds every transformed ad to a fresh aggregate store, then reads the per-advertiser report."""
+    from src.aggregates import AggregateStore
+    records = data.transformed_records()
+    path = os.path.join(data.workdir, "stages", "aggregate_ads", "ads.sqlite")
+    shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+    def run():
+        store = AggregateStore(path)
+        store.reset()
+        for record in records:
+            store.add(record)
+        store.report()
+        store.close()
+        return len(records)
+    return run
+
+@benchmark("validate_ads")
+def bench_validate_ads(data: BenchmarkData):
+    """The generated schema validator on every transformed ad; compare with stage:transform for its overhead."""
+    from src.storage import load_ad_schema
+    from src.validation import compile_validator
+    records = data.transformed_records()
+    validate = compile_validator(load_ad_schema())
+
+    def run():
+        invalid = [reason for reason in map(validate, records) if reason]
+        if invalid:
+            raise AssertionError(f"{len(invalid)} synthetic ads fail the schema, e.g. {invalid[0]}")
+        return len(records)
+    return run
+
+@benchmark("jsonl_writer_per_batch")
+def bench_jsonl_writer_per_batch(data: BenchmarkData):
+    return write_benchmark(data, "jsonl_writer_per_batch")
+
+@benchmark("jsonl_writer")
+def bench_jsonl_writer(data: BenchmarkData):
+    return write_benchmark(data, "jsonl_writer")
+
+def write_benchmark(data: BenchmarkData, name: str):
+    """Writes the transformed records in scraper-sized batches of 20, reopening per batch or not."""
+    from src.storage import JsonlWriter, jsonl_writer_options
+    records = data.transformed_records()
+    path = os.path.join(data.workdir, "stages", name, "ads.jsonl")
+    shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+    os.makedirs(os.path.dirname(path))
+    batches = [records[i:i + 20] for i in range(0, len(records), 20)]
+
+    options = jsonl_writer_options(load_config(data.config_path))
+
+    def run():
+        if name == "jsonl_writer_per_batch":
+            for batch in batches:
+                with JsonlWriter(path, **options) as writer:
+                    writer.write(batch)
+        else:
+            with JsonlWriter(path, **options) as writer:
+                for batch in batches:
+                    writer.write(batch)
+        return len(records)
+    return run
+
+@benchmark("stage:transform")
+def bench_transform_stage(data: BenchmarkData):
+    from src.transformer import transform
+    config = data.stage_config("transform")
+
+    def run():
+        transform(config)
+        return data.rows
+    return run
+
+@benchmark("stage:analyze")
+def bench_analyze_stage(data: BenchmarkData):
+    return analyze_stage(data, streaming=False)
+
+@benchmark("stage:analyze_streaming")
+def bench_analyze_streaming_stage(data: BenchmarkData):
+    return analyze_stage(data, streaming=True)
+
+def analyze_stage(data: BenchmarkData, streaming: bool):
+    from src.ads_analysis import analyze
+    config = data.stage_config("analyze_streaming" if streaming else "analyze")
+    config["paths"]["transformed_ads_dir"] = os.path.dirname(data.transformed_path)
+    config["paths"]["output_file"] = os.path.basename(data.transformed_path)
+    config.setdefault("analysis", {})["streaming"] = streaming
+
+    def run():
+        analyze(config)
+        return data.rows
+    return run
+
+@benchmark("startup:main")
+def bench_startup_main(data: BenchmarkData):
+    """Fresh interpreters importing main.py, i.e. the cost of every CLI call before a stage starts."""
+    return startup_benchmark("import main")
+
+@benchmark("startup:analyze")
+def bench_startup_analyze(data: BenchmarkData):
+    """Everything `python main.py --stages analyze` imports before it reads a line."""
+    return startup_benchmark("import main, src.ads_analysis")
+
+def startup_benchmark(code: str):
+    def run():
+        for _ in range(STARTUP_RUNS):
+            subprocess.run([sys.executable, "-c", code], cwd=REPO_ROOT, check=True)
+        return STARTUP_RUNS
+    return run
+
+
+def peak_rss_mb() -> float:
+    """Peak RSS of this process or any of its (pool) children, whichever is larger."""
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def _run_in_child(name: str, data: BenchmarkData, conn):
+    try:
+        run = BENCHMARKS[name](data)
+        started = time.perf_counter()
+        rows = run()
+        seconds = time.perf_counter() - started
+        conn.send({
+            "benchmark": name,
+            "rows": rows,
+            "seconds": round(seconds, 4),
+            "rows_per_s": round(rows / seconds, 1) if seconds else None,
+            "peak_rss_mb": peak_rss_mb(),
+        })
+    except Exception as e:
+        conn.send({"benchmark": name, "rows": data.rows, "error": repr(e)})
+    finally:
+        conn.close()
+
+def run_benchmark(name: str, data: BenchmarkData) -> dict:
+    """
+    Runs one benchmark in a fresh spawned process, so peak RSS covers only that benchmark
+    and no module state (caches, imports) carries over from the previous one.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_run_in_child, args=(name, data, child_conn))
+    process.start()
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        result = {"benchmark": name, "rows": data.rows, "error": f"exited with code {process.exitcode}"}
+    process.join()
+    return result
+
+def run_suite(
+    names: List[str],
+    sizes: List[int],
+    seed: int,
+    workdir: str,
+    config_path: str
+) -> dict:
+    results = []
+    for rows in sizes:
+        data = BenchmarkData(rows=rows, seed=seed, workdir=workdir, config_path=config_path)
+        if not (os.path.exists(data.parsed_path) and os.path.exists(data.transformed_path)):
+            shared_logger.info(f"Generating {rows} synthetic ads (seed {seed})")
+            write_synthetic_ads(data.parsed_path, data.transformed_path, rows, seed)
+        for name in names:
+            shared_logger.info(f"Running {name} on {rows} rows")
+            result = run_benchmark(name, data)
+            if "error" in result:
+                shared_logger.error(f"{name} on {rows} rows failed: {result['error']}")
+            else:
+                shared_logger.info(
+                    f"{name} on {rows} rows: {result['rows_per_s']} rows/s, "
+                    f"{result['seconds']}s, peak RSS {result['peak_rss_mb']} MB"
+                )
+            results.append({**result, "size": rows})
+    return {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "seed": seed,
+        },
+        "results": results,
+    }
@@ -0,0 +1,245 @@
+import json
+import os
+import random
+
+from collections import deque
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from src.transformer import (
+    calculate_duration_hours,
+    clean_text,
+    compute_ad_hash,
+    date_to_iso,
+    extract_dates_from_run_info,
+    extract_library_id,
+    has_non_empty,
+    infer_media_mix,
+    join_texts,
+)
+from src.utils import ensure_output_file
+
+
+# Words per language, so langdetect sees the same spread of languages the real data has
+VOCABULARY = {
+    "en": (
+        "learn master skills minutes daily course career future online lessons quiz start today "
+        "your child kids teach fun creative business freelance grow brain knowledge bite sized "
+        "speak confidently leader english ai tools boost productivity unlock potential join"
+    ).split(),
+    "es": (
+        "aprende habilidades minutos diarios curso carrera futuro lecciones empieza hoy tu hijo "
+        "niños enseña divertido creativo negocio crecer cerebro conocimiento habla inglés"
+    ).split(),
+    "fr": (
+        "apprenez compétences minutes quotidiennes cours carrière avenir leçons commencez "
+        "aujourd'hui votre enfant amusant créatif entreprise cerveau connaissances parlez anglais"
+    ).split(),
+    "de": (
+        "lernen fähigkeiten minuten täglich kurs karriere zukunft lektionen starte heute dein kind "
+        "kinder spaß kreativ geschäft gehirn wissen sprechen englisch"
+    ).split(),
+}
+LANGUAGE_WEIGHTS = {"en": 0.94, "es": 0.02, "fr": 0.02, "de": 0.02}
+
+EMOJI = ["🚀", "🧠", "✨", "📚", "🎯", "🔥", "👉", "💡"]
+
+CTA_BUTTONS = ["Start Now", "Learn More", "Sign Up", "Install Now", "Download", "Shop Now"]
+
+MONTHS = ["January", "February", "March", "April", "May", "June", "July", "August",
+          "September", "October", "November", "December"]
+
+SCRAPE_START = datetime(2025, 7, 1, tzinfo=timezone.utc)
+
+# Part of the input file names; bump it whenever the generated ads change
+GENERATOR_VERSION = 2
+
+# Share of ads that are a variant of a recent creative: another emoji, fresh tracking and CDN parameters
+VARIANT_RATE = 0.3
+
+
+def short_date(d: date) -> str:
+    return f"{MONTHS[d.month - 1][:3]} {d.day}, {d.year}"
+
+def long_date(d: date) -> str:
+    return f"{d.day} {MONTHS[d.month - 1]} {d.year}"
+
+def total_active_time(rng: random.Random) -> str:
+    hours = rng.randint(1, 400)
+    return f" · Total active time {hours} {'hr' if hours == 1 else 'hrs'}"
+
+def random_run_dates(rng: random.Random, is_active: bool, scraped_at: datetime) -> str:
+    """
+    Covers every run_dates format extract_dates_from_run_info handles. Ads without an end date
+    are always active, since calculate_duration_hours needs one for inactive ads.
+    """
+    start = scraped_at.date() - timedelta(days=rng.randint(0, 120))
+    fmt = short_date if rng.random() < 0.9 else long_date
+    if is_active:
+        run_dates = f"Started running on {fmt(start)}"
+        return run_dates + total_active_time(rng) if rng.random() < 0.2 else run_dates
+    end = min(start + timedelta(days=rng.randint(0, 60)), scraped_at.date())
+    run_dates = f"{fmt(start)} - {fmt(end)}"
+    return run_dates + total_active_time(rng) if rng.random() < 0.8 else run_dates
+
+def random_text(rng: random.Random, language: str, max_words: int) -> str:
+    words = rng.choices(VOCABULARY[language], k=rng.randint(3, max_words))
+    text = " ".join(words).capitalize()
+    if rng.random() < 0.4:
+        text += " " + rng.choice(EMOJI)
+    return text
+
+def random_ad_text(rng: random.Random, language: str) -> Optional[str]:
+    roll = rng.random()
+    if roll < 0.03:
+        return None
+    if roll < 0.45:
+        return random_text(rng, language, 12)
+    if roll < 0.95:
+        return random_text(rng, language, 30)
+    # A few long-form ads, like the real data's multi-paragraph copy
+    return "\n\n".join(random_text(rng, language, 40) for _ in range(rng.randint(2, 8)))
+
+def random_url(rng: random.Random, domain: str, path: str) -> str:
+    token = "".join(rng.choices("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-", k=48))
+    return f"https://{domain}/{path}?_nc_cat={rng.randint(100, 199)}&oh=00_{token}&oe={rng.randint(0, 16 ** 8):08X}"
+
+def random_media(rng: random.Random) -> Dict[str, list]:
+    roll = rng.random()
+    images = [random_url(rng, "scontent.fbcdn.net", f"v/t39/{rng.randint(10 ** 8, 10 ** 9)}_n.jpg")] if roll < 0.3 else []
+    videos = [random_url(rng, "video.fbcdn.net", f"o1/v/t2/{rng.randint(10 ** 8, 10 ** 9)}_v.mp4")] if 0.1 < roll < 0.85 else []
+    return {"images": images, "videos": videos}
+
+def reparameterize_url(rng: random.Random, url: str) -> str:
+    """The same resource with new signature and tracking parameters, as a re-run of the ad gets."""
+    domain, path = url.split("://", 1)[1].split("?", 1)[0].split("/", 1)
+    return random_url(rng, domain, path)
+
+def variant_text(rng: random.Random, text: Optional[str]) -> Optional[str]:
+    if not text:
+        return text
+    if text[-1] in EMOJI:
+        text = text[:-2]
+    return text + " " + rng.choice(EMOJI) if rng.random() < 0.8 else text
+
+def random_redirect(rng: random.Random, advertiser: str) -> Optional[str]:
+    if rng.random() < 0.15:
+        return None
+    domain = advertiser.lower().replace(" ", "").replace(":", "")[:16] or "example"
+    return random_url(rng, "l.facebook.com", f"l.php?u=https%3A%2F%2F{domain}.com%2Fstart")
+
+def random_cta_texts(rng: random.Random, advertiser: str, language: str) -> Optional[list]:
+    roll = rng.random()
+    if roll < 0.3:
+        return None
+    if roll < 0.35:
+        return []
+    domain = advertiser.upper().replace(" ", "")[:16] + ".COM"
+    return [domain, rng.choice(CTA_BUTTONS), random_text(rng, language, 15) if rng.random() < 0.6 else ""]
+
+def generate_parsed_ads(rows: int, seed: int = 0) -> Iterator[Tuple[Dict[str, Any], str]]:
+    """
+    Yields `rows` parsed ads shaped like the scraper's output, each with the language its text was
+    generated in. The same seed always gives the same ads.
+    About VARIANT_RATE of them re-run one of the last 200 creatives with cosmetic changes.
+    """
+    rng = random.Random(seed)
+    advertisers = [
+        f"{rng.choice(['Learny', 'Coursiv', 'Headway', 'Above', 'Speak', 'Career'])} "
+        f"{rng.choice(['Words', 'Voice', 'Academy', 'Daily', 'Junior', 'Pro', 'Lab'])}"
+        for _ in range(64)
+    ]
+    # A few advertisers run most of the ads
+    advertiser_weights = [1 / (i + 1) for i in range(len(advertisers))]
+    languages = list(LANGUAGE_WEIGHTS)
+    language_weights = list(LANGUAGE_WEIGHTS.values())
+    recent = deque(maxlen=200)
+
+    for i in range(rows):
+        is_active = rng.random() < 0.3
+        scraped_at = SCRAPE_START + timedelta(seconds=rng.randint(0, 30 * 86400), microseconds=rng.randint(0, 999999))
+        ad = {
+            "status_name": "​\nActive" if is_active else "​\nInactive",
+            "library_id": f"Library ID: {rng.randint(10 ** 14, 10 ** 16 - 1)}",
+            "run_dates": random_run_dates(rng, is_active, scraped_at),
+        }
+        if recent and rng.random() < VARIANT_RATE:
+            base, language = rng.choice(recent)
+            ad.update({
+                "advertiser_name": base["advertiser_name"],
+                "ad_text": variant_text(rng, base["ad_text"]),
+                "ad_redirect": base["ad_redirect"] and reparameterize_url(rng, base["ad_redirect"]),
+                "call_to_action_texts": base["call_to_action_texts"],
+                "media": {kind: [reparameterize_url(rng, url) for url in urls] for kind, urls in base["media"].items()},
+            })
+        else:
+            advertiser = rng.choices(advertisers, advertiser_weights)[0]
+            language = rng.choices(languages, language_weights)[0]
+            ad.update({
+                "advertiser_name": advertiser,
+                "ad_text": random_ad_text(rng, language),
+                "ad_redirect": random_redirect(rng, advertiser),
+                "call_to_action_texts": random_cta_texts(rng, advertiser, language),
+                "media": random_media(rng),
+            })
+            recent.append((ad, language))
+        advertiser = ad["advertiser_name"]
+        # Carousel ads: a handful of cards, each with its own redirect, texts and media
+        if rng.random() < 0.01:
+            ad["call_to_actions"] = [
+                {
+                    "ad_redirect": random_redirect(rng, advertiser),
+                    "call_to_action_texts": random_cta_texts(rng, advertiser, language),
+                    "media": random_media(rng),
+                }
+                for _ in range(rng.randint(2, 8))
+            ]
+        ad["scraped_at"] = scraped_at.isoformat()
+        yield ad, language
+
+def to_transformed(ad: Dict[str, Any], language: str) -> Dict[str, Any]:
+    """
+    The record normalize_ad would write for `ad`, with the generated language standing in for
+    langdetect so large transformed files are cheap to build.
+    """
+    run_start_date, run_end_date = extract_dates_from_run_info(ad["run_dates"])
+    is_active = clean_text(ad["status_name"]).lower() == "active"
+    scraped_at = datetime.fromisoformat(ad["scraped_at"])
+    transformed = {
+        "library_id": extract_library_id(ad["library_id"]),
+        "advertiser_name": ad["advertiser_name"].strip(),
+        "run_start_date": date_to_iso(run_start_date),
+        "run_end_date": date_to_iso(run_end_date),
+        "run_duration_hours": calculate_duration_hours(
+            run_start_date, run_end_date, is_active, scraped_at, ad["run_dates"]
+        ),
+        "ad_text": ad["ad_text"],
+        "ad_redirect": ad["ad_redirect"],
+        "has_call_to_action": has_non_empty(ad.get("call_to_action_texts", [])),
+        "call_to_action_text": join_texts(ad.get("call_to_action_texts", [])),
+        "has_call_to_actions": has_non_empty(ad.get("call_to_actions", [])),
+        "language": language if ad["ad_text"] else None,
+        "media_images": ad["media"]["images"],
+        "media_videos": ad["media"]["videos"],
+        "media_mix": infer_media_mix(ad["media"]),
+        "is_active": is_active,
+        "scraped_at": ad["scraped_at"],
+        "normalized_at": (scraped_at + timedelta(minutes=10)).isoformat(),
+    }
+    transformed["ad_hash"] = compute_ad_hash(transformed)
+    transformed["creative_cluster_id"] = None
+    return transformed
+
+def write_synthetic_ads(parsed_path: str, transformed_path: str, rows: int, seed: int = 0):
+    """Writes matching parsed and transformed JSONL files for the same generated ads."""
+    ensure_output_file(parsed_path)
+    ensure_output_file(transformed_path)
+    tmp_parsed, tmp_transformed = parsed_path + ".tmp", transformed_path + ".tmp"
+    with open(tmp_parsed, "w", encoding="utf-8") as fparsed, \
+            open(tmp_transformed, "w", encoding="utf-8") as ftransformed:
+        for ad, language in generate_parsed_ads(rows, seed):
+            fparsed.write(json.dumps(ad, ensure_ascii=False) + "\n")
+            ftransformed.write(json.dumps(to_transformed(ad, language), ensure_ascii=False) + "\n")
+    # Only complete files get their final name, so an interrupted run is regenerated next time
+    os.replace(tmp_parsed, parsed_path)
+    os.replace(tmp_transformed, transformed_path)
@@ -1,28 +1,189 @@
 import argparse
 import asyncio
+import json
+import time
 
-from src.ads_analysis import analyze
+from contextlib import nullcontext
+
+# Stage modules pull in pandas, numpy, langdetect, playwright or lxml; they are imported by the
+# stages that need them, so e.g. `--stages analyze` never loads the browser stack
+from src.checkpoints import save_checkpoint, should_run
 from src.config import load_config
 from src.logger import shared_logger
-from src.scraper import scrape_ads
-from src.transformer import transform
+from src.metrics import export_metrics, metrics
+from src.offset_index import INDEX_FIELDS, dataset_jsonl_path, index_datasets, lookup_ads
+from src.profiling import PROFILERS, profile_stage
+
+
+PIPELINE_STAGES = ("scrape", "transform", "analyze")
+STAGES = PIPELINE_STAGES + ("stream", "parse-captured")
+
 
+def parse_stages(value: str) -> tuple:
+    stages = tuple(s.strip() for s in value.split(",") if s.strip())
+    unknown = set(stages) - set(PIPELINE_STAGES)
+    if unknown or not stages:
+        raise argparse.ArgumentTypeError(
+            f"expected a comma-separated subset of {','.join(PIPELINE_STAGES)}, got {value!r}"
+        )
+    return stages
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Run Ad pipeline.")
     parser.add_argument("--config", type=str, default="config.yaml", help="Path to config.yaml")
+    parser.add_argument(
+        "--stages",
+        type=parse_stages,
+        default=PIPELINE_STAGES,
+        help="Comma-separated stages to run, in pipeline order (default: scrape,transform,analyze)"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Run the selected stages even if their checkpoints say they are up to date"
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Run scrape, transform and analysis concurrently instead of one after another"
+    )
+    parser.add_argument(
+        "--export-jsonl",
+        action="store_true",
+        help="Export the parquet parsed/transformed datasets to their JSONL paths and exit"
+    )
+    parser.add_argument(
+        "--parse-captured",
+        metavar="PATH",
+        help="Parse captured card HTML (a directory or file) without a browser and exit"
+    )
+    parser.add_argument(
+        "--profile",
+        choices=STAGES,
+        help="Profile one stage and save the output under --profile-dir"
+    )
+    parser.add_argument("--profiler", choices=PROFILERS, default="cprofile", help="Profiler used by --profile")
+    parser.add_argument("--profile-dir", default="data/profiles", help="Where --profile saves its output")
+
+    commands = parser.add_subparsers(dest="command")
+    lookup = commands.add_parser("lookup", help="Print the current ads stored under a library_id or ad_hash")
+    lookup.add_argument("field", choices=INDEX_FIELDS)
+    lookup.add_argument("value")
+    lookup.add_argument("--dataset", choices=("parsed", "transformed"), default="transformed")
+    index = commands.add_parser("index", help="Bring the JSONL offset indexes up to date")
+    index.add_argument("--rebuild", action="store_true", help="Rebuild them from scratch")
+    jobs = commands.add_parser("jobs", help="Shard scrape and transform work across worker processes")
+    jobs.add_argument("action", choices=("enqueue", "work", "status", "merge"))
+    jobs.add_argument("--kind", choices=("scrape", "transform"), default="scrape", help="What `enqueue` enqueues")
+    jobs.add_argument("--worker-id", help="Name `work` claims jobs under (default: host-pid)")
+    jobs.add_argument("--forever", action="store_true", help="Keep `work` polling once the queue is empty")
+    report = commands.add_parser("report", help="Print per-advertiser or per-day stats from the aggregate store")
+    report.add_argument("--by", choices=("advertiser", "day"), default="advertiser")
+    report.add_argument("--advertiser", help="Only this advertiser")
+    report.add_argument("--since", metavar="YYYY-MM-DD", help="First scrape day to include")
+    report.add_argument("--until", metavar="YYYY-MM-DD", help="Last scrape day to include")
     return parser.parse_args()
 
+def run_stage(args, stage: str, fn, *fn_args):
+    """Runs one stage under its `stage_seconds` timer, and under the profiler if it was asked for."""
+    profiler = profile_stage(stage, args.profiler, args.profile_dir) if args.profile == stage else nullcontext()
+    with metrics.timer("stage_seconds", stage=stage), profiler:
+        return fn(*fn_args)
+
+def stages_ran() -> bool:
+    """Whether any stage ran; lookups, reports and skipped stages leave the last run's metrics files alone."""
+    return any(name == "stage_seconds" for name, _ in metrics.timers)
+
+def run_scrape(config: dict):
+    from src.scraper import scrape_ads
+    asyncio.run(scrape_ads(config))
+
+def run_transform(config: dict):
+    from src.transformer import transform
+    transform(config)
+
+def run_analyze(config: dict):
+    from src.ads_analysis import analyze
+    analyze(config)
+
+STAGE_RUNNERS = {"scrape": run_scrape, "transform": run_transform, "analyze": run_analyze}
+
+def run_jobs_command(args, config: dict):
+    from src import sharding
+    if args.action == "enqueue":
+        sharding.enqueue_jobs(config, args.kind)
+    elif args.action == "work":
+        run_stage(args, "work", sharding.run_worker, config, args.worker_id, not args.forever)
+    elif args.action == "merge":
+        sharding.merge_shards(config)
+    sharding.log_queue_status(config)
+
+def run_report(args, config: dict):
+    from src.aggregates import aggregates_from_config
+    store = aggregates_from_config(config)
+    if store is None:
+        shared_logger.error("Reports need `aggregates.enabled` and a transform run with it")
+        return
+    try:
+        started = time.perf_counter()
+        rows = store.report(args.by, args.advertiser, args.since, args.until)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+    finally:
+        store.close()
+    for row in rows:
+        print(json.dumps(row, ensure_ascii=False))
+    shared_logger.info(f"Reported {len(rows)} rows from {store.path} in {elapsed_ms:.1f}ms")
+
+def run_pipeline(args, config: dict):
+    """Runs the selected stages in order, skipping those whose checkpoint shows nothing changed."""
+    for stage in PIPELINE_STAGES:
+        if stage not in args.stages:
+            continue
+        if not should_run(config, stage, args.force):
+            metrics.inc("stages_skipped_total", stage=stage)
+            continue
+        run_stage(args, stage, STAGE_RUNNERS[stage], config)
+        save_checkpoint(config, stage)
+
 def main():
     args = parse_args()
     config = load_config(args.config)
     try:
-        asyncio.run(scrape_ads(config))
-        transform(config)
-        analyze(config)
+        if args.command == "lookup":
+            ads = lookup_ads(dataset_jsonl_path(config, args.dataset), args.dataset, args.field, args.value)
+            for ad in ads:
+                print(json.dumps(ad, ensure_ascii=False))
+            shared_logger.info(f"Found {len(ads)} ads with {args.field} {args.value}")
+            return
+        if args.command == "index":
+            index_datasets(config, rebuild=args.rebuild)
+            return
+        if args.command == "jobs":
+            run_jobs_command(args, config)
+            return
+        if args.command == "report":
+            run_report(args, config)
+            return
+        if args.parse_captured:
+            from src.offline_parser import parse_captured
+            run_stage(args, "parse-captured", parse_captured, config, args.parse_captured)
+            return
+        if args.export_jsonl:
+            from src.storage import export_datasets
+            export_datasets(config)
+            return
+        if args.stream:
+            from src.streaming import run_streaming_pipeline
+            run_stage(args, "stream", asyncio.run, run_streaming_pipeline(config))
+            return
+        run_pipeline(args, config)
     except Exception as e:
         shared_logger.exception("Unhandled exception during pipeline run")
+    finally:
+        if stages_ran():
+            export_metrics(config)
 
 # python main.py --config config.yaml
+# python main.py --stages analyze
 if __name__ == "__main__":
     main()
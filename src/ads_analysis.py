@@ -1,20 +1,117 @@
+import heapq
 import numpy as np
 import os
 import pandas as pd
 
 from src.logger import shared_logger
+from src.metrics import metrics
+from src.storage import dataset_dir, get_storage_format, iter_column_batches, read_columns
+from src.transform_state import superseded_ads
 from src.utils import ensure_output_file
 
 
+DEFAULT_SCORE_WEIGHTS = {
+    "text_len": 0.35,
+    "media_mix": 0.3,
+    "is_active": 0.2,
+    "duration": 0.15,
+}
+
+MEDIA_MIX_SCORES = {
+    "video-only": 1.0,
+    "both": 0.8,
+    "image-only": 0.6,
+    "none": 0.0
+}
+
+TOP_ADS_COLUMNS = [
+    'library_id',
+    'advertiser_name',
+    'proxy_performance_score',
+    'ad_text_len',
+    'media_mix',
+    'is_active',
+    'run_duration_hours'
+]
+
+# Everything scoring and the top-ads output need; columnar storage reads nothing else
+SCORE_COLUMNS = [
+    'library_id',
+    'advertiser_name',
+    'ad_text',
+    'media_mix',
+    'is_active',
+    'run_duration_hours'
+]
+
+CLUSTER_COLUMN = 'creative_cluster_id'
+
+# Inferred, library_id goes through float64 and 17-digit IDs lose their last digit
+JSON_DTYPES = {'library_id': 'int64'}
+
 def load_ads_data(filepath: str) -> pd.DataFrame:
-    df = pd.read_json(filepath, lines=True)
+    df = pd.read_json(filepath, lines=True, dtype=JSON_DTYPES)
     df['run_start_date'] = pd.to_datetime(df['run_start_date'], errors='coerce')
     df['run_end_date'] = pd.to_datetime(df['run_end_date'], errors='coerce')
     df['scraped_at'] = pd.to_datetime(df['scraped_at'], errors='coerce')
     df['normalized_at'] = pd.to_datetime(df['normalized_at'], errors='coerce')
     return df
 
-def calculate_proxy_score(row) -> float:
+def iter_ads_chunks(filepath: str, chunk_size: int):
+    """
+    Reads the transformed JSONL in chunks of `chunk_size` rows, without the datetime conversions
+    scoring never uses.
+    """
+    with pd.read_json(filepath, lines=True, chunksize=chunk_size, convert_dates=False, dtype=JSON_DTYPES) as reader:
+        for chunk in reader:
+            # A chunk where every duration is null would otherwise come back as object dtype
+            chunk["run_duration_hours"] = pd.to_numeric(chunk["run_duration_hours"], errors="coerce").astype(float)
+            yield chunk
+
+def drop_superseded(df: pd.DataFrame, superseded: set) -> pd.DataFrame:
+    """Drops the ads an interrupted incremental transform superseded but did not compact out of the file."""
+    if not superseded:
+        return df
+    candidates = df.loc[
+        df['library_id'].isin({int(library_id) for library_id, _ in superseded}), ['library_id', 'ad_hash']
+    ]
+    stale = [(str(library_id), ad_hash) in superseded for library_id, ad_hash in candidates.itertuples(index=False)]
+    return df.drop(candidates.index[stale])
+
+def coerce_columnar_frame(df: pd.DataFrame) -> pd.DataFrame:
+    # read_json turns the numeric library_id strings into integers; do the same so outputs match
+    df['library_id'] = pd.to_numeric(df['library_id'])
+    return df
+
+def iter_dataset_chunks(base_dir: str, chunk_size: int, columns: list = SCORE_COLUMNS):
+    for chunk in iter_column_batches(base_dir, columns, chunk_size):
+        yield coerce_columnar_frame(chunk)
+
+def cluster_column(config: dict):
+    """The column `analysis.best_per_cluster` dedupes the top ads on, or None."""
+    return CLUSTER_COLUMN if (config.get("analysis") or {}).get("best_per_cluster") else None
+
+def cluster_keys(df: pd.DataFrame, column: str, order: np.ndarray) -> np.ndarray:
+    """Cluster of every row; rows without one (clustering off when they were written) stand alone."""
+    if column not in df:
+        return np.array([f"row:{i}" for i in order], dtype=object)
+    keys = df[column].to_numpy(dtype=object)
+    missing = pd.isna(keys)
+    keys[missing] = [f"row:{i}" for i in order[missing]]
+    return keys
+
+def get_score_weights(config: dict) -> dict:
+    weights = (config.get("analysis") or {}).get("weights") or {}
+    unknown = set(weights) - set(DEFAULT_SCORE_WEIGHTS)
+    if unknown:
+        raise ValueError(f"Unknown score weights in config: {sorted(unknown)}")
+    return {**DEFAULT_SCORE_WEIGHTS, **weights}
+
+def calculate_proxy_score(row, weights: dict = DEFAULT_SCORE_WEIGHTS) -> float:
+    """
+    Reference (row-wise) implementation of the proxy score.
+    `calculate_proxy_scores` must stay bit-identical to it.
+    """
     # Text length: Ideal range 50–250, peak at ~150
     text = row.get("ad_text") or ""
     text_len = len(text)
@@ -25,14 +122,11 @@ def calculate_proxy_score(row) -> float:
     text_len_score = np.clip(max(peak1, peak2), 0, 1)
 
     media_type = row['media_mix']
-    media_mix_score = {
-        "video-only": 1.0,
-        "both": 0.8,
-        "image-only": 0.6,
-        "none": 0.0
-    }.get(media_type, 0.0)
+    media_mix_score = MEDIA_MIX_SCORES.get(media_type, 0.0)
 
-    is_active_score = 1.0 if row.get('is_active') else 0.0
+    # A missing status (None or NaN) counts as inactive
+    is_active = row.get('is_active')
+    is_active_score = 1.0 if is_active and not pd.isna(is_active) else 0.0
 
     # Cap duration to 36 hours before scoring
     duration = row.get("run_duration_hours") or 0
@@ -40,13 +134,139 @@ def calculate_proxy_score(row) -> float:
     duration_score = np.log1p(capped_duration) / np.log1p(36)
 
     score = (
-        0.35 * text_len_score +
-        0.3 * media_mix_score +
-        0.2 * is_active_score +
-        0.15 * duration_score
+        weights["text_len"] * text_len_score +
+        weights["media_mix"] * media_mix_score +
+        weights["is_active"] * is_active_score +
+        weights["duration"] * duration_score
     )
     return round(score, 4)
 
+def calculate_proxy_scores(df: pd.DataFrame, weights: dict = DEFAULT_SCORE_WEIGHTS) -> pd.Series:
+    """
+    Vectorized proxy score over a whole frame, column by column.
+    Mirrors `calculate_proxy_score` operation for operation so results are bit-identical.
+    """
+    text_len = df["ad_text"].fillna("").str.len().to_numpy(dtype=np.int64)
+    peak1 = np.exp(-((text_len - 50) ** 2) / (2 * 15 ** 2))
+    peak2 = np.exp(-((text_len - 150) ** 2) / (2 * 30 ** 2))
+    text_len_score = np.clip(np.maximum(peak1, peak2), 0, 1)
+
+    media_mix_score = df["media_mix"].map(MEDIA_MIX_SCORES).fillna(0.0).to_numpy(dtype=np.float64)
+
+    is_active = df["is_active"]
+    is_active_score = np.where((is_active.notna() & is_active.astype(bool)).to_numpy(), 1.0, 0.0)
+
+    # `row.get(...) or 0` turns None into 0 but keeps NaN, which is truthy
+    duration = df["run_duration_hours"].to_numpy()
+    if duration.dtype == object:
+        duration = np.where(pd.isna(duration), 0, duration)
+    capped_duration = np.minimum(duration.astype(np.float64), 36)
+    duration_score = np.log1p(capped_duration) / np.log1p(36)
+
+    score = (
+        weights["text_len"] * text_len_score +
+        weights["media_mix"] * media_mix_score +
+        weights["is_active"] * is_active_score +
+        weights["duration"] * duration_score
+    )
+    return pd.Series(np.round(score, 4), index=df.index)
+
+class TopKScorer:
+    """
+    Online top-K over scored frames, holding at most K rows in a min-heap.
+    Ties keep the ad seen first, the same order a stable descending sort gives.
+    With `cluster_column`, the heap holds at most one ad per cluster, its best, which is exactly
+    what keeping the best ad per cluster of the whole input and then the top K gives.
+    """
+
+    def __init__(self, k: int = 100, weights: dict = DEFAULT_SCORE_WEIGHTS, cluster_column: str = None):
+        self.k = k
+        self.weights = weights
+        self.cluster_column = cluster_column
+        self.seen = 0
+        self._heap = []
+        # cluster -> its entry in the heap
+        self._clusters = {}
+
+    def add_frame(self, df: pd.DataFrame):
+        metrics.inc("analysis_ads_total", len(df))
+        scores = calculate_proxy_scores(df, self.weights).to_numpy()
+        # NaN scores sort last, as they do in sort_values
+        keys = np.where(np.isnan(scores), -np.inf, scores)
+        order = np.arange(self.seen, self.seen + len(df))
+        self.seen += len(df)
+
+        candidates = np.arange(len(df))
+        if len(self._heap) >= self.k:
+            candidates = candidates[keys > self._heap[0][0][0]]
+        candidates = candidates[np.argsort(-keys[candidates], kind="stable")]
+        clusters = None
+        if self.cluster_column:
+            clusters = cluster_keys(df, self.cluster_column, order)
+            # Only each cluster's best row in the chunk can improve on what the heap holds
+            candidates = candidates[~pd.Series(clusters[candidates]).duplicated().to_numpy()]
+        # Only the chunk's own best K can make it into the heap
+        candidates = candidates[:self.k]
+        if not len(candidates):
+            return
+
+        rows = df.iloc[candidates].assign(
+            proxy_performance_score=scores[candidates],
+            ad_text_len=df['ad_text'].iloc[candidates].fillna('').str.len()
+        )[TOP_ADS_COLUMNS]
+        for i, row in zip(candidates, rows.itertuples(index=False)):
+            if clusters is not None:
+                self._push_clustered(((keys[i], -order[i]), tuple(row), clusters[i]))
+                continue
+            entry = ((keys[i], -order[i]), tuple(row))
+            if len(self._heap) < self.k:
+                heapq.heappush(self._heap, entry)
+            elif entry[0] > self._heap[0][0]:
+                heapq.heapreplace(self._heap, entry)
+
+    def _push_clustered(self, entry):
+        cluster = entry[2]
+        held = self._clusters.get(cluster)
+        if held is not None:
+            if entry[0] > held[0]:
+                # The cluster's better ad takes its place; K is small, so re-heapifying is cheap
+                self._heap[self._heap.index(held)] = entry
+                heapq.heapify(self._heap)
+                self._clusters[cluster] = entry
+            return
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, entry)
+        elif entry[0] > self._heap[0][0]:
+            evicted = heapq.heapreplace(self._heap, entry)
+            del self._clusters[evicted[2]]
+        else:
+            return
+        self._clusters[cluster] = entry
+
+    def top_frame(self) -> pd.DataFrame:
+        rows = [entry[1] for entry in sorted(self._heap, key=lambda entry: entry[0], reverse=True)]
+        return pd.DataFrame(rows, columns=TOP_ADS_COLUMNS)
+
+def select_top_ads(df: pd.DataFrame, weights: dict, top_k: int, cluster_column: str = None) -> pd.DataFrame:
+    metrics.inc("analysis_ads_total", len(df))
+    df['proxy_performance_score'] = calculate_proxy_scores(df, weights)
+    df['ad_text_len'] = df['ad_text'].fillna('').str.len()
+    # Stable, so ties keep file order and match TopKScorer
+    if cluster_column:
+        df['cluster_key'] = cluster_keys(df, cluster_column, np.arange(len(df)))
+    top_ads_df = df.sort_values(by='proxy_performance_score', ascending=False, kind='stable')
+    if cluster_column:
+        top_ads_df = top_ads_df.drop_duplicates('cluster_key')
+    return top_ads_df.head(top_k)[TOP_ADS_COLUMNS]
+
+def stream_top_ads(chunks, weights: dict, top_k: int, chunk_size: int, cluster_column: str = None) -> pd.DataFrame:
+    """Same result as select_top_ads, with peak memory bounded by `chunk_size` and `top_k`."""
+    scorer = TopKScorer(top_k, weights, cluster_column)
+    for chunk in chunks:
+        scorer.add_frame(chunk)
+    shared_logger.info(f"Scored {scorer.seen} ads in chunks of {chunk_size}")
+    return scorer.top_frame()
+
 def analyze(config: dict):
     input_path = os.path.join(
         config["paths"]["transformed_ads_dir"],
@@ -55,24 +275,38 @@ def analyze(config: dict):
     ensure_output_file(input_path)
     output_path = config["paths"]["analysis_output"]
     ensure_output_file(output_path)
-    
-    df = load_ads_data(input_path)
+
+    analysis_cfg = config.get("analysis") or {}
+    top_k = analysis_cfg.get("top_k", 100)
+
+    chunk_size = analysis_cfg.get("chunk_size", 50000)
+    columnar = get_storage_format(config) == "parquet"
+    clusters = cluster_column(config)
+    columns = SCORE_COLUMNS + [clusters] if clusters else SCORE_COLUMNS
+    # Incremental transforms need JSONL, so only JSONL output can hold superseded ads
+    superseded = set() if columnar else superseded_ads(input_path)
 
     try:
-        df['proxy_performance_score'] = df.apply(calculate_proxy_score, axis=1)
-        df['ad_text_len'] = df['ad_text'].fillna('').apply(len)
-        top_ads_df = df.sort_values(by='proxy_performance_score', ascending=False).head(100)
-        top_ads_df = top_ads_df[[
-            'library_id',
-            'advertiser_name',
-            'proxy_performance_score',
-            'ad_text_len',
-            'media_mix',
-            'is_active',
-            'run_duration_hours'
-        ]]
+        weights = get_score_weights(config)
+        if analysis_cfg.get("streaming"):
+            chunks = (
+                iter_dataset_chunks(dataset_dir(input_path), chunk_size, columns) if columnar
+                else (drop_superseded(chunk, superseded) for chunk in iter_ads_chunks(input_path, chunk_size))
+            )
+            with metrics.timer("analysis_score_seconds"):
+                top_ads_df = stream_top_ads(chunks, weights, top_k, chunk_size, clusters)
+        else:
+            with metrics.timer("analysis_load_seconds"):
+                df = (
+                    coerce_columnar_frame(read_columns(dataset_dir(input_path), columns)) if columnar
+                    else drop_superseded(load_ads_data(input_path), superseded)
+                )
+            with metrics.timer("analysis_score_seconds"):
+                top_ads_df = select_top_ads(df, weights, top_k, clusters)
         top_ads_df.to_json(output_path, orient="records", lines=True)
     except Exception as e:
         shared_logger.error(f"Error analysing ads: {e}")
+        # Let the caller know, so a failed analysis is never checkpointed as done
+        raise
 
     shared_logger.info(f"Analysed and saved: {output_path}")
@@ -0,0 +1,250 @@
+import json
+import math
+import sqlite3
+
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.logger import shared_logger
+from src.storage import scrape_date
+from src.utils import ensure_output_file
+
+
+MEDIA_MIXES = ("both", "image-only", "video-only", "none")
+GROUP_FIELDS = ("ads", "active", "media_both", "media_image_only", "media_video_only", "media_none", "duration_count", "duration_sum")
+
+# run_duration_hours histogram: bucket 0 is [0, 1) hours, then BUCKETS_PER_DOUBLING log-spaced buckets
+# per power of two up to 2**16 hours (~7 years), where the last one is open. Quantiles read off it
+# are within a few percent, and the buckets of any set of groups simply add up
+BUCKETS_PER_DOUBLING = 4
+DURATION_BUCKETS = 16 * BUCKETS_PER_DOUBLING + 1
+
+# library_id -> (advertiser, day, is_active, media_mix, duration)
+Contribution = Tuple[str, str, int, str, Optional[float]]
+
+
+def duration_bucket(hours: float) -> int:
+    if hours < 1:
+        return 0
+    return min(int(math.log2(hours) * BUCKETS_PER_DOUBLING) + 1, DURATION_BUCKETS - 1)
+
+def bucket_bounds(bucket: int) -> Tuple[float, float]:
+    if bucket == 0:
+        return 0.0, 1.0
+    return 2.0 ** ((bucket - 1) / BUCKETS_PER_DOUBLING), 2.0 ** (bucket / BUCKETS_PER_DOUBLING)
+
+def contribution(record: Dict[str, Any]) -> Contribution:
+    """What a transformed ad adds to the aggregates."""
+    duration = record.get("run_duration_hours")
+    if duration is not None and math.isnan(duration):
+        duration = None
+    return (
+        record.get("advertiser_name") or "",
+        scrape_date(record),
+        int(bool(record.get("is_active"))),
+        record.get("media_mix"),
+        duration,
+    )
+
+def histogram_quantile(counts: Dict[int, int], q: float) -> Optional[float]:
+    """Quantile of a bucketed histogram, interpolating linearly inside the bucket it falls in."""
+    total = sum(counts.values())
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for bucket in sorted(counts):
+        count = counts[bucket]
+        if count and seen + count >= rank:
+            low, high = bucket_bounds(bucket)
+            return round(low + (high - low) * (rank - seen) / count, 2)
+        seen += count
+    return round(bucket_bounds(max(counts))[1], 2)
+
+
+class AggregateStore:
+    """
+    Per-advertiser, per-scrape-day aggregates of transformed ads, kept in SQLite and updated as
+    ads are written: counts, active and media-mix counts, and a run_duration_hours histogram.
+    Every aggregate is a sum, so days merge into any date range and advertisers into totals.
+    Each library_id counts once: writing an ad again retracts what its previous version added.
+    Changes are buffered in memory and applied every `flush_every` ads and on close.
+    """
+
+    def __init__(self, path: str, flush_every: int = 1000):
+        ensure_output_file(path)
+        self.path = path
+        self.flush_every = flush_every
+        self._conn = sqlite3.connect(path, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS contributions ("
+            "  library_id TEXT PRIMARY KEY, advertiser TEXT NOT NULL, day TEXT NOT NULL,"
+            "  is_active INTEGER NOT NULL, media_mix TEXT, duration REAL);"
+            "CREATE TABLE IF NOT EXISTS groups ("
+            "  advertiser TEXT NOT NULL, day TEXT NOT NULL,"
+            + "".join(f" {field} REAL NOT NULL DEFAULT 0," for field in GROUP_FIELDS) +
+            "  PRIMARY KEY (advertiser, day));"
+            "CREATE TABLE IF NOT EXISTS duration_buckets ("
+            "  advertiser TEXT NOT NULL, day TEXT NOT NULL, bucket INTEGER NOT NULL, count INTEGER NOT NULL,"
+            "  PRIMARY KEY (advertiser, day, bucket));"
+        )
+        self._conn.commit()
+        self._pending: Dict[str, Contribution] = {}
+        self._group_deltas: Dict[Tuple[str, str], Counter] = defaultdict(Counter)
+        self._bucket_deltas: Counter = Counter()
+
+    def reset(self):
+        """Drops everything, for a full transform that rewrites the output from scratch."""
+        self._pending.clear()
+        self._group_deltas.clear()
+        self._bucket_deltas.clear()
+        self._conn.executescript("DELETE FROM contributions; DELETE FROM groups; DELETE FROM duration_buckets;")
+        self._conn.commit()
+
+    def is_empty(self) -> bool:
+        return not self._pending and self._conn.execute("SELECT 1 FROM contributions LIMIT 1").fetchone() is None
+
+    def seed_from_file(self, path: str):
+        """Counts every ad of an existing transformed JSONL file, e.g. when aggregates were just enabled."""
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                self.add(json.loads(line))
+        self.flush()
+        shared_logger.info(f"Aggregated {path} into {self.path}")
+
+    def _apply(self, contribution: Contribution, sign: int):
+        advertiser, day, is_active, media_mix, duration = contribution
+        deltas = self._group_deltas[(advertiser, day)]
+        deltas["ads"] += sign
+        deltas["active"] += sign * is_active
+        if media_mix in MEDIA_MIXES:
+            deltas["media_" + media_mix.replace("-", "_")] += sign
+        if duration is not None:
+            deltas["duration_count"] += sign
+            deltas["duration_sum"] += sign * duration
+            self._bucket_deltas[(advertiser, day, duration_bucket(duration))] += sign
+
+    def _previous(self, library_id: str) -> Optional[Contribution]:
+        if library_id in self._pending:
+            return self._pending[library_id]
+        return self._conn.execute(
+            "SELECT advertiser, day, is_active, media_mix, duration FROM contributions WHERE library_id = ?",
+            (library_id,)
+        ).fetchone()
+
+    def add(self, record: Dict[str, Any]):
+        """Counts a transformed ad, replacing the contribution of its earlier version if any."""
+        self.add_contribution(str(record["library_id"]), contribution(record))
+
+    def add_contribution(self, library_id: str, ad_contribution: Contribution):
+        """add() for an ad whose contribution was computed elsewhere, e.g. in a transform worker."""
+        previous = self._previous(library_id)
+        if previous == ad_contribution:
+            return
+        if previous is not None:
+            self._apply(previous, -1)
+        self._apply(ad_contribution, 1)
+        self._pending[library_id] = ad_contribution
+        if len(self._pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        columns = ", ".join(GROUP_FIELDS)
+        updates = ", ".join(f"{field} = {field} + excluded.{field}" for field in GROUP_FIELDS)
+        with self._conn:
+            self._conn.executemany(
+                f"INSERT INTO groups (advertiser, day, {columns}) VALUES (?, ?{', ?' * len(GROUP_FIELDS)}) "
+                f"ON CONFLICT (advertiser, day) DO UPDATE SET {updates}",
+                [key + tuple(deltas[field] for field in GROUP_FIELDS) for key, deltas in self._group_deltas.items()]
+            )
+            self._conn.executemany(
+                "INSERT INTO duration_buckets (advertiser, day, bucket, count) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (advertiser, day, bucket) DO UPDATE SET count = count + excluded.count",
+                [key + (count,) for key, count in self._bucket_deltas.items() if count]
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO contributions (library_id, advertiser, day, is_active, media_mix, duration) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(library_id,) + contribution for library_id, contribution in self._pending.items()]
+            )
+            # Groups an upsert moved every ad out of
+            self._conn.execute("DELETE FROM groups WHERE ads <= 0")
+            self._conn.execute("DELETE FROM duration_buckets WHERE count <= 0")
+        self._pending.clear()
+        self._group_deltas.clear()
+        self._bucket_deltas.clear()
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+    # Reports
+
+    def _where(self, advertiser: Optional[str], since: Optional[str], until: Optional[str]) -> Tuple[str, tuple]:
+        clauses, params = [], []
+        if advertiser is not None:
+            clauses.append("advertiser = ?")
+            params.append(advertiser)
+        if since:
+            clauses.append("day >= ?")
+            params.append(since)
+        if until:
+            clauses.append("day <= ?")
+            params.append(until)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), tuple(params)
+
+    def report(
+        self,
+        by: str = "advertiser",
+        advertiser: Optional[str] = None,
+        since: Optional[str] = None,
+        until: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        One row per advertiser or per scrape day (`by`), optionally for one advertiser and a
+        day range: ad count, active rate, media-mix shares and run_duration_hours mean/p50/p90.
+        Reads only the pre-aggregated tables.
+        """
+        if by not in ("advertiser", "day"):
+            raise ValueError(f"Unknown report grouping: {by}")
+        self.flush()
+        where, params = self._where(advertiser, since, until)
+        sums = ", ".join(f"SUM({field})" for field in GROUP_FIELDS)
+        rows = self._conn.execute(f"SELECT {by}, {sums} FROM groups{where} GROUP BY {by}", params).fetchall()
+        histograms: Dict[str, Dict[int, int]] = defaultdict(dict)
+        for key, bucket, count in self._conn.execute(
+            f"SELECT {by}, bucket, SUM(count) FROM duration_buckets{where} GROUP BY {by}, bucket", params
+        ):
+            histograms[key][bucket] = count
+
+        report = []
+        for key, *values in rows:
+            totals = dict(zip(GROUP_FIELDS, values))
+            ads = totals["ads"]
+            report.append({
+                by: key,
+                "ads": int(ads),
+                "active_rate": round(totals["active"] / ads, 4) if ads else None,
+                "media_mix_share": {
+                    mix: round(totals["media_" + mix.replace("-", "_")] / ads, 4) if ads else None
+                    for mix in MEDIA_MIXES
+                },
+                "run_duration_hours": {
+                    "count": int(totals["duration_count"]),
+                    "mean": round(totals["duration_sum"] / totals["duration_count"], 2) if totals["duration_count"] else None,
+                    "p50": histogram_quantile(histograms[key], 0.5),
+                    "p90": histogram_quantile(histograms[key], 0.9),
+                },
+            })
+        report.sort(key=lambda row: (-row["ads"], row[by]) if by == "advertiser" else row[by])
+        return report
+
+
+def aggregates_from_config(config: dict) -> Optional[AggregateStore]:
+    aggregates_cfg = config.get("aggregates") or {}
+    if not aggregates_cfg.get("enabled"):
+        return None
+    return AggregateStore(aggregates_cfg.get("path", "data/aggregates/ads.sqlite"), aggregates_cfg.get("flush_every", 1000))
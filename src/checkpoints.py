@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+import time
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.logger import shared_logger
+
+
+# Config sections whose change makes a stage's previous output out of date; `paths` always counts
+STAGE_CONFIG_SECTIONS = {
+    "scrape": ("ad_library", "queries", "scraper"),
+    "transform": ("transform", "clustering", "writer", "aggregates", "validation"),
+    "analyze": ("analysis",),
+}
+
+
+def ads_path(config: dict, dir_key: str) -> str:
+    """The JSONL file, or the parquet dataset standing in for it, that a stage reads or writes."""
+    path = os.path.join(config["paths"][dir_key], config["paths"]["output_file"])
+    if (config["paths"].get("storage_format") or "jsonl") == "parquet":
+        return os.path.splitext(path)[0]
+    return path
+
+def stage_paths(config: dict, stage: str) -> Tuple[List[str], List[str]]:
+    """(inputs, outputs) of a stage."""
+    parsed = ads_path(config, "parsed_ads_dir")
+    transformed = ads_path(config, "transformed_ads_dir")
+    return {
+        "scrape": ([], [parsed]),
+        "transform": ([parsed], [transformed]),
+        "analyze": ([transformed], [config["paths"]["analysis_output"]]),
+    }[stage]
+
+def path_fingerprint(path: str) -> Optional[list]:
+    """Size and mtime of a file, or of every file under a directory; None if it does not exist."""
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+    if os.path.isdir(path):
+        entries = []
+        for root, _, files in os.walk(path):
+            for name in files:
+                stat = os.stat(os.path.join(root, name))
+                entries.append([os.path.relpath(os.path.join(root, name), path), stat.st_size, stat.st_mtime_ns])
+        return sorted(entries)
+    return None
+
+def config_digest(config: dict, stage: str) -> str:
+    sections = {key: config.get(key) for key in ("paths",) + STAGE_CONFIG_SECTIONS[stage]}
+    return hashlib.sha256(json.dumps(sections, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def checkpoint_path(config: dict, stage: str) -> str:
+    checkpoint_dir = (config.get("checkpoints") or {}).get("dir") or "data/checkpoints"
+    return os.path.join(checkpoint_dir, f"{stage}.json")
+
+def stage_state(config: dict, stage: str) -> Dict[str, Any]:
+    inputs, outputs = stage_paths(config, stage)
+    return {
+        "config": config_digest(config, stage),
+        "inputs": {path: path_fingerprint(path) for path in inputs},
+        "outputs": {path: path_fingerprint(path) for path in outputs},
+    }
+
+def load_checkpoint(config: dict, stage: str) -> Optional[dict]:
+    try:
+        with open(checkpoint_path(config, stage), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_checkpoint(config: dict, stage: str):
+    """Records what a stage that just finished ran on and produced."""
+    path = checkpoint_path(config, stage)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({**stage_state(config, stage), "finished_at": time.time()}, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+def stale_reason(config: dict, stage: str) -> Optional[str]:
+    """Why a stage has to run, or None if its checkpoint shows it is up to date."""
+    checkpoint = load_checkpoint(config, stage)
+    if checkpoint is None:
+        return "no checkpoint"
+    if stage == "scrape":
+        # The Ad Library changes under us; only a recent enough scrape counts as current
+        max_age_h = (config.get("checkpoints") or {}).get("scrape_max_age_hours") or 0
+        if time.time() - checkpoint.get("finished_at", 0) >= max_age_h * 3600:
+            return "scrape is older than checkpoints.scrape_max_age_hours"
+    state = stage_state(config, stage)
+    if state["config"] != checkpoint.get("config"):
+        return "config changed"
+    if state["inputs"] != checkpoint.get("inputs"):
+        return "input changed"
+    if state["outputs"] != checkpoint.get("outputs"):
+        return "output missing or changed"
+    return None
+
+def should_run(config: dict, stage: str, force: bool = False) -> bool:
+    if force or not (config.get("checkpoints") or {}).get("enabled"):
+        return True
+    reason = stale_reason(config, stage)
+    if reason is None:
+        shared_logger.info(f"Skipping {stage}: up to date with its checkpoint ({checkpoint_path(config, stage)})")
+        return False
+    shared_logger.info(f"Running {stage}: {reason}")
+    return True
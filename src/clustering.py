@@ -0,0 +1,272 @@
+import hashlib
+import json
+import os
+import re
+import unicodedata
+import numpy as np
+
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from src.logger import shared_logger
+
+
+# Byte n-grams of the normalized text; short enough that a swapped word only touches a few
+SHINGLE_BYTES = 5
+
+# Query parameters that differ between otherwise identical landing pages
+TRACKING_PARAMS = {"fbclid", "gclid", "msclkid", "ref", "source", "campaign_id", "ad_id", "adset_id"}
+TRACKING_PREFIXES = ("utm_", "_nc_", "hsa_")
+
+# Facebook wraps outbound links as l.facebook.com/l.php?u=<target>&h=<signature>
+REDIRECT_HOSTS = {"l.facebook.com", "lm.facebook.com", "l.instagram.com"}
+
+NON_WORD_RE = re.compile(r"[^\w\s]+")
+SPACE_RE = re.compile(r"\s+")
+
+HASH_SHIFT = np.uint64(32)
+
+# An ad's MinHash signature and its LSH band keys
+CreativeKey = Tuple[np.ndarray, List[int]]
+
+
+def normalize_creative_text(text: Optional[str]) -> str:
+    """Case, punctuation, emoji and whitespace removed, so cosmetic edits do not count as changes."""
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return SPACE_RE.sub(" ", NON_WORD_RE.sub(" ", text)).strip()
+
+def canonical_redirect(url: Optional[str]) -> Optional[str]:
+    """The landing page without Facebook's link wrapper, tracking parameters or fragment."""
+    if not url:
+        return None
+    parts = urlsplit(url.strip())
+    if parts.hostname in REDIRECT_HOSTS:
+        target = dict(parse_qsl(parts.query)).get("u")
+        if target:
+            parts = urlsplit(target)
+    host = (parts.hostname or "").removeprefix("www.")
+    query = urlencode(sorted(
+        (k, v) for k, v in parse_qsl(parts.query)
+        if k.lower() not in TRACKING_PARAMS and not k.lower().startswith(TRACKING_PREFIXES)
+    ))
+    return f"{host}{parts.path.rstrip('/')}" + (f"?{query}" if query else "")
+
+def canonical_media(url: str) -> str:
+    """
+    The media file name: CDN host, size variant (`stp=`) and signature parameters change between
+    renditions of the same image or video, the file name does not.
+    """
+    return url.split("?", 1)[0].split("#", 1)[0].rsplit("/", 1)[-1]
+
+def _token_hash(token: str) -> int:
+    return int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+
+def creative_features(record: Dict[str, Any]) -> np.ndarray:
+    """
+    The set MinHash is taken over: byte shingles of the normalized ad text plus one token per
+    canonical redirect and media file, all as uint64.
+    """
+    features = []
+    text = normalize_creative_text(record.get("ad_text")).encode("utf-8")
+    if text:
+        data = np.frombuffer(text, dtype=np.uint8).astype(np.uint64)
+        if len(data) < SHINGLE_BYTES:
+            data = np.concatenate([data, np.zeros(SHINGLE_BYTES - len(data), dtype=np.uint64)])
+        count = len(data) - SHINGLE_BYTES + 1
+        shingles = np.zeros(count, dtype=np.uint64)
+        for i in range(SHINGLE_BYTES):
+            shingles |= data[i:i + count] << np.uint64(8 * i)
+        features.append(shingles)
+    tokens = []
+    redirect = canonical_redirect(record.get("ad_redirect"))
+    if redirect:
+        tokens.append(f"redirect:{redirect}")
+    for field in ("media_images", "media_videos"):
+        tokens.extend(f"media:{canonical_media(url)}" for url in record.get(field) or [] if url)
+    if tokens:
+        features.append(np.array([_token_hash(t) for t in tokens], dtype=np.uint64))
+    if not features:
+        return np.zeros(0, dtype=np.uint64)
+    return np.unique(np.concatenate(features))
+
+
+class MinHasher:
+    """MinHash signatures from `num_perm` multiply-shift hash functions seeded by `seed`."""
+
+    def __init__(self, num_perm: int = 64, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        # Odd multipliers keep multiply-shift universal
+        self._a = rng.integers(1, 2 ** 63, size=num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self._b = rng.integers(0, 2 ** 63, size=num_perm, dtype=np.uint64)
+
+    def signature(self, features: np.ndarray) -> np.ndarray:
+        # uint64 arithmetic wraps, which is exactly the mod 2**64 multiply-shift needs
+        hashed = (features[:, None] * self._a + self._b) >> HASH_SHIFT
+        return hashed.min(axis=0).astype(np.uint32)
+
+
+class CreativeClusterer:
+    """
+    Online near-duplicate clustering with MinHash and LSH banding.
+    Each ad is compared only with the clusters that share at least one band of its signature, and
+    joins the most similar one whose first ad it matches with estimated Jaccard similarity of at
+    least `threshold`; otherwise it starts a cluster of its own. Work per ad does not depend on
+    how many ads came before, so a run is linear in the number of ads, with memory growing with
+    the number of distinct creatives.
+    A cluster is named after the `ad_hash` of its first ad, so the same input order gives the same ids.
+    """
+
+    def __init__(self, num_perm: int = 64, bands: int = 16, threshold: float = 0.7, seed: int = 0):
+        if num_perm % bands:
+            raise ValueError(f"clustering.num_perm ({num_perm}) must be a multiple of clustering.bands ({bands})")
+        self.hasher = MinHasher(num_perm, seed)
+        self.num_perm = num_perm
+        self.seed = seed
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        # Folds each band of a signature into a single integer bucket key
+        self._band_weights = np.random.default_rng(seed + 1).integers(
+            1, 2 ** 63, size=(bands, self.rows), dtype=np.uint64
+        )
+        self._buckets: List[Dict[int, int]] = [{} for _ in range(bands)]
+        self._signatures = np.zeros((1024, num_perm), dtype=np.uint32)
+        self.cluster_ids: List[str] = []
+        self._known: Dict[str, int] = {}
+        self.assigned = 0
+
+    def _band_keys(self, signature: np.ndarray) -> List[int]:
+        bands = signature.astype(np.uint64).reshape(self.bands, self.rows)
+        return (bands * self._band_weights).sum(axis=1).tolist()
+
+    def _match(self, signature: np.ndarray, band_keys: List[int]) -> Optional[int]:
+        candidates = {c for band, key in enumerate(band_keys) if (c := self._buckets[band].get(key)) is not None}
+        if not candidates:
+            return None
+        candidates = sorted(candidates)
+        similarity = (self._signatures[candidates] == signature).mean(axis=1)
+        best = int(np.argmax(similarity))
+        return candidates[best] if similarity[best] >= self.threshold else None
+
+    def _new_cluster(self, cluster_id: str, signature: np.ndarray, band_keys: List[int]) -> int:
+        index = len(self.cluster_ids)
+        if index == len(self._signatures):
+            self._signatures = np.concatenate([self._signatures, np.zeros_like(self._signatures)])
+        self._signatures[index] = signature
+        for band, key in enumerate(band_keys):
+            self._buckets[band].setdefault(key, index)
+        self.cluster_ids.append(cluster_id)
+        self._known[cluster_id] = index
+        return index
+
+    def creative_key(self, record: Dict[str, Any]) -> Optional[CreativeKey]:
+        """
+        The signature and band keys of an ad, or None when it has nothing to compare. Needs no
+        clusters, so transform workers compute it and the parent only matches it with assign_key.
+        """
+        features = creative_features(record)
+        if not len(features):
+            return None
+        signature = self.hasher.signature(features)
+        return signature, self._band_keys(signature)
+
+    def assign(self, record: Dict[str, Any]) -> str:
+        """The cluster id for a transformed ad, starting a new cluster if nothing is similar enough."""
+        return self.assign_key(record["ad_hash"], self.creative_key(record))
+
+    def assign_key(self, ad_hash: str, key: Optional[CreativeKey]) -> str:
+        """assign() for an ad whose creative_key was computed elsewhere."""
+        self.assigned += 1
+        own_id = ad_hash[:16]
+        if key is None:
+            # Nothing to compare; exact duplicates still share an ad_hash
+            return own_id
+        signature, band_keys = key
+        match = self._match(signature, band_keys)
+        if match is not None:
+            return self.cluster_ids[match]
+        if own_id in self._known:
+            return own_id
+        self._new_cluster(own_id, signature, band_keys)
+        return own_id
+
+    def add_existing(self, record: Dict[str, Any]):
+        """Registers an ad that already has a cluster id, e.g. from an earlier incremental run."""
+        cluster_id = record.get("creative_cluster_id")
+        if not cluster_id or cluster_id in self._known:
+            return
+        features = creative_features(record)
+        if len(features):
+            signature = self.hasher.signature(features)
+            self._new_cluster(cluster_id, signature, self._band_keys(signature))
+
+    def seed_from_file(self, path: str):
+        """Registers every cluster of an existing transformed JSONL file, in file order."""
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                self.add_existing(json.loads(line))
+        shared_logger.info(f"Loaded {len(self.cluster_ids)} creative clusters from {path}")
+
+    def save(self, path: str, output_size: int):
+        """
+        Writes the cluster signatures and their LSH bucket keys to an .npz file, tagged with the
+        size of the transformed file they describe, so the next incremental run loads them
+        instead of re-hashing every ad.
+        """
+        count = len(self.cluster_ids)
+        signatures = self._signatures[:count]
+        band_keys = (
+            signatures.astype(np.uint64).reshape(count, self.bands, self.rows) * self._band_weights
+        ).sum(axis=2)
+        # Written under a temporary name and renamed, so a crash never leaves half a file
+        with open(path + ".tmp", "wb") as f:
+            np.savez(
+                f,
+                params=np.array([self.num_perm, self.bands, self.seed, output_size], dtype=np.int64),
+                signatures=signatures,
+                band_keys=band_keys,
+                cluster_ids=np.array(self.cluster_ids, dtype=str)
+            )
+        os.replace(path + ".tmp", path)
+
+    def load(self, path: str, output_size: int) -> bool:
+        """
+        Restores clusters saved for a transformed file of `output_size` bytes with the same
+        parameters. Returns False, leaving the clusterer empty, if there are none that match.
+        """
+        if not os.path.exists(path):
+            return False
+        with np.load(path) as saved:
+            if saved["params"].tolist() != [self.num_perm, self.bands, self.seed, output_size]:
+                return False
+            signatures, band_keys = saved["signatures"], saved["band_keys"]
+            cluster_ids = saved["cluster_ids"].tolist()
+        count = len(cluster_ids)
+        self._signatures = np.zeros((max(1024, count * 2), self.num_perm), dtype=np.uint32)
+        self._signatures[:count] = signatures
+        self.cluster_ids = cluster_ids
+        self._known = {cluster_id: index for index, cluster_id in enumerate(cluster_ids)}
+        # Earlier clusters keep a shared bucket, as when they were added one by one
+        for band, bucket in enumerate(self._buckets):
+            for index, key in enumerate(band_keys[:, band].tolist()):
+                bucket.setdefault(key, index)
+        shared_logger.info(f"Loaded {count} creative clusters from {path}")
+        return True
+
+    def log_stats(self):
+        shared_logger.info(f"Clustered {self.assigned} ads into {len(self.cluster_ids)} creative clusters")
+
+
+def clusterer_from_config(config: dict) -> Optional[CreativeClusterer]:
+    cluster_cfg = config.get("clustering") or {}
+    if not cluster_cfg.get("enabled"):
+        return None
+    return CreativeClusterer(
+        num_perm=cluster_cfg.get("num_perm", 64),
+        bands=cluster_cfg.get("bands", 16),
+        threshold=cluster_cfg.get("threshold", 0.7),
+        seed=cluster_cfg.get("seed", 0)
+    )
@@ -1,4 +1,6 @@
 AD_CARD_SELECTOR = "div.xrvj5dj > div.xh8yej3"
+SEEN_CARD_ATTRIBUTE = "data-ad-pipeline-seen" # set on cards already parsed when tracking by tag
+UNSEEN_AD_CARD_SELECTOR = f"{AD_CARD_SELECTOR}:not([{SEEN_CARD_ATTRIBUTE}])"
 
 SUMMARY_BLOCK_SELECTOR = "div.x78zum5.xdt5ytf.x2lwn1j.xeuugli" # within ad card
 
@@ -0,0 +1,206 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from src.logger import shared_logger
+
+
+@dataclass
+class Job:
+    id: int
+    kind: str
+    key: str
+    payload: Dict[str, Any]
+    attempts: int
+
+
+# (kind, key, payload, max_attempts), as passed to JobQueue.enqueue
+JobSpec = Tuple[str, str, Dict[str, Any], int]
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class JobQueue:
+    """
+    A job queue in one SQLite file, shared by worker processes on one machine or on several that
+    mount the same filesystem (one with working POSIX locks; SQLite's locking does the rest).
+    A claimed job is leased for `lease_s` seconds and the worker keeps the lease alive with
+    heartbeats. A job whose lease runs out goes back to the queue, so a killed worker only costs
+    a retry. Failed jobs are retried after a backoff until `max_attempts` is used up.
+    Every state change checks the worker and attempt that own the job, so a worker that lost its
+    lease cannot complete a job someone else is now running.
+    """
+
+    def __init__(self, path: str, lease_s: float = 120, retry_backoff_s: float = 10):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.lease_s = lease_s
+        self.retry_backoff_s = retry_backoff_s
+        # Autocommit; writes that must be atomic open their own BEGIN IMMEDIATE
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "  id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            "  kind TEXT NOT NULL, key TEXT NOT NULL UNIQUE, payload TEXT NOT NULL,"
+            "  state TEXT NOT NULL DEFAULT 'pending',"
+            "  attempts INTEGER NOT NULL DEFAULT 0, max_attempts INTEGER NOT NULL,"
+            "  worker TEXT, lease_expires REAL, available_at REAL NOT NULL DEFAULT 0,"
+            "  output TEXT, error TEXT, updated_at REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, available_at)")
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def enqueue(self, kind: str, key: str, payload: Dict[str, Any], max_attempts: int = 3) -> bool:
+        """Adds a job unless one with the same key exists, so enqueueing twice is harmless."""
+        cursor = self._conn.execute(
+            "INSERT OR IGNORE INTO jobs (kind, key, payload, max_attempts, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (kind, key, json.dumps(payload), max_attempts, time.time())
+        )
+        return cursor.rowcount == 1
+
+    def enqueue_many(self, specs: Iterable[JobSpec]) -> int:
+        return sum(self.enqueue(*spec) for spec in specs)
+
+    def claim(self, worker: str) -> Optional[Job]:
+        """Leases the oldest runnable job: pending and past its backoff, or running on an expired lease."""
+        now = time.time()
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Expired leases that used up their attempts fail here instead of running again
+            self._conn.execute(
+                "UPDATE jobs SET state = 'failed', error = 'lease expired', worker = NULL, updated_at = ? "
+                "WHERE state = 'running' AND lease_expires < ? AND attempts >= max_attempts",
+                (now, now)
+            )
+            row = self._conn.execute(
+                "SELECT id, kind, key, payload, attempts FROM jobs "
+                "WHERE (state = 'pending' AND available_at <= ?) OR (state = 'running' AND lease_expires < ?) "
+                "ORDER BY id LIMIT 1",
+                (now, now)
+            ).fetchone()
+            if row is None:
+                self._conn.execute("COMMIT")
+                return None
+            job_id, kind, key, payload, attempts = row
+            self._conn.execute(
+                "UPDATE jobs SET state = 'running', worker = ?, attempts = ?, lease_expires = ?, updated_at = ? "
+                "WHERE id = ?",
+                (worker, attempts + 1, now + self.lease_s, now, job_id)
+            )
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        if attempts:
+            shared_logger.info(f"Retrying job {key} (attempt {attempts + 1})")
+        return Job(job_id, kind, key, json.loads(payload), attempts + 1)
+
+    def _update_owned(self, job: Job, worker: str, assignments: str, params: tuple) -> bool:
+        cursor = self._conn.execute(
+            f"UPDATE jobs SET {assignments}, updated_at = ? "
+            "WHERE id = ? AND state = 'running' AND worker = ? AND attempts = ?",
+            params + (time.time(), job.id, worker, job.attempts)
+        )
+        return cursor.rowcount == 1
+
+    def heartbeat(self, job: Job, worker: str) -> bool:
+        """Extends the lease; False means it was lost and the job may be running elsewhere."""
+        return self._update_owned(job, worker, "lease_expires = ?", (time.time() + self.lease_s,))
+
+    def complete(self, job: Job, worker: str, output: Any = None, follow_ups: Iterable[JobSpec] = ()) -> bool:
+        """
+        Marks the job done and enqueues `follow_ups` in the same transaction, only if the job is
+        still this worker's: a worker that lost its lease leaves no jobs behind for its attempt.
+        """
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            done = self._update_owned(
+                job, worker, "state = 'done', output = ?, error = NULL, lease_expires = NULL", (json.dumps(output),)
+            )
+            if done:
+                self.enqueue_many(follow_ups)
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        return done
+
+    def fail(self, job: Job, worker: str, error: str) -> bool:
+        """Puts the job back after a backoff, or marks it failed once its attempts are used up."""
+        row = self._conn.execute("SELECT max_attempts FROM jobs WHERE id = ?", (job.id,)).fetchone()
+        if row and job.attempts >= row[0]:
+            return self._update_owned(job, worker, "state = 'failed', error = ?, lease_expires = NULL", (error,))
+        return self._update_owned(
+            job, worker, "state = 'pending', error = ?, lease_expires = NULL, available_at = ?",
+            (error, time.time() + self.retry_backoff_s * job.attempts)
+        )
+
+    def counts(self) -> Dict[str, int]:
+        counts = {"pending": 0, "running": 0, "done": 0, "failed": 0}
+        counts.update(dict(self._conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state")))
+        return counts
+
+    def jobs(self, kind: Optional[str] = None, state: Optional[str] = None) -> List[Dict[str, Any]]:
+        rows = self._conn.execute(
+            "SELECT id, kind, key, state, attempts, worker, output, error FROM jobs "
+            "WHERE (? IS NULL OR kind = ?) AND (? IS NULL OR state = ?) ORDER BY id",
+            (kind, kind, state, state)
+        )
+        return [
+            {
+                "id": job_id, "kind": job_kind, "key": key, "state": job_state, "attempts": attempts,
+                "worker": worker, "output": json.loads(output) if output else None, "error": error,
+            }
+            for job_id, job_kind, key, job_state, attempts, worker, output, error in rows
+        ]
+
+
+class Heartbeat:
+    """Keeps a job's lease alive from a background thread while the job runs."""
+
+    def __init__(self, queue: JobQueue, job: Job, worker: str, interval_s: float):
+        self.queue_path = queue.path
+        self.lease_s = queue.lease_s
+        self.job = job
+        self.worker = worker
+        self.interval_s = interval_s
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"heartbeat-{job.key}", daemon=True)
+
+    def _run(self):
+        # SQLite connections stay in the thread that opened them
+        queue = JobQueue(self.queue_path, self.lease_s)
+        try:
+            while not self._stop.wait(self.interval_s):
+                if not queue.heartbeat(self.job, self.worker):
+                    shared_logger.warning(f"Lost the lease on job {self.job.key}")
+                    self.lost = True
+                    return
+        finally:
+            queue.close()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
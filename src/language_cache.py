@@ -0,0 +1,129 @@
+import hashlib
+import sqlite3
+import time
+
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+from src.utils import ensure_output_file
+
+
+class LanguageCache:
+    """
+    Content-addressed cache of detected languages.
+    An in-process LRU sits in front of a SQLite store that persists across runs
+    and is trimmed to `max_entries` by least recent use.
+    """
+
+    def __init__(self, path: str, memory_size: int = 10000, max_entries: int = 1000000):
+        ensure_output_file(path)
+        self.path = path
+        self.memory_size = memory_size
+        self.max_entries = max_entries
+        self._memory: "OrderedDict[str, str]" = OrderedDict()
+        self._touched: Dict[str, float] = {}
+        self._pending = 0
+        self._conn = sqlite3.connect(path, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS languages ("
+            "key TEXT PRIMARY KEY, language TEXT NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS languages_last_used ON languages (last_used)")
+        self._conn.commit()
+        self.reset_stats()
+
+    # Part of every key; bumped when what is detected for a key changes, so older entries never match
+    KEY_VERSION = 2
+
+    @staticmethod
+    def make_key(text: str) -> str:
+        return hashlib.sha256(f"{LanguageCache.KEY_VERSION}:{text}".encode("utf-8")).hexdigest()
+
+    def reset_stats(self):
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def pop_stats(self) -> Dict[str, int]:
+        stats = self.stats()
+        self.reset_stats()
+        return stats
+
+    def _remember(self, key: str, language: str):
+        self._memory[key] = language
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[str]:
+        language = self._memory.get(key)
+        if language is not None:
+            self._memory.move_to_end(key)
+            self._touched[key] = time.time()
+            self.memory_hits += 1
+            return language
+
+        row = self._conn.execute("SELECT language FROM languages WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self._remember(key, row[0])
+        self._touched[key] = time.time()
+        self.disk_hits += 1
+        return row[0]
+
+    def put(self, key: str, language: str):
+        self._remember(key, language)
+        self._conn.execute(
+            "INSERT OR REPLACE INTO languages (key, language, last_used) VALUES (?, ?, ?)",
+            (key, language, time.time())
+        )
+        self._pending += 1
+        if self._pending >= 1000:
+            self.flush()
+
+    def get_or_detect(self, text: str, detect_fn: Callable[[str], str], key_text: Optional[str] = None) -> str:
+        """Detects the language of `text`, cached under `key_text` (`text` itself by default)."""
+        key = self.make_key(text if key_text is None else key_text)
+        language = self.get(key)
+        if language is None:
+            self.misses += 1
+            language = detect_fn(text)
+            self.put(key, language)
+        return language
+
+    def flush(self):
+        if self._touched:
+            self._conn.executemany(
+                "UPDATE languages SET last_used = ? WHERE key = ?",
+                [(ts, key) for key, ts in self._touched.items()]
+            )
+            self._touched.clear()
+        self._evict()
+        self._conn.commit()
+        self._pending = 0
+
+    def _evict(self):
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM languages").fetchone()
+        excess = count - self.max_entries
+        if excess <= 0:
+            return
+        self._conn.execute(
+            "DELETE FROM languages WHERE key IN "
+            "(SELECT key FROM languages ORDER BY last_used LIMIT ?)",
+            (excess,)
+        )
+        self.evictions += excess
+
+    def close(self):
+        self.flush()
+        self._conn.close()
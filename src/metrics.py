@@ -0,0 +1,169 @@
+import json
+import os
+import time
+
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from src.logger import shared_logger
+
+
+METRIC_PREFIX = "ad_pipeline"
+
+# (name, sorted label pairs)
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def metric_key(name: str, labels: Dict[str, Any]) -> MetricKey:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+class Metrics:
+    """
+    Process-wide counters and timers.
+    Pool workers hand theirs back with `pop_snapshot` and the parent `merge`s them, like the
+    language cache counters.
+    """
+
+    def __init__(self):
+        self.started_at = datetime.now(timezone.utc)
+        self._started = time.monotonic()
+        self.counters: Counter = Counter()
+        # key -> [count, total seconds, max seconds]
+        self.timers: Dict[MetricKey, list] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self.counters[metric_key(name, labels)] += value
+
+    def observe(self, name: str, seconds: float, **labels):
+        timer = self.timers.setdefault(metric_key(name, labels), [0, 0.0, 0.0])
+        timer[0] += 1
+        timer[1] += seconds
+        timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def counter(self, name: str, **labels) -> float:
+        """Value of one counter, or the sum over all label sets when no labels are given."""
+        if labels:
+            return self.counters[metric_key(name, labels)]
+        return sum(v for (n, _), v in self.counters.items() if n == name)
+
+    def timer_total(self, name: str, **labels) -> float:
+        if labels:
+            return self.timers.get(metric_key(name, labels), [0, 0.0, 0.0])[1]
+        return sum(t[1] for (n, _), t in self.timers.items() if n == name)
+
+    def pop_snapshot(self) -> dict:
+        snapshot = {"counters": dict(self.counters), "timers": self.timers}
+        self.counters = Counter()
+        self.timers = {}
+        return snapshot
+
+    def merge(self, snapshot: Optional[dict]):
+        if not snapshot:
+            return
+        self.counters.update(snapshot["counters"])
+        for key, (count, total, longest) in snapshot["timers"].items():
+            timer = self.timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] += count
+            timer[1] += total
+            timer[2] = max(timer[2], longest)
+
+    def derived(self) -> Dict[str, Optional[float]]:
+        """The ratios people ask about: throughput per stage, RPCs per card, quarantine rate."""
+        def ratio(a: float, b: float) -> Optional[float]:
+            return round(a / b, 4) if b else None
+
+        cards = self.counter("scraper_cards_total")
+        return {
+            "scrape_ads_per_s": ratio(self.counter("scraper_ads_total"), self.timer_total("stage_seconds", stage="scrape")),
+            "transform_ads_per_s": ratio(self.counter("transform_ads_total"), self.timer_total("stage_seconds", stage="transform")),
+            "analysis_ads_per_s": ratio(self.counter("analysis_ads_total"), self.timer_total("stage_seconds", stage="analyze")),
+            "parser_rpcs_per_card": ratio(self.counter("parser_rpcs_total"), cards),
+            "quarantine_rate": ratio(self.counter("scraper_quarantined_total"), cards),
+            "detect_language_mean_ms": ratio(
+                self.timer_total("detect_language_seconds") * 1000,
+                sum(t[0] for (n, _), t in self.timers.items() if n == "detect_language_seconds")
+            ),
+        }
+
+    def summary(self) -> dict:
+        def labelled(name: str, labels) -> str:
+            return name + format_labels(labels)
+
+        return {
+            "started_at": self.started_at.isoformat(),
+            "finished_at": datetime.now(timezone.utc).isoformat(),
+            "duration_s": round(time.monotonic() - self._started, 3),
+            "counters": {labelled(n, l): v for (n, l), v in sorted(self.counters.items())},
+            "timers": {
+                labelled(n, l): {
+                    "count": count,
+                    "total_s": round(total, 6),
+                    "mean_s": round(total / count, 6) if count else None,
+                    "max_s": round(longest, 6),
+                }
+                for (n, l), (count, total, longest) in sorted(self.timers.items())
+            },
+            "derived": self.derived(),
+        }
+
+    def to_prometheus(self) -> str:
+        """Prometheus text exposition format; timers become summaries without quantiles."""
+        lines = []
+        for name in sorted({n for n, _ in self.counters}):
+            full_name = f"{METRIC_PREFIX}_{name}"
+            lines.append(f"# TYPE {full_name} counter")
+            for (n, labels), value in sorted(self.counters.items()):
+                if n == name:
+                    lines.append(f"{full_name}{format_labels(labels)} {value}")
+        for name in sorted({n for n, _ in self.timers}):
+            full_name = f"{METRIC_PREFIX}_{name}"
+            lines.append(f"# TYPE {full_name} summary")
+            for (n, labels), (count, total, _) in sorted(self.timers.items()):
+                if n == name:
+                    lines.append(f"{full_name}_sum{format_labels(labels)} {total:.6f}")
+                    lines.append(f"{full_name}_count{format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        # Written under a temporary name and renamed, so a textfile collector never reads half a file
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(path + ".tmp", path)
+
+    def write_summary(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+metrics = Metrics()
+
+def export_metrics(config: dict):
+    """Writes the run's metrics where `metrics` in config.yaml points, if enabled."""
+    metrics_cfg = config.get("metrics") or {}
+    if not metrics_cfg.get("enabled"):
+        return
+    if metrics_cfg.get("prometheus_file"):
+        metrics.write_prometheus(metrics_cfg["prometheus_file"])
+    if metrics_cfg.get("summary_file"):
+        metrics.write_summary(metrics_cfg["summary_file"])
+    derived = ", ".join(f"{k}={v}" for k, v in metrics.derived().items() if v is not None)
+    shared_logger.info(f"Run metrics: {derived or 'nothing recorded'}")
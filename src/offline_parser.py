@@ -0,0 +1,278 @@
+import glob
+import json
+import os
+import re
+import shutil
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from lxml import html as lxml_html
+from lxml.cssselect import CSSSelector
+
+from src.constants import (
+    SUMMARY_BLOCK_SELECTOR,
+    CONTENT_BLOCK_SELECTOR,
+    ADVERTISER_SELECTOR,
+    AD_BODY_BLOCK_SELECTOR,
+    AD_VIDEO_SELECTOR,
+    CALL_TO_ACTION_REF,
+    CALL_TO_ACTION_BLOCK_SELECTOR,
+    CALL_TO_ACTION_TEXTS_SELECTORS,
+    CALL_TO_ACTIONS_BLOCK_SELECTOR,
+    CALL_TO_ACTION_CARD_SELECTOR
+)
+from src.logger import shared_logger
+from src.storage import JsonlWriter, get_storage_format, jsonl_writer_options, open_ads_writer
+
+
+# Elements that start a new line in innerText; spans, links and the like do not
+BLOCK_TAGS = {
+    "address", "article", "aside", "blockquote", "dd", "div", "dl", "dt", "figcaption", "figure",
+    "footer", "form", "h1", "h2", "h3", "h4", "h5", "h6", "header", "hr", "li", "main", "nav",
+    "ol", "p", "pre", "section", "table", "tr", "ul",
+}
+HIDDEN_TAGS = {"script", "style", "template", "noscript", "head", "title"}
+
+
+@lru_cache(maxsize=None)
+def _compiled(selector: str) -> CSSSelector:
+    return CSSSelector(selector)
+
+def query_selector_all(el, selector: str) -> list:
+    # Like the browser's querySelectorAll, only descendants match, never `el` itself
+    if el is None:
+        return []
+    return [found for found in _compiled(selector)(el) if found is not el]
+
+def query_selector(el, selector: str):
+    found = query_selector_all(el, selector)
+    return found[0] if found else None
+
+def inner_text(el) -> Optional[str]:
+    """
+    Approximates the browser's innerText for the inline markup of ad cards:
+    whitespace runs collapse to one space, <br> and block elements break lines.
+    """
+    if el is None:
+        return None
+    parts: List[str] = []
+
+    def walk(node):
+        tag = node.tag if isinstance(node.tag, str) else None
+        if tag in HIDDEN_TAGS:
+            return
+        if tag == "br":
+            parts.append("\n")
+        else:
+            block = tag in BLOCK_TAGS
+            if block:
+                parts.append("\n")
+            if node.text and tag is not None:
+                parts.append(re.sub(r"[ \t\r\n\f]+", " ", node.text))
+            for child in node:
+                walk(child)
+                if child.tail:
+                    parts.append(re.sub(r"[ \t\r\n\f]+", " ", child.tail))
+            if block:
+                parts.append("\n")
+
+    walk(el)
+    lines = "".join(parts).split("\n")
+    text = "\n".join(line.strip(" ") for line in lines)
+    return re.sub(r"^\n+|\n+$", "", re.sub(r"\n{2,}", "\n", text))
+
+def extract_media(media_div) -> Dict[str, List[str]]:
+    if media_div is None:
+        return {
+            "images": [],
+            "videos": []
+        }
+    return {
+        "images": [img.get("src") for img in media_div.iter("img") if img.get("src")],
+        "videos": [vid.get("src") for vid in media_div.iter("video") if vid.get("src")],
+    }
+
+def extract_call_to_action_texts(cta_div) -> Optional[List[Optional[str]]]:
+    if cta_div is None:
+        return None
+    return [inner_text(query_selector(cta_div, selector)) for selector in CALL_TO_ACTION_TEXTS_SELECTORS]
+
+def parse_ad_html(card) -> Dict[str, Any]:
+    """Offline twin of parser.parse_ad: same selectors, same dict shape, lxml element in."""
+    ad = {}
+    summary_block = query_selector(card, SUMMARY_BLOCK_SELECTOR)
+    summary_items = summary_block.xpath("./div")
+    ad["status_name"] = inner_text(query_selector(summary_items[0], "span")) if len(summary_items) > 0 else None
+    ad["library_id"] = inner_text(query_selector(summary_items[1], "span")) if len(summary_items) > 1 else None
+    ad["run_dates"] = inner_text(query_selector(summary_items[2], "span")) if len(summary_items) > 2 else None
+
+    content_block = query_selector(card, CONTENT_BLOCK_SELECTOR)
+    advertiser = content_block.xpath("." + ADVERTISER_SELECTOR)
+    ad["advertiser_name"] = inner_text(advertiser[0] if advertiser else None)
+
+    ad_body_block = query_selector(content_block, AD_BODY_BLOCK_SELECTOR)
+    ad["ad_text"] = inner_text(query_selector(ad_body_block, "div._7jyr > span"))
+    ad["ad_redirect"] = None
+    ad["call_to_action_texts"] = []
+
+    video = query_selector(ad_body_block, AD_VIDEO_SELECTOR)
+    ad["media"] = extract_media(video)
+
+    ref_block = query_selector(ad_body_block, CALL_TO_ACTION_REF)
+    if ref_block is not None:
+        ad["ad_redirect"] = ref_block.get("href")
+        cta_block = query_selector(ref_block, CALL_TO_ACTION_BLOCK_SELECTOR)
+        ad["call_to_action_texts"] = extract_call_to_action_texts(cta_block)
+        found_media = extract_media(ref_block)
+        ad["media"] = {
+            "images": ad["media"]["images"] + found_media["images"],
+            "videos": ad["media"]["videos"] + found_media["videos"]
+        }
+    ctas_block = query_selector(content_block, CALL_TO_ACTIONS_BLOCK_SELECTOR)
+    if ctas_block is not None:
+        ad["call_to_actions"] = []
+        for cta_card in query_selector_all(ctas_block, CALL_TO_ACTION_CARD_SELECTOR):
+            redirect_url_el = query_selector(cta_card, "a")
+            cta_block = query_selector(cta_card, CALL_TO_ACTION_BLOCK_SELECTOR)
+            ad["call_to_actions"].append({
+                "ad_redirect": redirect_url_el.get("href") if redirect_url_el is not None else None,
+                "call_to_action_texts": extract_call_to_action_texts(cta_block),
+                "media": extract_media(cta_card),
+            })
+
+    return ad
+
+def card_from_record(record: Dict[str, Any]):
+    """
+    Captured records hold the card's outerHTML; quarantine records only its innerHTML,
+    which is wrapped in a stand-in card element.
+    """
+    if record.get("outer_html"):
+        return lxml_html.fragment_fromstring(record["outer_html"])
+    return lxml_html.fragment_fromstring(record.get("html") or "", create_parent="div")
+
+def parse_html_records(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Pool entry point; returns results shaped like parser.parse_ad_handles."""
+    results = []
+    for record in records:
+        try:
+            ad = parse_ad_html(card_from_record(record))
+            for key in ("scraped_at", "query"):
+                if record.get(key):
+                    ad[key] = record[key]
+            results.append({"ad": ad})
+        except Exception as e:
+            results.append({
+                "error": str(e),
+                "html": record.get("outer_html") or record.get("html"),
+                "scraped_at": record.get("scraped_at"),
+            })
+    return results
+
+def captured_files(path: str) -> List[str]:
+    if os.path.isfile(path):
+        return [path]
+    return sorted(
+        glob.glob(os.path.join(path, "**", "*.jsonl"), recursive=True)
+        + glob.glob(os.path.join(path, "**", "*.html"), recursive=True)
+    )
+
+def iter_captured_records(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Captured JSONL files hold one record per card, `.html` files a single card's outerHTML;
+    those were saved when the card was scraped, so their mtime stands in for `scraped_at`.
+    """
+    for file_path in captured_files(path):
+        with open(file_path, "r", encoding="utf-8") as f:
+            if file_path.endswith(".html"):
+                scraped_at = datetime.fromtimestamp(os.fstat(f.fileno()).st_mtime, timezone.utc).isoformat()
+                yield {"outer_html": f.read(), "scraped_at": scraped_at}
+                continue
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    shared_logger.error(f"Skipping invalid JSON line in {file_path}: {line}")
+                    continue
+                # Transformed ads quarantined by schema validation have no card HTML to re-parse
+                if record.get("stage") != "validate":
+                    yield record
+
+def iter_parsed_captures(path: str, workers: int, chunk_size: int) -> Iterator[Dict[str, Any]]:
+    """Parses captured cards in input order, chunk by chunk on a process pool."""
+    records = iter_captured_records(path)
+
+    def chunks():
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Keep a bounded window of chunks in flight so memory does not grow with input size
+        pending = deque()
+        for chunk in chunks():
+            pending.append(executor.submit(parse_html_records, chunk))
+            if len(pending) >= workers * 2:
+                yield from pending.popleft().result()
+        for future in pending:
+            yield from future.result()
+
+def parse_captured(config: dict, path: str) -> Tuple[int, int]:
+    """
+    Re-parses captured card HTML under `path` without a browser and appends the ads to the parsed output.
+    Cards that still fail go to `offline_parser.failures_file` in quarantine, collected in a tmp file
+    and moved there after the pass: replacing it when it was one of the inputs, appended otherwise,
+    so a pass never reads its own failures back. Returns (parsed, failed) counts.
+    """
+    offline_cfg = config.get("offline_parser") or {}
+    workers = offline_cfg.get("workers") or os.cpu_count() or 1
+    chunk_size = offline_cfg.get("chunk_size", 500)
+    output_path = os.path.join(config["paths"]["parsed_ads_dir"], config["paths"]["output_file"])
+    failures_path = os.path.join(
+        config["paths"]["quarantine_dir"],
+        offline_cfg.get("failures_file") or f"unparsed_{config['paths']['output_file']}"
+    )
+    failures_tmp = failures_path + ".tmp"
+    reparsing_failures = os.path.abspath(failures_path) in map(os.path.abspath, captured_files(path))
+    if os.path.exists(failures_tmp):
+        # Left behind by an interrupted pass
+        os.remove(failures_tmp)
+
+    parsed, failed = 0, 0
+    writer = open_ads_writer(output_path, get_storage_format(config), "parsed", config=config)
+    quarantine_writer = JsonlWriter(failures_tmp, **jsonl_writer_options(config))
+    try:
+        batch = []
+        for result in iter_parsed_captures(path, workers, chunk_size):
+            if "error" in result:
+                failed += 1
+                quarantine_writer.write([result])
+                continue
+            batch.append(result["ad"])
+            if len(batch) >= chunk_size:
+                writer.write(batch)
+                parsed += len(batch)
+                batch.clear()
+        writer.write(batch)
+        parsed += len(batch)
+    finally:
+        writer.close()
+        quarantine_writer.close()
+    if reparsing_failures:
+        os.replace(failures_tmp, failures_path)
+    else:
+        if failed:
+            with open(failures_tmp, "rb") as src, open(failures_path, "ab") as dst:
+                shutil.copyfileobj(src, dst)
+        os.remove(failures_tmp)
+
+    shared_logger.info(f"Parsed {parsed} captured ads from {path} ({failed} failed). Output: {output_path}")
+    return parsed, failed
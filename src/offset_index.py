@@ -0,0 +1,342 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from src.logger import shared_logger
+
+
+INDEX_MAGIC = b"ADIDX001"
+# magic, capacity, count, indexed data size, head and tail fingerprints of the indexed data
+HEADER = struct.Struct("<8sQQQ16s16s")
+HEADER_SIZE = 128
+# key hash, data offset + 1 (0 marks an empty slot)
+SLOT = struct.Struct("<QQ")
+INITIAL_CAPACITY = 1024
+MAX_LOAD = 0.5
+# Bytes hashed at each end of the indexed data to notice a rewritten file
+FINGERPRINT_BYTES = 4096
+
+INDEX_FIELDS = ("library_id", "ad_hash")
+
+IndexKey = Tuple[str, str]
+
+
+class StaleIndexError(Exception):
+    pass
+
+
+def index_path_for(data_path: str) -> str:
+    return data_path + ".idx"
+
+def key_hash(field: str, value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(f"{field}\0{value}".encode("utf-8"), digest_size=8).digest(), "little")
+
+def normalize_key(field: str, value: str) -> str:
+    if field not in INDEX_FIELDS:
+        raise ValueError(f"Unknown index field: {field}")
+    if field == "library_id":
+        # Parsed ads keep the "Library ID: " label; accept either spelling
+        return value.rsplit(" ", 1)[-1]
+    return value
+
+def index_keys(record: Dict[str, Any], kind: str) -> List[IndexKey]:
+    """The (field, value) pairs a record is indexed under."""
+    if kind == "transformed":
+        library_id, ad_hash = record.get("library_id"), record.get("ad_hash")
+    else:
+        # Parsed ads carry no ad_hash yet; index the one the transform will assign
+        from src.transformer import compute_raw_ad_hash, extract_library_id
+        library_id = extract_library_id(record.get("library_id"))
+        try:
+            ad_hash = compute_raw_ad_hash(record)
+        except Exception:
+            ad_hash = None
+    keys = []
+    if library_id:
+        keys.append(("library_id", str(library_id)))
+    if ad_hash:
+        keys.append(("ad_hash", ad_hash))
+    return keys
+
+def data_fingerprints(fd: int, size: int) -> Tuple[bytes, bytes]:
+    head = os.pread(fd, min(size, FINGERPRINT_BYTES), 0)
+    tail_start = max(0, size - FINGERPRINT_BYTES)
+    tail = os.pread(fd, size - tail_start, tail_start)
+    return (
+        hashlib.blake2b(head, digest_size=16).digest(),
+        hashlib.blake2b(tail, digest_size=16).digest()
+    )
+
+
+class OffsetIndex:
+    """
+    Sidecar `<file>.idx` mapping library_id and ad_hash to byte offsets of JSONL lines.
+    An open-addressing hash table in a memory-mapped file: lookups probe a few slots and read only
+    the matching lines. Keys may repeat (a re-scraped library_id, one ad_hash across many ads),
+    so a lookup returns every line stored under the key.
+    The header records how many bytes of the data file are indexed and fingerprints of them:
+    a longer data file is "behind" and only its tail gets indexed, a shorter or rewritten one is
+    "stale" and gets rebuilt.
+    """
+
+    def __init__(self, data_path: str, kind: str, index_path: Optional[str] = None):
+        if kind not in ("parsed", "transformed"):
+            raise ValueError(f"Unknown dataset kind: {kind}")
+        self.data_path = data_path
+        self.kind = kind
+        self.index_path = index_path or index_path_for(data_path)
+        self._file = None
+        self._map = None
+        self.capacity = 0
+        self.count = 0
+        self.data_size = 0
+
+    # Opening and state
+
+    def _open(self):
+        if self._map is not None:
+            return
+        if not os.path.exists(self.index_path):
+            self._create(INITIAL_CAPACITY)
+        self._file = open(self.index_path, "r+b")
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        magic, self.capacity, self.count, self.data_size, _, _ = HEADER.unpack_from(self._map, 0)
+        if magic != INDEX_MAGIC:
+            self.close()
+            raise ValueError(f"{self.index_path} is not an offset index")
+
+    def _create(self, capacity: int, path: Optional[str] = None):
+        path = path or self.index_path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(HEADER.pack(INDEX_MAGIC, capacity, 0, 0, b"\0" * 16, b"\0" * 16).ljust(HEADER_SIZE, b"\0"))
+            f.truncate(HEADER_SIZE + capacity * SLOT.size)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _sync(self):
+        """Drops the mapping if another writer replaced the index file (grown or rebuilt), else rereads the header."""
+        if self._map is None:
+            return
+        try:
+            replaced = os.stat(self.index_path).st_ino != os.fstat(self._file.fileno()).st_ino
+        except FileNotFoundError:
+            replaced = True
+        if replaced:
+            self.close()
+        else:
+            _, self.capacity, self.count, self.data_size, _, _ = HEADER.unpack_from(self._map, 0)
+
+    def status(self) -> str:
+        """"fresh", "behind" (data was appended since), "stale" (data was rewritten) or "missing"."""
+        self._sync()
+        if not os.path.exists(self.index_path):
+            return "missing"
+        self._open()
+        if not os.path.exists(self.data_path):
+            return "stale"
+        with open(self.data_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < self.data_size:
+                return "stale"
+            head, tail = data_fingerprints(f.fileno(), self.data_size)
+        _, _, _, _, saved_head, saved_tail = HEADER.unpack_from(self._map, 0)
+        if (head, tail) != (saved_head, saved_tail):
+            return "stale"
+        return "fresh" if size == self.data_size else "behind"
+
+    def refresh(self) -> str:
+        """Brings the index up to date with the data file; returns the status it started from."""
+        status = self.status()
+        if status in ("missing", "stale"):
+            self.rebuild()
+        elif status == "behind":
+            self._index_from(self.data_size)
+        return status
+
+    def rebuild(self):
+        self.close()
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+        self._open()
+        self._index_from(0)
+
+    def _index_from(self, offset: int):
+        """Indexes complete lines after `offset`; a trailing partial line is left for later."""
+        indexed = 0
+        if os.path.exists(self.data_path):
+            with open(self.data_path, "rb") as f:
+                f.seek(offset)
+                for raw in f:
+                    if not raw.endswith(b"\n"):
+                        break
+                    try:
+                        keys = index_keys(json.loads(raw), self.kind)
+                    except ValueError:
+                        keys = []
+                    self.add(keys, offset)
+                    offset += len(raw)
+                    indexed += 1
+        self.commit(offset)
+        shared_logger.info(f"Indexed {indexed} lines of {self.data_path} ({self.count} keys)")
+
+    # Writing
+
+    def add(self, keys: Iterable[IndexKey], offset: int):
+        self._open()
+        for field, value in keys:
+            if (self.count + 1) > self.capacity * MAX_LOAD:
+                self._grow()
+            self._insert(key_hash(field, value), offset + 1)
+            self.count += 1
+
+    def _insert(self, hashed: int, stored_offset: int):
+        mask = self.capacity - 1
+        slot = hashed & mask
+        while True:
+            position = HEADER_SIZE + slot * SLOT.size
+            if not SLOT.unpack_from(self._map, position)[1]:
+                SLOT.pack_into(self._map, position, hashed, stored_offset)
+                return
+            slot = (slot + 1) & mask
+
+    def _grow(self):
+        """Rehashes every entry into a table twice the size; entries carry their hash, so the data is not reread."""
+        tmp_path = self.index_path + ".tmp"
+        old_map, old_capacity = self._map, self.capacity
+        _, _, _, _, head, tail = HEADER.unpack_from(old_map, 0)
+        self._create(old_capacity * 2, tmp_path)
+        with open(tmp_path, "r+b") as f:
+            self._map = mmap.mmap(f.fileno(), 0)
+            self.capacity = old_capacity * 2
+            for slot in range(old_capacity):
+                hashed, stored_offset = SLOT.unpack_from(old_map, HEADER_SIZE + slot * SLOT.size)
+                if stored_offset:
+                    self._insert(hashed, stored_offset)
+            self._write_header(self.data_size, head, tail)
+            self._map.close()
+        old_map.close()
+        self._file.close()
+        os.replace(tmp_path, self.index_path)
+        self._file = open(self.index_path, "r+b")
+        self._map = mmap.mmap(self._file.fileno(), 0)
+
+    def _write_header(self, data_size: int, head: bytes, tail: bytes):
+        HEADER.pack_into(self._map, 0, INDEX_MAGIC, self.capacity, self.count, data_size, head, tail)
+
+    def commit(self, data_size: int):
+        """Records that the first `data_size` bytes of the data file are indexed."""
+        self._open()
+        if os.path.exists(self.data_path):
+            with open(self.data_path, "rb") as f:
+                head, tail = data_fingerprints(f.fileno(), data_size)
+        else:
+            # Nothing written yet: an empty index
+            data_size = 0
+            head = tail = hashlib.blake2b(b"", digest_size=16).digest()
+        self.data_size = data_size
+        self._write_header(data_size, head, tail)
+        self._map.flush()
+
+    # Reading
+
+    def offsets(self, field: str, value: str) -> List[int]:
+        """Candidate offsets for a key; they can include 64-bit hash collisions, which `lookup` filters out."""
+        self._open()
+        hashed = key_hash(field, normalize_key(field, value))
+        mask = self.capacity - 1
+        slot = hashed & mask
+        found = []
+        while True:
+            slot_hash, stored_offset = SLOT.unpack_from(self._map, HEADER_SIZE + slot * SLOT.size)
+            if not stored_offset:
+                return found
+            if slot_hash == hashed:
+                found.append(stored_offset - 1)
+            slot = (slot + 1) & mask
+
+    def _committed_offsets(self, field: str, value: str) -> List[int]:
+        # Entries past the committed size belong to a write that never finished; a tail
+        # re-index can add a second entry for the same line
+        return sorted({offset for offset in self.offsets(field, value) if offset < self.data_size})
+
+    def _read(self, f, offset: int) -> Dict[str, Any]:
+        f.seek(offset)
+        try:
+            return json.loads(f.readline())
+        except ValueError:
+            raise StaleIndexError(f"{self.index_path} points at a broken line at byte {offset}")
+
+    def _superseded(self, f, record: Dict[str, Any], offset: int) -> bool:
+        """Whether a later line holds the same library_id; both files append new versions of an ad."""
+        keys = [key for key in index_keys(record, self.kind) if key[0] == "library_id"]
+        if not keys:
+            return False
+        later = [o for o in self._committed_offsets(*keys[0]) if o > offset]
+        return any(keys[0] in index_keys(self._read(f, o), self.kind) for o in later)
+
+    def lookup(self, field: str, value: str) -> List[Dict[str, Any]]:
+        """
+        The current records stored under the key, in file order, reading only those lines.
+        A line superseded by a later version of the same ad is left out.
+        """
+        value = normalize_key(field, value)
+        records = []
+        with open(self.data_path, "rb") as f:
+            for offset in self._committed_offsets(field, value):
+                record = self._read(f, offset)
+                if (field, value) in index_keys(record, self.kind) and not self._superseded(f, record, offset):
+                    records.append(record)
+        return records
+
+
+def dataset_jsonl_path(config: dict, kind: str) -> str:
+    base_dir = config["paths"]["parsed_ads_dir" if kind == "parsed" else "transformed_ads_dir"]
+    return os.path.join(base_dir, config["paths"]["output_file"])
+
+def lookup_ads(data_path: str, kind: str, field: str, value: str) -> List[Dict[str, Any]]:
+    """
+    Fetches ads by library_id or ad_hash from a JSONL file through its offset index,
+    bringing the index up to date first if the file changed since it was written.
+    """
+    if not os.path.exists(data_path):
+        raise FileNotFoundError(f"No JSONL file to look up ads in: {data_path}")
+    with OffsetIndex(data_path, kind) as index:
+        status = index.refresh()
+        if status != "fresh":
+            shared_logger.info(f"Offset index for {data_path} was {status}; updated")
+        try:
+            return index.lookup(field, value)
+        except StaleIndexError as e:
+            shared_logger.warning(f"{e}; rebuilding")
+            index.rebuild()
+            return index.lookup(field, value)
+
+def index_datasets(config: dict, rebuild: bool = False):
+    """Brings the parsed and transformed JSONL indexes up to date, or rebuilds them from scratch."""
+    for kind in ("parsed", "transformed"):
+        data_path = dataset_jsonl_path(config, kind)
+        if not os.path.exists(data_path):
+            shared_logger.info(f"Skipping the {kind} index: {data_path} does not exist")
+            continue
+        with OffsetIndex(data_path, kind) as index:
+            if rebuild:
+                index.rebuild()
+            else:
+                shared_logger.info(f"Offset index for {data_path} was {index.refresh()}")
@@ -1,5 +1,6 @@
-from typing import Any, Dict, List, Optional
-from playwright.async_api import ElementHandle
+import asyncio
+from typing import Any, Dict, List, Optional, Tuple
+from playwright.async_api import ElementHandle, Page
 
 from src.constants import (
     SUMMARY_BLOCK_SELECTOR,
@@ -13,6 +14,7 @@ from src.constants import (
     CALL_TO_ACTIONS_BLOCK_SELECTOR,
     CALL_TO_ACTION_CARD_SELECTOR
 )
+from src.metrics import metrics
 
 
 async def extract_text(el: Optional[ElementHandle]) -> Optional[str]:
@@ -98,3 +100,190 @@ async def parse_ad(ad_el: ElementHandle) -> Dict[str, Any]:
             })
 
     return ad
+
+class CountingHandle:
+    """
+    Wraps an ElementHandle and counts every Playwright round trip made through it, including
+    those through the handles it returns, as `parser_rpcs_total`.
+    """
+
+    def __init__(self, handle: ElementHandle):
+        self._handle = handle
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._handle, name)
+        if not asyncio.iscoroutinefunction(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            metrics.inc("parser_rpcs_total")
+            result = await attr(*args, **kwargs)
+            if isinstance(result, ElementHandle):
+                return CountingHandle(result)
+            if isinstance(result, list):
+                return [CountingHandle(r) if isinstance(r, ElementHandle) else r for r in result]
+            return result
+        return call
+
+async def parse_ad_handles(ad_cards: List[ElementHandle], capture_html: bool = False) -> List[Dict[str, Any]]:
+    """
+    Parses cards one ElementHandle RPC at a time.
+    Returns {"ad": ...} per parsed card, or {"error": ..., "html": ...} for cards that failed.
+    With `capture_html`, each result also carries the card's "outer_html".
+    """
+    results = []
+    for ad_el in map(CountingHandle, ad_cards):
+        try:
+            result = {"ad": await parse_ad(ad_el)}
+        except Exception as e:
+            try:
+                html = await ad_el.inner_html()
+            except Exception:
+                html = None
+            result = {"error": str(e), "html": html}
+        if capture_html:
+            try:
+                result["outer_html"] = await ad_el.evaluate("(el) => el.outerHTML")
+            except Exception:
+                result["outer_html"] = None
+        results.append(result)
+    return results
+
+# Mirrors parse_ad step for step, but runs inside the page so a whole scroll batch costs one round trip
+EXTRACT_ADS_SCRIPT = """
+({ cardSelector, start, s, markAttribute, detach, captureHtml }) => {
+    const text = (el) => (el ? el.innerText : null);
+    const xpathFirst = (root, xpath) => document.evaluate(
+        "." + xpath, root, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null
+    ).singleNodeValue;
+    const media = (root) => {
+        if (!root) {
+            return { images: [], videos: [] };
+        }
+        const sources = (tag) => Array.from(root.querySelectorAll(tag))
+            .map((el) => el.getAttribute("src"))
+            .filter((src) => src);
+        return { images: sources("img"), videos: sources("video") };
+    };
+    const ctaTexts = (ctaDiv) => (
+        ctaDiv ? s.ctaTexts.map((selector) => text(ctaDiv.querySelector(selector))) : null
+    );
+
+    const parse = (card) => {
+        const ad = {};
+        const summaryItems = card.querySelector(s.summary).querySelectorAll(":scope > div");
+        ad.status_name = summaryItems.length > 0 ? text(summaryItems[0].querySelector("span")) : null;
+        ad.library_id = summaryItems.length > 1 ? text(summaryItems[1].querySelector("span")) : null;
+        ad.run_dates = summaryItems.length > 2 ? text(summaryItems[2].querySelector("span")) : null;
+
+        const contentBlock = card.querySelector(s.content);
+        ad.advertiser_name = text(xpathFirst(contentBlock, s.advertiser));
+
+        const adBodyBlock = contentBlock.querySelector(s.adBody);
+        ad.ad_text = text(adBodyBlock.querySelector("div._7jyr > span"));
+        ad.ad_redirect = null;
+        ad.call_to_action_texts = [];
+        ad.media = media(adBodyBlock.querySelector(s.video));
+
+        const refBlock = adBodyBlock.querySelector(s.ctaRef);
+        if (refBlock) {
+            ad.ad_redirect = refBlock.getAttribute("href");
+            ad.call_to_action_texts = ctaTexts(refBlock.querySelector(s.ctaBlock));
+            const found = media(refBlock);
+            ad.media = {
+                images: ad.media.images.concat(found.images),
+                videos: ad.media.videos.concat(found.videos),
+            };
+        }
+        const ctasBlock = contentBlock.querySelector(s.ctasBlock);
+        if (ctasBlock) {
+            ad.call_to_actions = Array.from(ctasBlock.querySelectorAll(s.ctaCard)).map((card) => {
+                const redirectEl = card.querySelector("a");
+                return {
+                    ad_redirect: redirectEl ? redirectEl.getAttribute("href") : null,
+                    call_to_action_texts: ctaTexts(card.querySelector(s.ctaBlock)),
+                    media: media(card),
+                };
+            });
+        }
+        return ad;
+    };
+
+    const cards = Array.from(document.querySelectorAll(cardSelector)).slice(start);
+    const results = cards.map((card) => {
+        let result;
+        try {
+            result = { ad: parse(card) };
+        } catch (e) {
+            result = { error: String(e), html: card.innerHTML };
+        }
+        if (captureHtml) {
+            result.outer_html = card.outerHTML;
+        }
+        if (markAttribute) {
+            card.setAttribute(markAttribute, "");
+        }
+        if (detach) {
+            card.remove();
+        }
+        return result;
+    });
+    return { total: start + cards.length, results };
+}
+"""
+
+EXTRACT_ADS_SELECTORS = {
+    "summary": SUMMARY_BLOCK_SELECTOR,
+    "content": CONTENT_BLOCK_SELECTOR,
+    "advertiser": ADVERTISER_SELECTOR,
+    "adBody": AD_BODY_BLOCK_SELECTOR,
+    "video": AD_VIDEO_SELECTOR,
+    "ctaRef": CALL_TO_ACTION_REF,
+    "ctaBlock": CALL_TO_ACTION_BLOCK_SELECTOR,
+    "ctaTexts": list(CALL_TO_ACTION_TEXTS_SELECTORS),
+    "ctasBlock": CALL_TO_ACTIONS_BLOCK_SELECTOR,
+    "ctaCard": CALL_TO_ACTION_CARD_SELECTOR,
+}
+
+async def parse_ads_in_page(
+    page: Page,
+    card_selector: str,
+    start: int,
+    mark_attribute: Optional[str] = None,
+    detach: bool = False,
+    capture_html: bool = False
+) -> Tuple[int, List[Dict[str, Any]]]:
+    """
+    Parses every card after index `start` with a single page.evaluate call.
+    Parsed cards can be tagged with `mark_attribute` and removed from the DOM in the same call.
+    Returns the total card count and results shaped like parse_ad_handles.
+    """
+    metrics.inc("parser_rpcs_total")
+    batch = await page.evaluate(
+        EXTRACT_ADS_SCRIPT,
+        {
+            "cardSelector": card_selector,
+            "start": start,
+            "s": EXTRACT_ADS_SELECTORS,
+            "markAttribute": mark_attribute,
+            "detach": detach,
+            "captureHtml": capture_html,
+        }
+    )
+    return batch["total"], batch["results"]
+
+MARK_CARDS_SCRIPT = """
+([cards, markAttribute, detach]) => cards.forEach((card) => {
+    card.setAttribute(markAttribute, "");
+    if (detach) {
+        card.remove();
+    }
+})
+"""
+
+async def release_ad_handles(page: Page, ad_cards: List[ElementHandle], mark_attribute: str, detach: bool = False):
+    """Tags parsed cards in one round trip, optionally detaches them, then disposes their handles."""
+    if not ad_cards:
+        return
+    await page.evaluate(MARK_CARDS_SCRIPT, [ad_cards, mark_attribute, detach])
+    await asyncio.gather(*(ad_el.dispose() for ad_el in ad_cards), return_exceptions=True)
@@ -0,0 +1,64 @@
+import cProfile
+import io
+import os
+import pstats
+import tracemalloc
+
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Iterator
+
+from src.logger import shared_logger
+from src.utils import ensure_output_file
+
+
+PROFILERS = ("cprofile", "tracemalloc")
+
+# Lines kept in the human-readable report next to the raw profile
+REPORT_LINES = 40
+
+
+@contextmanager
+def profile_stage(stage: str, profiler: str, output_dir: str) -> Iterator[None]:
+    """
+    Profiles the wrapped stage and saves the result under `output_dir`:
+    cProfile writes a `.prof` file (for pstats/snakeviz) plus the top functions by cumulative time,
+    tracemalloc a snapshot plus the top allocating lines and the peak traced memory.
+    Only this process is profiled; transform pool workers are not.
+    """
+    if profiler not in PROFILERS:
+        raise ValueError(f"Unknown profiler: {profiler}")
+    base_path = os.path.join(output_dir, f"{stage}-{datetime.now(timezone.utc):%Y%m%dT%H%M%S}")
+    ensure_output_file(base_path)
+
+    if profiler == "cprofile":
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(base_path + ".prof")
+            report = io.StringIO()
+            pstats.Stats(profile, stream=report).sort_stats("cumulative").print_stats(REPORT_LINES)
+            with open(base_path + ".txt", "w", encoding="utf-8") as f:
+                f.write(report.getvalue())
+            shared_logger.info(f"Saved cProfile output for {stage}: {base_path}.prof, {base_path}.txt")
+        return
+
+    tracemalloc.start(25)
+    try:
+        yield
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        snapshot.dump(base_path + ".tracemalloc")
+        with open(base_path + ".txt", "w", encoding="utf-8") as f:
+            f.write(f"Peak traced memory: {peak / 1024 / 1024:.1f} MiB\n\n")
+            for stat in snapshot.statistics("lineno")[:REPORT_LINES]:
+                f.write(f"{stat}\n")
+        shared_logger.info(
+            f"Saved tracemalloc output for {stage} (peak {peak / 1024 / 1024:.1f} MiB): "
+            f"{base_path}.tracemalloc, {base_path}.txt"
+        )
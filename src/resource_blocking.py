@@ -0,0 +1,100 @@
+import re
+
+from collections import Counter
+from typing import Optional
+from playwright.async_api import BrowserContext, Response, Route
+
+from src.logger import shared_logger
+
+
+DEFAULT_BLOCKED_RESOURCE_TYPES = ["image", "media", "font"]
+
+DEFAULT_BLOCKED_URL_PATTERNS = [
+    r"google-analytics\.com",
+    r"googletagmanager\.com",
+    r"doubleclick\.net",
+    r"connect\.facebook\.net/.*/fbevents\.js",
+    r"facebook\.com/tr[/?]",
+    r"/ajax/bz",
+    r"/ajax/bnzai",
+]
+
+# Requests that load more ads must never be blocked, whatever the other rules say
+DEFAULT_ALLOWED_URL_PATTERNS = [
+    r"/api/graphql",
+    r"/ads/library/async/",
+]
+
+
+class ResourceBlocker:
+    """
+    page.route profile that aborts media, fonts and analytics while letting the
+    XHR/GraphQL calls that load more ads through.
+    In "audit" mode nothing is aborted; requests that would be blocked are only counted,
+    which also measures how many bytes blocking saves.
+    """
+
+    def __init__(self, blocking_cfg: Optional[dict] = None):
+        blocking_cfg = blocking_cfg or {}
+        self.audit = blocking_cfg.get("mode", "block") == "audit"
+        self.resource_types = set(blocking_cfg.get("resource_types", DEFAULT_BLOCKED_RESOURCE_TYPES))
+        self.blocked_patterns = [
+            re.compile(p) for p in blocking_cfg.get("url_patterns", DEFAULT_BLOCKED_URL_PATTERNS)
+        ]
+        self.allowed_patterns = [
+            re.compile(p) for p in blocking_cfg.get("allow_url_patterns", DEFAULT_ALLOWED_URL_PATTERNS)
+        ]
+        self.blocked_requests = Counter()
+        self.blocked_bytes = 0
+        self.allowed_requests = 0
+        self.allowed_bytes = 0
+        self._would_block = set()
+
+    def should_block(self, url: str, resource_type: str) -> bool:
+        if any(p.search(url) for p in self.allowed_patterns):
+            return False
+        return resource_type in self.resource_types or any(p.search(url) for p in self.blocked_patterns)
+
+    async def install(self, context: BrowserContext):
+        await context.route("**/*", self._handle_route)
+        context.on("response", self._on_response)
+
+    async def _handle_route(self, route: Route):
+        request = route.request
+        if not self.should_block(request.url, request.resource_type):
+            await route.continue_()
+            return
+        self.blocked_requests[request.resource_type] += 1
+        if self.audit:
+            self._would_block.add(request)
+            await route.continue_()
+        else:
+            await route.abort("blockedbyclient")
+
+    def _on_response(self, response: Response):
+        size = int(response.headers.get("content-length") or 0)
+        if response.request in self._would_block:
+            self._would_block.discard(response.request)
+            self.blocked_bytes += size
+        else:
+            self.allowed_requests += 1
+            self.allowed_bytes += size
+
+    def stats(self) -> dict:
+        return {
+            "blocked_requests": sum(self.blocked_requests.values()),
+            "blocked_by_type": dict(self.blocked_requests),
+            "blocked_bytes": self.blocked_bytes if self.audit else None,
+            "allowed_requests": self.allowed_requests,
+            "allowed_bytes": self.allowed_bytes,
+        }
+
+    def log_stats(self):
+        stats = self.stats()
+        verb = "Would block" if self.audit else "Blocked"
+        by_type = ", ".join(f"{k}={v}" for k, v in sorted(stats["blocked_by_type"].items()))
+        blocked_bytes = f", {stats['blocked_bytes']} bytes" if self.audit else ""
+        shared_logger.info(
+            f"{verb} {stats['blocked_requests']} requests ({by_type}){blocked_bytes}; "
+            f"allowed {stats['allowed_requests']} requests, {stats['allowed_bytes']} bytes"
+        )
@@ -1,82 +1,335 @@
+import asyncio
 import os
+import re
 from datetime import datetime, timezone
-from playwright.async_api import async_playwright
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from playwright.async_api import BrowserContext, Page, async_playwright
 
-from src.constants import AD_CARD_SELECTOR
+from src.constants import AD_CARD_SELECTOR, SEEN_CARD_ATTRIBUTE, UNSEEN_AD_CARD_SELECTOR
 from src.logger import shared_logger
-from src.parser import parse_ad
-from src.utils import build_ad_library_url, ensure_output_file, write_batch_to_file
+from src.metrics import metrics
+from src.parser import parse_ad_handles, parse_ads_in_page, release_ad_handles
+from src.resource_blocking import ResourceBlocker
+from src.storage import JsonlWriter, get_storage_format, jsonl_writer_options, open_ads_writer
+from src.utils import build_ad_library_url, ensure_output_file
 
 
-async def scrape_ads(config: dict):
-    ad_params = config["ad_library"]
+# Resolves once more than `count` elements match `selector`, or with grew=false after `timeout` ms.
+# Re-counting is throttled so a burst of DOM mutations costs one querySelectorAll.
+WAIT_FOR_CARDS_SCRIPT = """
+({ selector, count, timeout }) => new Promise((resolve) => {
+    const start = performance.now();
+    const grown = () => document.querySelectorAll(selector).length > count;
+    let timer = null;
+    let scheduled = false;
+    const observer = new MutationObserver(() => {
+        if (scheduled) {
+            return;
+        }
+        scheduled = true;
+        setTimeout(() => {
+            scheduled = false;
+            if (grown()) {
+                finish(true);
+            }
+        }, 50);
+    });
+    const finish = (grew) => {
+        observer.disconnect();
+        clearTimeout(timer);
+        resolve({ grew, elapsed_ms: Math.round(performance.now() - start) });
+    };
+    if (grown()) {
+        return finish(true);
+    }
+    observer.observe(document.body, { childList: true, subtree: true });
+    timer = setTimeout(() => finish(false), timeout);
+})
+"""
+
+
+class NetworkActivity:
+    """Tracks in-flight requests of a page so waits can stop once the network has gone quiet."""
+
+    def __init__(self, page: Page):
+        self.in_flight = 0
+        self.last_change = asyncio.get_running_loop().time()
+        page.on("request", self._started)
+        page.on("requestfinished", self._finished)
+        page.on("requestfailed", self._finished)
+
+    def _started(self, _request):
+        self.in_flight += 1
+        self.last_change = asyncio.get_running_loop().time()
+
+    def _finished(self, _request):
+        self.in_flight = max(0, self.in_flight - 1)
+        self.last_change = asyncio.get_running_loop().time()
+
+    async def wait_idle(self, idle_ms: int, settle_ms: int):
+        """Returns once no request has been in flight for `idle_ms`, but never before `settle_ms`."""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        while True:
+            now = loop.time()
+            quiet = self.in_flight == 0 and (now - self.last_change) * 1000 >= idle_ms
+            if quiet and (now - started) * 1000 >= settle_ms:
+                return
+            await asyncio.sleep(0.05)
+
+async def wait_for_new_cards(
+    page: Page,
+    network: NetworkActivity,
+    card_selector: str,
+    card_count: int,
+    timeout_ms: int,
+    settle_ms: int,
+    idle_ms: int
+) -> Dict[str, Any]:
+    """
+    Waits until more than `card_count` cards match `card_selector`, the network goes idle
+    after at least `settle_ms`, or `timeout_ms` passes, whichever comes first.
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    grow = asyncio.create_task(page.evaluate(
+        WAIT_FOR_CARDS_SCRIPT,
+        {"selector": card_selector, "count": card_count, "timeout": timeout_ms}
+    ))
+    idle = asyncio.create_task(network.wait_idle(idle_ms, settle_ms))
+    done, _ = await asyncio.wait({grow, idle}, return_when=asyncio.FIRST_COMPLETED)
+    idle.cancel()
+    if grow in done:
+        return {**grow.result(), "signal": "cards" if grow.result()["grew"] else "timeout"}
+    # The in-page wait keeps running until its own timeout; its result is no longer needed
+    grow.add_done_callback(lambda task: task.exception())
+    return {"grew": False, "elapsed_ms": round((loop.time() - started) * 1000), "signal": "network_idle"}
+
+def query_name(params: dict) -> str:
+    return re.sub(r"\W+", "_", f"{params.get('q', '')}_{params.get('country', '')}").strip("_").lower()
+
+def build_query_specs(config: dict) -> List[Dict[str, Any]]:
+    """
+    Expands `queries` into full query specs, each entry overriding the `ad_library` defaults.
+    Without `queries`, the single `ad_library` query is used as before.
+    """
+    base_params = config["ad_library"]
+    max_ads = config["scraper"]["max_ads"]
+    queries = config.get("queries")
+    if not queries:
+        return [{"name": None, "params": base_params, "max_ads": max_ads}]
+
+    specs = []
+    for query in queries:
+        query = dict(query)
+        spec_max_ads = query.pop("max_ads", max_ads)
+        name = query.pop("name", None)
+        params = {**base_params, **query}
+        specs.append({"name": name or query_name(params), "params": params, "max_ads": spec_max_ads})
+    return specs
+
+def query_output_path(config: dict, base_dir: str, spec: dict) -> str:
+    if spec["name"] and config["paths"].get("per_query_output"):
+        return os.path.join(base_dir, f"{spec['name']}.jsonl")
+    return os.path.join(base_dir, config["paths"]["output_file"])
+
+def capture_records(results: List[Dict[str, Any]], spec: dict) -> List[Dict[str, Any]]:
+    """Raw card HTML kept for offline re-parsing with `main.py --parse-captured`."""
+    scraped_at = datetime.now(timezone.utc).isoformat()
+    records = []
+    for result in results:
+        record = {"outer_html": result.get("outer_html"), "scraped_at": scraped_at}
+        if spec["name"]:
+            record["query"] = spec["name"]
+        records.append(record)
+    return records
+
+AdSink = Callable[[Dict[str, Any]], Awaitable[None]]
+
+async def scrape_query(context: BrowserContext, config: dict, spec: dict, sink: Optional[AdSink] = None) -> int:
+    """
+    Scrolls through the Ad Library results for one query spec, appending parsed ads to its output.
+    Every parsed ad is also awaited into `sink`, so a slow consumer holds back scrolling.
+    Returns the number of ads written.
+    """
     scraper_cfg = config["scraper"]
-    output_path = os.path.join(
-        config["paths"]["parsed_ads_dir"],
-        config["paths"]["output_file"]
-    )
+    output_path = query_output_path(config, config["paths"]["parsed_ads_dir"], spec)
     ensure_output_file(output_path)
-    quarantine_path = os.path.join(
-        config["paths"]["quarantine_dir"],
-        config["paths"]["output_file"]
-    )
-    ensure_output_file(quarantine_path)
-
-    headless = scraper_cfg["headless"]
-    max_ads = scraper_cfg["max_ads"]
+    writer = open_ads_writer(output_path, get_storage_format(config), "parsed", config=config)
+    capture_html = scraper_cfg.get("capture_html", False)
+    capture_writer = JsonlWriter(
+        query_output_path(config, config["paths"].get("captured_dir", "data/captured"), spec),
+        **jsonl_writer_options(config, rotate=True)
+    ) if capture_html else None
+    quarantine_path = query_output_path(config, config["paths"]["quarantine_dir"], spec)
+    quarantine_writer = JsonlWriter(quarantine_path, **jsonl_writer_options(config, rotate=True))
+
+    max_ads = spec["max_ads"]
     max_scroll_tries = scraper_cfg["max_scroll_tries"]
     scroll_timeout = scraper_cfg["scroll_timeout_ms"]
     batch_size = scraper_cfg["batch_size"]
+    extraction = scraper_cfg.get("extraction", "handles")
+    adaptive_wait = scraper_cfg.get("adaptive_wait", False)
+    min_wait = scraper_cfg.get("scroll_min_wait_ms", 250)
+    network_idle_ms = scraper_cfg.get("network_idle_ms", 500)
+    # "tag" marks parsed cards and only ever queries unmarked ones, "index" re-queries all cards
+    track_by_tag = scraper_cfg.get("card_tracking", "index") == "tag"
+    detach = track_by_tag and scraper_cfg.get("detach_processed", False)
+    card_selector = UNSEEN_AD_CARD_SELECTOR if track_by_tag else AD_CARD_SELECTOR
+    mark_attribute = SEEN_CARD_ATTRIBUTE if track_by_tag else None
+    label = spec["name"] or "ad_library"
 
     ads, output_count, prev_count, tries = [], 0, 0, 0
+    settle_ms, scroll_count = min_wait, 0
 
-    async with async_playwright() as p:
-        browser = await p.chromium.launch(channel="chrome", headless=headless)
-        context = await browser.new_context()
-        page = await context.new_page()
-        
-        await page.goto(build_ad_library_url(ad_params))
+    page = await context.new_page()
+    network = NetworkActivity(page)
+    try:
+        with metrics.timer("scraper_page_load_seconds", query=label):
+            await page.goto(build_ad_library_url(spec["params"], scraper_cfg.get("base_url")))
 
         while output_count < max_ads and tries < max_scroll_tries:
-            ad_cards = await page.query_selector_all(AD_CARD_SELECTOR)
-            new_cards = ad_cards[prev_count:]
+            with metrics.timer("scraper_extract_seconds", query=label):
+                if extraction == "in_page":
+                    card_count, results = await parse_ads_in_page(
+                        page, card_selector, prev_count, mark_attribute, detach, capture_html
+                    )
+                else:
+                    metrics.inc("parser_rpcs_total")
+                    ad_cards = await page.query_selector_all(card_selector)
+                    card_count = len(ad_cards)
+                    results = await parse_ad_handles(ad_cards[prev_count:], capture_html)
+                    if track_by_tag:
+                        await release_ad_handles(page, ad_cards, mark_attribute, detach)
+            metrics.inc("scraper_cards_total", len(results), query=label)
 
-            if not new_cards:
+            if not results:
                 tries += 1
-                shared_logger.info(f"No new ads found. Try {tries}")
+                shared_logger.info(f"[{label}] No new ads found. Try {tries}")
             else:
                 tries = 0
 
-            for ad_el in new_cards:
-                try:
-                    ad = await parse_ad(ad_el)
-                    ad["scraped_at"] = datetime.now(timezone.utc).isoformat()
-                    ads.append(ad)
-                    if len(ads) >= batch_size:
-                        shared_logger.info(f"Writing {len(ads)} ads to file")
-                        write_batch_to_file(output_path, ads)
-                        output_count += len(ads)
-                        ads.clear()
-                    if output_count >= max_ads:
-                        break
-                except Exception as e:
-                    shared_logger.error(f"Skipped ad due to error: {e}")
+            if capture_writer:
+                capture_writer.write(capture_records(results, spec))
+
+            for result in results:
+                if "error" in result:
+                    shared_logger.error(f"[{label}] Skipped ad due to error: {result['error']}")
+                    metrics.inc("scraper_quarantined_total", query=label)
                     try:
-                        ad_html = await ad_el.inner_html()
                         quarantine_record = {
-                            "error": str(e),
-                            "html": ad_html,
+                            "error": result["error"],
+                            "html": result["html"],
                             "scraped_at": datetime.now(timezone.utc).isoformat(),
                         }
-                        write_batch_to_file(quarantine_path, [quarantine_record])
+                        quarantine_writer.write([quarantine_record])
                     except Exception as inner_e:
-                        shared_logger.error(f"Failed to write to quarantine: {inner_e}")
-            
-            prev_count = len(ad_cards)
+                        shared_logger.error(f"[{label}] Failed to write to quarantine: {inner_e}")
+                    continue
+
+                ad = result["ad"]
+                ad["scraped_at"] = datetime.now(timezone.utc).isoformat()
+                if spec["name"]:
+                    ad["query"] = spec["name"]
+                ads.append(ad)
+                metrics.inc("scraper_ads_total", query=label)
+                if sink:
+                    await sink(ad)
+                if len(ads) >= batch_size:
+                    shared_logger.info(f"[{label}] Writing {len(ads)} ads to file")
+                    writer.write(ads)
+                    output_count += len(ads)
+                    ads.clear()
+                if output_count >= max_ads:
+                    break
+
+            # Tagged cards drop out of the selector, so every query starts from the first unseen card
+            prev_count = 0 if track_by_tag else card_count
             await page.evaluate("window.scrollBy(0, document.body.scrollHeight)")
-            await page.wait_for_timeout(scroll_timeout)
-        
+            scroll_count += 1
+            if not adaptive_wait:
+                with metrics.timer("scraper_scroll_wait_seconds", query=label):
+                    await page.wait_for_timeout(scroll_timeout)
+                continue
+
+            with metrics.timer("scraper_scroll_wait_seconds", query=label):
+                waited = await wait_for_new_cards(
+                    page, network, card_selector, prev_count, scroll_timeout, settle_ms, network_idle_ms
+                )
+            shared_logger.info(
+                f"[{label}] Scroll {scroll_count}: {waited['signal']} after {waited['elapsed_ms']} ms "
+                f"(settle {settle_ms} ms)"
+            )
+            # Back off only while nothing changes; new cards reset the wait
+            settle_ms = min_wait if waited["grew"] else min(settle_ms * 2, scroll_timeout)
+
         if ads:
-            write_batch_to_file(output_path, ads)
+            writer.write(ads)
+            output_count += len(ads)
+    finally:
+        writer.close()
+        quarantine_writer.close()
+        if capture_writer:
+            capture_writer.close()
+        await page.close()
+
+    shared_logger.info(f"[{label}] Finished with {output_count} ads. Output: {output_path}")
+    return output_count
+
+async def run_query(contexts: asyncio.Queue, config: dict, spec: dict, sink: Optional[AdSink] = None) -> int:
+    """
+    Runs one query on a context borrowed from the pool, retrying with exponential backoff.
+    A retried query may append ads it already wrote; incremental transform skips those.
+    """
+    scraper_cfg = config["scraper"]
+    max_retries = scraper_cfg.get("max_retries", 0)
+    backoff_s = scraper_cfg.get("retry_backoff_s", 5)
+    label = spec["name"] or "ad_library"
+
+    for attempt in range(max_retries + 1):
+        context = await contexts.get()
+        try:
+            return await scrape_query(context, config, spec, sink)
+        except Exception as e:
+            if attempt == max_retries:
+                shared_logger.error(f"[{label}] Giving up after {attempt + 1} attempts: {e}")
+                raise
+            delay = backoff_s * 2 ** attempt
+            metrics.inc("scraper_retries_total", query=label)
+            shared_logger.warning(f"[{label}] Attempt {attempt + 1} failed: {e}. Retrying in {delay}s")
+        finally:
+            contexts.put_nowait(context)
+        await asyncio.sleep(delay)
+
+async def scrape_ads(config: dict, sink: Optional[AdSink] = None):
+    scraper_cfg = config["scraper"]
+    specs = build_query_specs(config)
+    concurrency = max(1, min(scraper_cfg.get("concurrency", 1), len(specs)))
+
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(channel=scraper_cfg.get("channel", "chrome"), headless=scraper_cfg["headless"])
+        blocking_cfg = scraper_cfg.get("resource_blocking") or {}
+        blocker = ResourceBlocker(blocking_cfg) if blocking_cfg.get("enabled") else None
+        contexts = asyncio.Queue()
+        for _ in range(concurrency):
+            context = await browser.new_context()
+            if blocker:
+                await blocker.install(context)
+            contexts.put_nowait(context)
+
+        shared_logger.info(f"Scraping {len(specs)} queries with {concurrency} concurrent contexts")
+        results = await asyncio.gather(
+            *(run_query(contexts, config, spec, sink) for spec in specs),
+            return_exceptions=True
+        )
         await browser.close()
-        shared_logger.info(f"Finished. Output: {output_path}")
+
+    if blocker:
+        blocker.log_stats()
+    failed = [spec["name"] or "ad_library" for spec, result in zip(specs, results) if isinstance(result, Exception)]
+    total = sum(result for result in results if not isinstance(result, Exception))
+    shared_logger.info(f"Finished. {total} ads from {len(specs) - len(failed)}/{len(specs)} queries")
+    if failed and len(failed) == len(specs):
+        raise RuntimeError(f"All queries failed after retries: {failed}")
+    if failed:
+        shared_logger.error(f"Queries failed after retries: {failed}")
@@ -0,0 +1,329 @@
+import asyncio
+import copy
+import json
+import os
+import re
+import time
+
+from collections import Counter
+from typing import Any, Dict, Iterator, List, Optional
+
+from src.job_queue import Heartbeat, Job, JobQueue, JobSpec, default_worker_id
+from src.logger import shared_logger
+from src.metrics import metrics
+from src.storage import (
+    JsonlWriter,
+    dataset_dir,
+    get_storage_format,
+    iter_dataset_records,
+    jsonl_writer_options,
+    open_ads_writer
+)
+from src.utils import ensure_output_file
+
+
+def jobs_options(config: dict) -> Dict[str, Any]:
+    jobs_cfg = config.get("jobs") or {}
+    return {
+        "queue_path": jobs_cfg.get("queue_path", "data/jobs/queue.sqlite"),
+        "shards_dir": jobs_cfg.get("shards_dir", "data/jobs/shards"),
+        "lease_s": jobs_cfg.get("lease_s", 120),
+        "heartbeat_s": jobs_cfg.get("heartbeat_s", 30),
+        "max_attempts": jobs_cfg.get("max_attempts", 3),
+        "retry_backoff_s": jobs_cfg.get("retry_backoff_s", 10),
+        "transform_chunk_lines": jobs_cfg.get("transform_chunk_lines", 5000),
+        "poll_s": jobs_cfg.get("poll_s", 2),
+    }
+
+def open_queue(config: dict) -> JobQueue:
+    options = jobs_options(config)
+    return JobQueue(options["queue_path"], options["lease_s"], options["retry_backoff_s"])
+
+def shard_path(config: dict, kind: str, key: str, attempt: Optional[int] = None) -> str:
+    name = re.sub(r"[^\w.-]+", "_", key) + (f".a{attempt}" if attempt else "")
+    return os.path.join(jobs_options(config)["shards_dir"], kind, name + ".jsonl")
+
+def main_path(config: dict, kind: str) -> str:
+    base_dir = config["paths"]["parsed_ads_dir" if kind == "parsed" else "transformed_ads_dir"]
+    return os.path.join(base_dir, config["paths"]["output_file"])
+
+
+# Enqueueing
+
+def enqueue_scrape_jobs(config: dict, queue: JobQueue) -> int:
+    """One job per query spec; each scrapes into its own parsed shard."""
+    from src.scraper import build_query_specs
+    added = 0
+    for spec in build_query_specs(config):
+        added += queue.enqueue(
+            "scrape", f"scrape:{spec['name'] or 'ad_library'}", {"spec": spec}, jobs_options(config)["max_attempts"]
+        )
+    return added
+
+def line_ranges(path: str, lines_per_range: int) -> Iterator[tuple]:
+    """Byte ranges of `lines_per_range` complete lines each."""
+    start = offset = count = 0
+    with open(path, "rb") as f:
+        for raw in f:
+            if not raw.endswith(b"\n"):
+                break
+            offset += len(raw)
+            count += 1
+            if count == lines_per_range:
+                yield start, offset
+                start, count = offset, 0
+    if count:
+        yield start, offset
+
+def transform_job_specs(config: dict, input_path: str) -> Iterator[JobSpec]:
+    """
+    One job per chunk of `jobs.transform_chunk_lines` lines of a parsed JSONL file.
+    Keys carry the file's size and mtime, so the byte ranges of changed contents never match old jobs.
+    """
+    options = jobs_options(config)
+    stat = os.stat(input_path)
+    version = f"{stat.st_size}-{stat.st_mtime_ns}"
+    for start, end in line_ranges(input_path, options["transform_chunk_lines"]):
+        yield (
+            "transform",
+            f"transform:{os.path.basename(input_path)}@{version}:{start}",
+            {"input_path": input_path, "start": start, "end": end},
+            options["max_attempts"]
+        )
+
+def enqueue_jobs(config: dict, kind: str) -> int:
+    """
+    `scrape` enqueues the query specs; their transform jobs follow as each scrape finishes.
+    `transform` enqueues chunks of the existing parsed file.
+    """
+    with open_queue(config) as queue:
+        if kind == "scrape":
+            added = enqueue_scrape_jobs(config, queue)
+        else:
+            added = queue.enqueue_many(transform_job_specs(config, main_path(config, "parsed")))
+    shared_logger.info(f"Enqueued {added} {kind} jobs")
+    return added
+
+
+# Running jobs
+
+def shard_config(config: dict, job: Job) -> dict:
+    """
+    The config with every scrape output redirected into files of the job's attempt; parsed ads
+    go to a tmp directory until the attempt finishes.
+    """
+    shards_dir = jobs_options(config)["shards_dir"]
+    spec = job.payload["spec"]
+    output_path = shard_path(config, "parsed", job.key, job.attempts)
+    job_config = copy.deepcopy(config)
+    job_config["queries"] = [{"name": spec["name"], "max_ads": spec["max_ads"], **spec["params"]}]
+    job_config["paths"].update({
+        "parsed_ads_dir": os.path.join(os.path.dirname(output_path), "tmp"),
+        "output_file": os.path.basename(output_path),
+        "per_query_output": False,
+        "storage_format": "jsonl",
+        "quarantine_dir": os.path.join(shards_dir, "quarantine"),
+        "captured_dir": os.path.join(shards_dir, "captured"),
+    })
+    job_config.setdefault("offset_index", {})["enabled"] = False
+    return job_config
+
+def run_scrape_job(config: dict, queue: JobQueue, job: Job) -> Dict[str, Any]:
+    """
+    Scrapes into a file of this attempt only and renames it when done, so a worker that lost its
+    lease and is still running never writes into the shard another attempt produced.
+    """
+    from src.scraper import scrape_ads
+    output_path = shard_path(config, "parsed", job.key, job.attempts)
+    job_config = shard_config(config, job)
+    tmp_path = main_path(job_config, "parsed")
+    ensure_output_file(tmp_path)
+    open(tmp_path, "w").close()
+    asyncio.run(scrape_ads(job_config))
+    os.replace(tmp_path, output_path)
+    return {"path": output_path}
+
+def run_transform_job(config: dict, queue: JobQueue, job: Job) -> Dict[str, Any]:
+    from src.transformer import iter_transformed
+    payload = job.payload
+    output_path = shard_path(config, "transformed", job.key)
+    ensure_output_file(output_path)
+    # Written under a per-attempt name and renamed when complete, so a shard is never half written
+    tmp_path = f"{output_path}.{job.attempts}.tmp"
+    errors = 0
+    with open(payload["input_path"], "rb") as f:
+        f.seek(payload["start"])
+        data = f.read(payload["end"] - payload["start"])
+    lines = data.decode("utf-8").splitlines(keepends=True)
+    with JsonlWriter(tmp_path, **jsonl_writer_options(config)) as writer:
+        for output_line, error, _ in iter_transformed(lines, config=config):
+            if error:
+                shared_logger.error(error)
+                errors += 1
+            else:
+                writer.write_lines([output_line])
+    os.replace(tmp_path, output_path)
+    return {"path": output_path, "input_path": payload["input_path"], "lines": len(lines), "errors": errors}
+
+JOB_HANDLERS = {"scrape": run_scrape_job, "transform": run_transform_job}
+
+def follow_up_jobs(config: dict, job: Job, output: Dict[str, Any]) -> List[JobSpec]:
+    """Jobs a finished job hands on, enqueued as it completes: a scrape shard's transform jobs."""
+    if job.kind == "scrape":
+        return list(transform_job_specs(config, output["path"]))
+    return []
+
+def run_worker(config: dict, worker: Optional[str] = None, exit_when_idle: bool = True) -> Counter:
+    """
+    Claims and runs jobs until the queue has nothing pending or running (or forever, without
+    `exit_when_idle`). Start as many as you like, on any machine that sees the same files.
+    """
+    from src.transformer import close_language_cache, configure_json_encoder, configure_language_cache
+    options = jobs_options(config)
+    worker = worker or default_worker_id()
+    counts = Counter()
+    configure_language_cache(config)
+    configure_json_encoder(config)
+    shared_logger.info(f"Worker {worker} polling {options['queue_path']}")
+    try:
+        with open_queue(config) as queue:
+            while True:
+                job = queue.claim(worker)
+                if job is None:
+                    queued = queue.counts()
+                    if exit_when_idle and not (queued["pending"] or queued["running"]):
+                        break
+                    time.sleep(options["poll_s"])
+                    continue
+                started = time.perf_counter()
+                with Heartbeat(queue, job, worker, options["heartbeat_s"]) as heartbeat:
+                    try:
+                        output = JOB_HANDLERS[job.kind](config, queue, job)
+                        error = None
+                    except Exception as e:
+                        shared_logger.exception(f"Job {job.key} failed")
+                        output, error = None, repr(e)
+                if heartbeat.lost:
+                    counts["lost"] += 1
+                    continue
+                if error:
+                    queue.fail(job, worker, error)
+                    metrics.inc("jobs_failed_total", kind=job.kind)
+                    counts["failed"] += 1
+                elif queue.complete(job, worker, output, follow_up_jobs(config, job, output)):
+                    metrics.inc("jobs_completed_total", kind=job.kind)
+                    metrics.observe("job_seconds", time.perf_counter() - started, kind=job.kind)
+                    counts["done"] += 1
+                else:
+                    counts["lost"] += 1
+    finally:
+        close_language_cache()
+    shared_logger.info(
+        f"Worker {worker} finished: {counts['done']} jobs done, {counts['failed']} failed, "
+        f"{counts['lost']} lost to expired leases"
+    )
+    return counts
+
+
+# Merging
+
+def iter_shard_records(paths: List[str]) -> Iterator[Dict[str, Any]]:
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+def iter_existing_records(config: dict, kind: str) -> Iterator[Dict[str, Any]]:
+    """The ads already in the configured parsed or transformed output, whatever its storage format."""
+    path = main_path(config, kind)
+    if get_storage_format(config) == "parquet":
+        yield from iter_dataset_records(dataset_dir(path), kind)
+    elif os.path.exists(path):
+        yield from iter_shard_records([path])
+
+def merge_shards(config: dict) -> Dict[str, int]:
+    """
+    Merges finished shards into the configured parsed and transformed outputs, in job order.
+    Shards are appended, skipping ads the output already has (by `library_id` and `ad_hash`, or the
+    raw ad hash for parsed ads), except transform shards of the parsed output itself (`jobs enqueue --kind transform`):
+    those cover every parsed ad and replace the transformed output. Schema validation, clustering
+    and aggregation of transformed ads run here, across all shards.
+    """
+    from src.aggregates import aggregates_from_config
+    from src.clustering import clusterer_from_config
+    from src.transformer import compute_raw_ad_hash, configure_json_encoder
+    from src.validation import validator_from_config
+    configure_json_encoder(config)
+    with open_queue(config) as queue:
+        queued = queue.counts()
+        if queued["pending"] or queued["running"]:
+            shared_logger.warning(f"Merging while jobs are unfinished: {queued}")
+        if queued["failed"]:
+            shared_logger.error(f"Failed jobs are left out of the merge: {[j['key'] for j in queue.jobs(state='failed')]}")
+        outputs = {kind: [job["output"] for job in queue.jobs(kind=kind, state="done")] for kind in ("scrape", "transform")}
+
+    parsed_path = os.path.abspath(main_path(config, "parsed"))
+    replace_transformed = any(
+        os.path.abspath(output.get("input_path", "")) == parsed_path for output in outputs["transform"]
+    )
+    storage_format = get_storage_format(config)
+    merged = {}
+    for kind, jobs_kind, dedupe_key in (
+        ("parsed", "scrape", lambda record: (record.get("library_id"), compute_raw_ad_hash(record))),
+        ("transformed", "transform", lambda record: (record["library_id"], record["ad_hash"])),
+    ):
+        paths = [output["path"] for output in outputs[jobs_kind]]
+        if not paths:
+            continue
+        replace = kind == "transformed" and replace_transformed
+        clusterer = clusterer_from_config(config) if kind == "transformed" else None
+        aggregates = aggregates_from_config(config) if kind == "transformed" else None
+        validator = validator_from_config(config) if kind == "transformed" else None
+        seen, written, duplicates = set(), 0, 0
+        if replace:
+            if aggregates is not None:
+                aggregates.reset()
+        else:
+            for record in iter_existing_records(config, kind):
+                seen.add(dedupe_key(record))
+                if clusterer is not None:
+                    clusterer.add_existing(record)
+                # A no-op for ads already counted; fills in a store that was just enabled
+                if aggregates is not None:
+                    aggregates.add(record)
+        # Parquet writers are not context managers
+        writer = open_ads_writer(main_path(config, kind), storage_format, kind, truncate=replace, config=config)
+        try:
+            for record in iter_shard_records(paths):
+                key = dedupe_key(record)
+                if key in seen:
+                    duplicates += 1
+                    continue
+                seen.add(key)
+                if validator is not None and validator.check(record):
+                    continue
+                if clusterer is not None:
+                    record["creative_cluster_id"] = clusterer.assign(record)
+                if aggregates is not None:
+                    aggregates.add(record)
+                writer.write([record])
+                written += 1
+        finally:
+            writer.close()
+            if aggregates is not None:
+                aggregates.close()
+            if validator is not None:
+                validator.close()
+                validator.log_stats()
+        shared_logger.info(
+            f"Merged {len(paths)} {kind} shards into {main_path(config, kind)} "
+            f"({'replaced' if replace else 'appended'}): {written} ads, {duplicates} duplicates dropped"
+        )
+        merged[kind] = written
+    return merged
+
+def log_queue_status(config: dict):
+    with open_queue(config) as queue:
+        for job in queue.jobs(state="failed"):
+            shared_logger.error(f"Failed job {job['key']} after {job['attempts']} attempts: {job['error']}")
+        shared_logger.info(f"Jobs in {queue.path}: {queue.counts()}")
@@ -0,0 +1,526 @@
+import atexit
+import json
+import os
+import shutil
+import time
+import uuid
+import weakref
+
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import date, datetime, timezone
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from src.logger import shared_logger
+from src.metrics import metrics
+from src.offset_index import OffsetIndex, index_keys
+from src.utils import ensure_output_file
+
+try:
+    import fcntl
+except ImportError:
+    # No flock (Windows): concurrent writers to one indexed file are not coordinated
+    fcntl = None
+
+
+SCHEMA_PATH = os.path.join(os.path.dirname(__file__), "schema", "ad_scheama.json")
+
+# Low-cardinality string columns stored dictionary-encoded
+DICTIONARY_FIELDS = ("advertiser_name", "media_mix", "language")
+
+PARTITION_FIELD = "scrape_date"
+
+# Parsed ads leave these keys out instead of writing null; export restores that shape
+OPTIONAL_PARSED_FIELDS = ("call_to_actions", "query")
+
+JSON_CODECS = ("json", "auto", "orjson", "msgspec")
+
+FSYNC_POLICIES = ("never", "flush", "close")
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("The parquet storage format needs pyarrow: pip install pyarrow") from e
+    return pyarrow
+
+def get_storage_format(config: dict) -> str:
+    storage_format = config["paths"].get("storage_format", "jsonl")
+    if storage_format not in ("jsonl", "parquet"):
+        raise ValueError(f"Unknown storage_format: {storage_format}")
+    return storage_format
+
+def dataset_dir(jsonl_path: str) -> str:
+    """The parquet dataset that stands in for a JSONL path: `data/parsed/x.jsonl` -> `data/parsed/x/`."""
+    return os.path.splitext(jsonl_path)[0]
+
+def load_ad_schema() -> dict:
+    with open(SCHEMA_PATH, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def _arrow_type(pa, prop: dict):
+    types = prop["type"] if isinstance(prop["type"], list) else [prop["type"]]
+    (base,) = [t for t in types if t != "null"]
+    if base == "string":
+        return pa.date32() if prop.get("format") == "date" else pa.string()
+    if base == "number":
+        return pa.float64()
+    if base == "integer":
+        return pa.int64()
+    if base == "boolean":
+        return pa.bool_()
+    if base == "array":
+        return pa.list_(_arrow_type(pa, prop["items"]))
+    raise ValueError(f"Unsupported JSON schema type: {base}")
+
+def transformed_ads_schema():
+    """Arrow schema derived from ad_scheama.json."""
+    pa = import_pyarrow()
+    json_schema = load_ad_schema()
+    required = set(json_schema.get("required", []))
+    fields = []
+    for name, prop in json_schema["properties"].items():
+        types = prop["type"] if isinstance(prop["type"], list) else [prop["type"]]
+        arrow_type = _arrow_type(pa, prop)
+        if name in DICTIONARY_FIELDS:
+            arrow_type = pa.dictionary(pa.int32(), arrow_type)
+        fields.append(pa.field(name, arrow_type, nullable="null" in types or name not in required))
+    return pa.schema(fields)
+
+def parsed_ads_schema():
+    pa = import_pyarrow()
+    texts = pa.list_(pa.string())
+    media = pa.struct([("images", texts), ("videos", texts)])
+    return pa.schema([
+        ("status_name", pa.string()),
+        ("library_id", pa.string()),
+        ("run_dates", pa.string()),
+        ("advertiser_name", pa.dictionary(pa.int32(), pa.string())),
+        ("ad_text", pa.string()),
+        ("ad_redirect", pa.string()),
+        ("call_to_action_texts", texts),
+        ("media", media),
+        ("call_to_actions", pa.list_(pa.struct([
+            ("ad_redirect", pa.string()),
+            ("call_to_action_texts", texts),
+            ("media", media),
+        ]))),
+        ("scraped_at", pa.string()),
+        ("query", pa.string()),
+    ])
+
+def scrape_date(record: Dict[str, Any]) -> str:
+    scraped_at = record.get("scraped_at")
+    return scraped_at[:10] if scraped_at else "unknown"
+
+
+class ParquetDatasetWriter:
+    """
+    Writes ads into a parquet dataset partitioned by scrape date (`scrape_date=YYYY-MM-DD/`).
+    Each run keeps one file open per partition and appends a row group every `row_group_size` rows,
+    so files are only readable once `close` has written their footer.
+    """
+
+    def __init__(self, base_dir: str, schema, row_group_size: int = 10000):
+        self._pa = import_pyarrow()
+        self.base_dir = base_dir
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self._date_fields = [f.name for f in schema if f.type == self._pa.date32()]
+        self._buffers: Dict[str, List[dict]] = defaultdict(list)
+        self._writers = {}
+        self._run_id = f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+
+    def write(self, records: Iterable[Dict[str, Any]]):
+        for record in records:
+            partition = scrape_date(record)
+            if self._date_fields:
+                record = {
+                    **record,
+                    **{k: date.fromisoformat(record[k]) for k in self._date_fields if record.get(k)}
+                }
+            buffer = self._buffers[partition]
+            buffer.append(record)
+            if len(buffer) >= self.row_group_size:
+                self._flush_partition(partition)
+
+    def _flush_partition(self, partition: str):
+        rows = self._buffers[partition]
+        if not rows:
+            return
+        writer = self._writers.get(partition)
+        if writer is None:
+            path = os.path.join(self.base_dir, f"{PARTITION_FIELD}={partition}", f"part-{self._run_id}.parquet")
+            ensure_output_file(path)
+            writer = self._pa.parquet.ParquetWriter(path, self.schema)
+            self._writers[partition] = writer
+        writer.write_table(self._pa.Table.from_pylist(rows, schema=self.schema))
+        rows.clear()
+
+    def flush(self):
+        for partition in list(self._buffers):
+            self._flush_partition(partition)
+
+    def close(self):
+        self.flush()
+        for writer in self._writers.values():
+            writer.close()
+            metrics.inc("bytes_written_total", os.path.getsize(writer.where), path=self.base_dir)
+        self._writers.clear()
+
+
+def _load_fast_codec(name: str) -> Optional[Callable[[Any], bytes]]:
+    try:
+        if name == "orjson":
+            import orjson
+            return orjson.dumps
+        import msgspec
+        return msgspec.json.Encoder().encode
+    except ImportError:
+        return None
+
+def _fast_codec_safe(value: Any) -> bool:
+    """
+    False for values orjson/msgspec would spell differently from json.dumps: floats json.dumps
+    writes in exponent form (1e-05, 1e+16), NaN and infinities.
+    """
+    if isinstance(value, float):
+        return value == 0 or 1e-4 <= abs(value) < 1e16
+    if isinstance(value, dict):
+        return all(_fast_codec_safe(v) for v in value.values())
+    if isinstance(value, list):
+        return all(_fast_codec_safe(v) for v in value)
+    return True
+
+def make_json_encoder(codec: str = "json", compact: bool = False) -> Callable[[Any], bytes]:
+    """
+    Returns a record -> UTF-8 bytes encoder. Whatever the codec, output is byte-identical to
+    `json.dumps(record, ensure_ascii=False)` with the chosen separators: records a fast codec
+    would spell differently, or cannot encode, go through the standard library.
+    Fast codecs only write compact JSON, so they need `compact`.
+    """
+    if codec not in JSON_CODECS:
+        raise ValueError(f"Unknown JSON codec: {codec}")
+    separators = (",", ":") if compact else None
+
+    def encode_stdlib(record: Any) -> bytes:
+        return json.dumps(record, ensure_ascii=False, separators=separators).encode("utf-8")
+
+    if codec == "json":
+        return encode_stdlib
+    if not compact:
+        shared_logger.warning(f"The {codec} codec needs compact JSON; writing with json instead")
+        return encode_stdlib
+    for name in (("orjson", "msgspec") if codec == "auto" else (codec,)):
+        fast = _load_fast_codec(name)
+        if fast:
+            break
+    else:
+        if codec != "auto":
+            shared_logger.warning(f"{codec} is not installed; writing with json instead")
+        return encode_stdlib
+
+    def encode(record: Any) -> bytes:
+        if _fast_codec_safe(record):
+            try:
+                return fast(record)
+            except Exception:
+                pass
+        return encode_stdlib(record)
+    return encode
+
+
+@contextmanager
+def locked(f):
+    """Exclusive advisory lock on an open file, where the platform has flock."""
+    if fcntl is None:
+        yield
+        return
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+# Writers still open at interpreter exit get flushed and closed there
+_open_writers = weakref.WeakSet()
+
+@atexit.register
+def _close_open_writers():
+    for writer in list(_open_writers):
+        try:
+            writer.close()
+        except Exception as e:
+            shared_logger.error(f"Failed to close {writer.path} at exit: {e}")
+
+
+class JsonlWriter:
+    """
+    Long-lived JSONL appender that keeps its file open for the whole run.
+    Encoded lines collect in memory and go out in one write once `buffer_bytes` are buffered,
+    or on the first write after `flush_interval_s`; only whole lines ever reach the file.
+    `fsync` is "never", "flush" (after every flush) or "close".
+    With `rotate_bytes` or `rotate_interval_s` set, a flushed file that grew past either limit is
+    renamed to `<name>.<UTC timestamp>.jsonl` and a fresh file takes its place.
+    With `index_kind` ("parsed" or "transformed"), every flushed line is added to the file's
+    OffsetIndex, which is committed right after the data.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        buffer_bytes: int = 1 << 20,
+        flush_interval_s: float = 5.0,
+        fsync: str = "close",
+        codec: str = "json",
+        compact: bool = False,
+        rotate_bytes: int = 0,
+        rotate_interval_s: float = 0,
+        index_kind: Optional[str] = None
+    ):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        if index_kind and (rotate_bytes or rotate_interval_s):
+            raise ValueError("An indexed JSONL file cannot be rotated")
+        ensure_output_file(path)
+        self.path = path
+        self.buffer_bytes = buffer_bytes
+        self.flush_interval_s = flush_interval_s
+        self.fsync = fsync
+        self.rotate_bytes = rotate_bytes
+        self.rotate_interval_s = rotate_interval_s
+        self.closed = False
+        self._encode = make_json_encoder(codec, compact)
+        self._buffer: List[bytes] = []
+        self._buffered = 0
+        # Created before the index looks at it
+        self._file = open(path, "ab")
+        self._size = self._file.tell()
+        self.index_kind = index_kind
+        self._index = None
+        self._index_keys = []
+        if index_kind:
+            self._index = OffsetIndex(path, index_kind)
+            # Catches up with anything appended, or rewritten, without the index
+            self._index.refresh()
+        self._opened_at = self._last_flush = time.monotonic()
+        _open_writers.add(self)
+
+    def write(self, records: Iterable[Dict[str, Any]]):
+        encode = self._encode
+        records = list(records)
+        if self._index:
+            self._index_keys.extend(index_keys(record, self.index_kind) for record in records)
+        self._append([encode(record) + b"\n" for record in records])
+
+    def write_lines(self, lines: Iterable[str]):
+        """Appends already serialized lines, each ending in a newline."""
+        lines = list(lines)
+        if self._index:
+            self._index_keys.extend(index_keys(json.loads(line), self.index_kind) for line in lines)
+        self._append([line.encode("utf-8") for line in lines])
+
+    def _append(self, data: List[bytes]):
+        self._buffer.extend(data)
+        self._buffered += sum(map(len, data))
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if self._buffered >= self.buffer_bytes or time.monotonic() - self._last_flush >= self.flush_interval_s:
+            self.flush()
+
+    def flush(self):
+        if self._index:
+            self._flush_indexed()
+        else:
+            if self._buffer:
+                self._write_buffer()
+            self._file.flush()
+            if self.fsync == "flush":
+                os.fsync(self._file.fileno())
+        self._last_flush = time.monotonic()
+        if self._should_rotate():
+            self._rotate()
+
+    def _write_buffer(self):
+        data = b"".join(self._buffer)
+        self._file.write(data)
+        self._size += len(data)
+        self._buffer.clear()
+        self._buffered = 0
+        metrics.inc("bytes_written_total", len(data), path=self.path)
+
+    def _flush_indexed(self):
+        """
+        Other writers may append to the same file (concurrent queries, other processes), so the
+        offsets come from the file's actual size, taken under a lock together with the index update.
+        """
+        with locked(self._file):
+            # Picks up the index as other writers left it, and any lines appended without it
+            self._index.refresh()
+            self._size = os.fstat(self._file.fileno()).st_size
+            offset = self._size
+            for line, keys in zip(self._buffer, self._index_keys):
+                self._index.add(keys, offset)
+                offset += len(line)
+            self._index_keys.clear()
+            if self._buffer:
+                self._write_buffer()
+            self._file.flush()
+            if self.fsync == "flush":
+                os.fsync(self._file.fileno())
+            self._index.commit(self._size)
+
+    def _should_rotate(self) -> bool:
+        if not self._size:
+            return False
+        return bool(
+            (self.rotate_bytes and self._size >= self.rotate_bytes) or
+            (self.rotate_interval_s and time.monotonic() - self._opened_at >= self.rotate_interval_s)
+        )
+
+    def _rotate(self):
+        if self.fsync != "never":
+            os.fsync(self._file.fileno())
+        self._file.close()
+        stem, ext = os.path.splitext(self.path)
+        rotated = f"{stem}.{datetime.now(timezone.utc):%Y%m%dT%H%M%S}{ext}"
+        suffix = 1
+        while os.path.exists(rotated):
+            rotated = f"{stem}.{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{suffix}{ext}"
+            suffix += 1
+        os.replace(self.path, rotated)
+        shared_logger.info(f"Rotated {self.path} to {rotated}")
+        self._file = open(self.path, "ab")
+        self._size = 0
+        self._opened_at = time.monotonic()
+
+    def close(self):
+        """Flushes, fsyncs unless the policy is "never", and closes. Safe to call more than once."""
+        if self.closed:
+            return
+        try:
+            self.flush()
+            if self.fsync != "never":
+                os.fsync(self._file.fileno())
+        finally:
+            self._file.close()
+            if self._index:
+                self._index.close()
+            self.closed = True
+            _open_writers.discard(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def index_enabled(config: Optional[dict]) -> bool:
+    return bool(((config or {}).get("offset_index") or {}).get("enabled"))
+
+def jsonl_writer_options(config: Optional[dict], rotate: bool = False) -> Dict[str, Any]:
+    """
+    JsonlWriter arguments from the `writer` section of config.yaml.
+    Only quarantine and captured-HTML writers `rotate`: the transform reads a single parsed file.
+    """
+    writer_cfg = (config or {}).get("writer") or {}
+    options = {
+        "buffer_bytes": writer_cfg.get("buffer_bytes", 1 << 20),
+        "flush_interval_s": writer_cfg.get("flush_interval_s", 5.0),
+        "fsync": writer_cfg.get("fsync", "close"),
+        "codec": writer_cfg.get("codec", "json"),
+        "compact": writer_cfg.get("compact", False),
+    }
+    if rotate:
+        options["rotate_bytes"] = writer_cfg.get("rotate_bytes", 0)
+        options["rotate_interval_s"] = writer_cfg.get("rotate_interval_s", 0)
+    return options
+
+def open_ads_writer(
+    jsonl_path: str,
+    storage_format: str,
+    kind: str,
+    truncate: bool = False,
+    config: Optional[dict] = None
+):
+    """
+    Returns a writer for parsed or transformed ads (`kind`) in the configured format.
+    `truncate` starts the output from scratch, as a full transform does.
+    JSONL writers take their buffering options from `config`.
+    """
+    if storage_format == "parquet":
+        base_dir = dataset_dir(jsonl_path)
+        if truncate and os.path.isdir(base_dir):
+            shutil.rmtree(base_dir)
+        schema = parsed_ads_schema() if kind == "parsed" else transformed_ads_schema()
+        return ParquetDatasetWriter(base_dir, schema)
+    if truncate:
+        ensure_output_file(jsonl_path)
+        open(jsonl_path, "w").close()
+    index_kind = kind if index_enabled(config) else None
+    return JsonlWriter(jsonl_path, index_kind=index_kind, **jsonl_writer_options(config))
+
+def open_dataset(base_dir: str):
+    pa = import_pyarrow()
+    return pa.dataset.dataset(base_dir, format="parquet", partitioning="hive")
+
+def decode_dictionaries(table):
+    """Casts dictionary columns back to plain values so pandas sees strings, not categoricals."""
+    pa = import_pyarrow()
+    schema = pa.schema([
+        f.with_type(f.type.value_type) if pa.types.is_dictionary(f.type) else f
+        for f in table.schema
+    ])
+    return table.cast(schema)
+
+def read_columns(base_dir: str, columns: List[str]):
+    """Reads only `columns` of a parquet dataset into pandas."""
+    return decode_dictionaries(open_dataset(base_dir).to_table(columns=columns)).to_pandas()
+
+def iter_column_batches(base_dir: str, columns: List[str], batch_size: int) -> Iterator:
+    for batch in open_dataset(base_dir).to_batches(columns=columns, batch_size=batch_size):
+        if batch.num_rows:
+            pa = import_pyarrow()
+            yield decode_dictionaries(pa.Table.from_batches([batch])).to_pandas()
+
+def iter_dataset_records(base_dir: str, kind: str) -> Iterator[Dict[str, Any]]:
+    """Yields ads from a parquet dataset in the same shape they have in JSONL."""
+    if not os.path.isdir(base_dir):
+        return
+    dataset = open_dataset(base_dir)
+    columns = [name for name in dataset.schema.names if name != PARTITION_FIELD]
+    for batch in dataset.to_batches(columns=columns):
+        for record in batch.to_pylist():
+            for key, value in record.items():
+                if isinstance(value, date):
+                    record[key] = value.isoformat()
+            if kind == "parsed":
+                for key in OPTIONAL_PARSED_FIELDS:
+                    if record.get(key) is None:
+                        record.pop(key, None)
+            yield record
+
+def export_jsonl(jsonl_path: str, kind: str, batch_size: int = 10000, config: Optional[dict] = None) -> int:
+    """Writes the parquet dataset behind `jsonl_path` out to `jsonl_path` itself."""
+    count = 0
+    batch = []
+    with open_ads_writer(jsonl_path, "jsonl", kind, truncate=True, config=config) as writer:
+        for record in iter_dataset_records(dataset_dir(jsonl_path), kind):
+            batch.append(record)
+            if len(batch) >= batch_size:
+                writer.write(batch)
+                count += len(batch)
+                batch.clear()
+        writer.write(batch)
+        count += len(batch)
+    shared_logger.info(f"Exported {count} {kind} ads to {jsonl_path}")
+    return count
+
+def export_datasets(config: dict):
+    for kind, base_dir in (("parsed", config["paths"]["parsed_ads_dir"]), ("transformed", config["paths"]["transformed_ads_dir"])):
+        export_jsonl(os.path.join(base_dir, config["paths"]["output_file"]), kind, config=config)
@@ -0,0 +1,164 @@
+import asyncio
+import io
+import json
+import os
+import time
+import pandas as pd
+
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from src.ads_analysis import JSON_DTYPES, TopKScorer, cluster_column, get_score_weights
+from src.aggregates import aggregates_from_config
+from src.clustering import clusterer_from_config
+from src.logger import shared_logger
+from src.metrics import metrics
+from src.scraper import scrape_ads
+from src.storage import get_storage_format, open_ads_writer
+from src.transformer import (
+    finish_ad,
+    init_transform_worker,
+    log_language_cache_stats,
+    transform_chunk
+)
+from src.utils import ensure_output_file
+from src.validation import validator_from_config
+
+
+async def next_batch(queue: asyncio.Queue, batch_size: int) -> List[Optional[Dict[str, Any]]]:
+    """Waits for one ad, then takes whatever else is already queued, up to `batch_size`."""
+    batch = [await queue.get()]
+    while len(batch) < batch_size and batch[-1] is not None and not queue.empty():
+        batch.append(queue.get_nowait())
+    return batch
+
+async def run_streaming_pipeline(config: dict):
+    """
+    Runs scrape, transform and analysis concurrently.
+    Parsed ads flow through a bounded queue into normalize_ad on a process pool and then into
+    an online top-K scorer. The parsed, transformed and analysis files are still written, the
+    last one refreshed every `streaming.analysis_flush_s` seconds while the scrape runs.
+    A full queue blocks the scraper, so it never runs ahead of the slower stages.
+    """
+    stream_cfg = config.get("streaming") or {}
+    queue_size = stream_cfg.get("queue_size", 200)
+    batch_size = stream_cfg.get("batch_size", 20)
+    flush_s = stream_cfg.get("analysis_flush_s", 5)
+    workers = max(1, (config.get("transform") or {}).get("workers") or 1)
+    top_k = (config.get("analysis") or {}).get("top_k", 100)
+
+    transformed_path = os.path.join(
+        config["paths"]["transformed_ads_dir"],
+        config["paths"]["output_file"]
+    )
+    ensure_output_file(transformed_path)
+    analysis_path = config["paths"]["analysis_output"]
+    ensure_output_file(analysis_path)
+
+    queue = asyncio.Queue(maxsize=queue_size)
+    scorer = TopKScorer(top_k, get_score_weights(config), cluster_column(config))
+    clusterer = clusterer_from_config(config)
+    aggregates = aggregates_from_config(config)
+    validator = validator_from_config(config)
+    storage_format = get_storage_format(config)
+    seen = set()
+    cache_stats = Counter()
+    pending = deque()
+    started = time.monotonic()
+    last_flush = None
+
+    async def produce():
+        try:
+            await scrape_ads(config, sink=queue.put)
+        finally:
+            await queue.put(None)
+
+    def write_top_ads():
+        scorer.top_frame().to_json(analysis_path, orient="records", lines=True)
+
+    def handle(results, writer):
+        lines = []
+        for output_line, error, ad_checks in results:
+            if error:
+                shared_logger.error(error)
+                continue
+            # A retried query can hand over ads it already delivered
+            key = (ad_checks.library_id, ad_checks.ad_hash)
+            if key in seen:
+                continue
+            seen.add(key)
+            output_line, error = finish_ad(output_line, ad_checks, clusterer, aggregates, validator)
+            if error:
+                shared_logger.error(error)
+                continue
+            lines.append(output_line)
+        if lines:
+            if storage_format == "jsonl":
+                writer.write_lines(lines)
+            else:
+                writer.write([json.loads(line) for line in lines])
+            frame = pd.read_json(io.StringIO("".join(lines)), lines=True, dtype=JSON_DTYPES)
+            frame["run_duration_hours"] = pd.to_numeric(frame["run_duration_hours"], errors="coerce").astype(float)
+            scorer.add_frame(frame)
+
+    async def drain(writer, limit: int):
+        nonlocal last_flush
+        while len(pending) > limit:
+            results, chunk_stats, chunk_metrics = await pending.popleft()
+            cache_stats.update(chunk_stats)
+            metrics.merge(chunk_metrics)
+            handle(results, writer)
+            now = time.monotonic()
+            if scorer.seen and (last_flush is None or now - last_flush >= flush_s):
+                if last_flush is None:
+                    shared_logger.info(f"First top-{top_k} results after {now - started:.1f}s: {analysis_path}")
+                write_top_ads()
+                last_flush = now
+
+    producer = asyncio.create_task(produce())
+    loop = asyncio.get_running_loop()
+    writer = open_ads_writer(transformed_path, storage_format, "transformed", truncate=True, config=config)
+    if aggregates is not None:
+        aggregates.reset()
+    try:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_transform_worker,
+            # Always with checks: handle dedupes on their library_id and ad_hash
+            initargs=(config, True)
+        ) as executor:
+            done = False
+            while not done:
+                batch = await next_batch(queue, batch_size)
+                if batch[-1] is None:
+                    done = True
+                    batch.pop()
+                if batch:
+                    lines = [json.dumps(ad, ensure_ascii=False) for ad in batch]
+                    pending.append(loop.run_in_executor(executor, transform_chunk, lines))
+                # Keep at most one batch per worker in flight; waiting here is what fills the queue
+                await drain(writer, workers - 1)
+            await drain(writer, 0)
+    except BaseException:
+        producer.cancel()
+        raise
+    finally:
+        writer.close()
+        if aggregates is not None:
+            aggregates.close()
+        if validator is not None:
+            validator.close()
+    await producer
+
+    write_top_ads()
+    if cache_stats:
+        log_language_cache_stats(cache_stats)
+    if clusterer is not None:
+        clusterer.log_stats()
+    if validator is not None:
+        validator.log_stats()
+    shared_logger.info(
+        f"Streamed {scorer.seen} ads in {time.monotonic() - started:.1f}s. "
+        f"Transformed: {transformed_path}, analysis: {analysis_path}"
+    )
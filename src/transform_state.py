@@ -0,0 +1,138 @@
+import os
+import sqlite3
+
+from typing import Iterable, Optional, Set, Tuple
+
+from src.utils import ensure_output_file
+
+
+class TransformState:
+    """
+    Checkpoint and upsert index for incremental transforms.
+    Tracks how far into the parsed file we have read, which `ad_hash` each `library_id`
+    was last written with, and where that line lives in the transformed file.
+    Lines superseded by an upsert are recorded as stale until the run compacts them out of the
+    transformed file.
+    """
+
+    def __init__(self, path: str):
+        ensure_output_file(path)
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS checkpoint ("
+            "  id INTEGER PRIMARY KEY CHECK (id = 0),"
+            "  input_path TEXT NOT NULL, input_inode INTEGER NOT NULL,"
+            "  input_offset INTEGER NOT NULL, output_size INTEGER NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS ads ("
+            "  library_id TEXT PRIMARY KEY, ad_hash TEXT NOT NULL, output_offset INTEGER NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS ads_offset ON ads (output_offset);"
+        )
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(stale)")]
+        if columns and "ad_hash" not in columns:
+            # From before stale lines were kept between runs; any left were from an interrupted run
+            if self._conn.execute("SELECT 1 FROM stale LIMIT 1").fetchone():
+                self._conn.executescript("DELETE FROM checkpoint; DELETE FROM ads;")
+            self._conn.execute("DROP TABLE stale")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS stale ("
+            "  output_offset INTEGER PRIMARY KEY, library_id TEXT NOT NULL, ad_hash TEXT NOT NULL)"
+        )
+        self._conn.commit()
+
+    def load_checkpoint(self) -> Optional[Tuple[str, int, int, int]]:
+        return self._conn.execute(
+            "SELECT input_path, input_inode, input_offset, output_size FROM checkpoint"
+        ).fetchone()
+
+    def resume_offset(self, input_path: str, output_path: str) -> int:
+        """
+        Returns the input offset to resume from, or 0 after resetting the state when the
+        parsed or transformed file no longer matches what the checkpoint recorded.
+        """
+        checkpoint = self.load_checkpoint()
+        if checkpoint:
+            saved_input, saved_inode, saved_offset, saved_output_size = checkpoint
+            input_stat = os.stat(input_path)
+            output_size = os.path.getsize(output_path) if os.path.exists(output_path) else -1
+            if (
+                saved_input == os.path.abspath(input_path)
+                and saved_inode == input_stat.st_ino
+                and saved_offset <= input_stat.st_size
+                and saved_output_size == output_size
+            ):
+                return saved_offset
+        self.reset()
+        return 0
+
+    def reset(self):
+        self._conn.executescript("DELETE FROM checkpoint; DELETE FROM ads; DELETE FROM stale;")
+        self._conn.commit()
+
+    def get_hash(self, library_id: str) -> Optional[str]:
+        row = self._conn.execute("SELECT ad_hash FROM ads WHERE library_id = ?", (library_id,)).fetchone()
+        return row[0] if row else None
+
+    def upsert(self, library_id: str, ad_hash: str, output_offset: int) -> bool:
+        """Records the new line for `library_id`; returns True if it replaced an older one."""
+        row = self._conn.execute(
+            "SELECT output_offset, ad_hash FROM ads WHERE library_id = ?", (library_id,)
+        ).fetchone()
+        if row:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO stale (output_offset, library_id, ad_hash) VALUES (?, ?, ?)",
+                (row[0], library_id, row[1])
+            )
+        self._conn.execute(
+            "INSERT OR REPLACE INTO ads (library_id, ad_hash, output_offset) VALUES (?, ?, ?)",
+            (library_id, ad_hash, output_offset)
+        )
+        return row is not None
+
+    def save_checkpoint(self, input_path: str, input_offset: int, output_size: int):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO checkpoint (id, input_path, input_inode, input_offset, output_size) "
+            "VALUES (0, ?, ?, ?, ?)",
+            (os.path.abspath(input_path), os.stat(input_path).st_ino, input_offset, output_size)
+        )
+        self._conn.commit()
+
+    def stale_offsets(self) -> set:
+        return {row[0] for row in self._conn.execute("SELECT output_offset FROM stale")}
+
+    def needs_compaction(self) -> bool:
+        """True when upserts left superseded lines in the transformed file."""
+        return self._conn.execute("SELECT 1 FROM stale LIMIT 1").fetchone() is not None
+
+    def move_offsets(self, moves: Iterable[Tuple[int, int]]):
+        """
+        Points the upsert index at the compacted file: `moves` are (new, old) offsets of the kept
+        lines in file order. New offsets never exceed old ones, so no update hits a moved line.
+        """
+        self._conn.executemany("UPDATE ads SET output_offset = ? WHERE output_offset = ?", moves)
+        self._conn.execute("DELETE FROM stale")
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
+
+
+def superseded_ads(output_path: str) -> Set[Tuple[str, str]]:
+    """
+    (library_id, ad_hash) of the lines in a transformed file that an interrupted incremental run
+    superseded but did not get to compact away. Empty when the file has no state or the state describes another file.
+    """
+    path = output_path + ".state.sqlite"
+    if not os.path.exists(path) or not os.path.exists(output_path):
+        return set()
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        checkpoint = conn.execute("SELECT output_size FROM checkpoint").fetchone()
+        if checkpoint is None or checkpoint[0] != os.path.getsize(output_path):
+            return set()
+        return set(conn.execute("SELECT library_id, ad_hash FROM stale"))
+    except sqlite3.OperationalError:
+        # A state file from before stale lines were kept has no ad_hash column
+        return set()
+    finally:
+        conn.close()
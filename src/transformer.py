@@ -3,12 +3,84 @@ import json
 import os
 import re
 
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, date, timezone
-from langdetect import detect
-from typing import Any, Dict, Optional, Tuple
+from itertools import islice
+from langdetect import DetectorFactory, detect
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
+from src.aggregates import AggregateStore, Contribution, aggregates_from_config, contribution
+from src.clustering import CreativeClusterer, CreativeKey, clusterer_from_config
+from src.language_cache import LanguageCache
 from src.logger import shared_logger
+from src.metrics import metrics
+from src.offset_index import OffsetIndex
+from src.storage import (
+    dataset_dir,
+    get_storage_format,
+    index_enabled,
+    iter_dataset_records,
+    jsonl_writer_options,
+    load_ad_schema,
+    make_json_encoder,
+    open_ads_writer
+)
+from src.transform_state import TransformState
 from src.utils import ensure_output_file
+from src.validation import SchemaValidator, compile_validator, validator_from_config
+
+
+@dataclass
+class AdChecks:
+    """What the parent needs to finish a transformed ad, worked out by the worker that transformed it."""
+    library_id: str
+    ad_hash: str
+    # Where the encoded line holds the `null` creative_cluster_id, for the parent to fill in
+    cluster_id_at: int
+    invalid_reason: Optional[str] = None
+    # Only kept for invalid ads, which are quarantined whole
+    invalid_record: Optional[Dict[str, Any]] = None
+    creative_key: Optional[CreativeKey] = None
+    contribution: Optional[Contribution] = None
+
+
+class AdChecker:
+    """
+    The per-ad part of validation, clustering and aggregation that needs no state from other
+    ads, so it runs in the transform workers and the parent never decodes a transformed line.
+    """
+
+    def __init__(self, config: dict):
+        self.validate = compile_validator(load_ad_schema()) if (config.get("validation") or {}).get("enabled") else None
+        self.clusterer = clusterer_from_config(config)
+        self.aggregate = bool((config.get("aggregates") or {}).get("enabled"))
+
+    def check(self, record: Dict[str, Any], output_line: str) -> AdChecks:
+        checks = AdChecks(record["library_id"], record["ad_hash"], output_line.rindex("null"))
+        if self.validate is not None:
+            with metrics.timer("validation_seconds"):
+                checks.invalid_reason = self.validate(record)
+            if checks.invalid_reason:
+                checks.invalid_record = record
+                return checks
+        if self.clusterer is not None:
+            with metrics.timer("clustering_seconds"):
+                checks.creative_key = self.clusterer.creative_key(record)
+        if self.aggregate:
+            checks.contribution = contribution(record)
+        return checks
+
+
+# One transform result per input line: (output_line, error_message, checks)
+TransformResult = Tuple[Optional[str], Optional[str], Optional[AdChecks]]
+
+_language_cache: Optional[LanguageCache] = None
+_ad_checker: Optional[AdChecker] = None
+
+# Encodes transformed lines; configure_json_encoder applies the `writer` codec settings
+_encode_json = make_json_encoder()
 
 
 def clean_text(s: Optional[str]) -> Optional[str]:
@@ -100,11 +172,64 @@ def calculate_duration_hours(
         duration_hours = (end_dt - start_dt).total_seconds() / 3600
     return round(duration_hours, 2) if duration_hours else None
 
+def _detect_language(text: str) -> str:
+    with metrics.timer("detect_language_seconds"):
+        try:
+            return detect(text)
+        except:
+            return "unknown"
+
 def detect_language(text: str) -> str:
-    try:
-        return detect(text)
-    except:
-        return "unknown"
+    """
+    Detects on the text as given either way; the cache only keys on the cleaned text, so
+    copies that differ in invisible characters share an entry.
+    """
+    if _language_cache is not None:
+        return _language_cache.get_or_detect(text, _detect_language, key_text=clean_text(text))
+    return _detect_language(text)
+
+def configure_language_cache(config: dict) -> Optional[LanguageCache]:
+    """
+    Enables the language cache for this process if `transform.language_cache.enabled` is set.
+    langdetect is seeded either way, so cached and freshly detected languages always agree.
+    """
+    global _language_cache
+    cache_cfg = (config.get("transform") or {}).get("language_cache") or {}
+    DetectorFactory.seed = cache_cfg.get("seed", 0)
+    if not cache_cfg.get("enabled"):
+        return None
+    _language_cache = LanguageCache(
+        cache_cfg.get("path", "data/cache/language.sqlite"),
+        memory_size=cache_cfg.get("memory_size", 10000),
+        max_entries=cache_cfg.get("max_entries", 1000000),
+    )
+    return _language_cache
+
+def configure_json_encoder(config: dict):
+    global _encode_json
+    options = jsonl_writer_options(config)
+    _encode_json = make_json_encoder(options["codec"], options["compact"])
+
+def encode_line(record: Dict[str, Any]) -> str:
+    return _encode_json(record).decode("utf-8") + "\n"
+
+def configure_ad_checker(config: dict, checks: bool):
+    """With `checks`, transform results carry the AdChecks that iter_finished needs."""
+    global _ad_checker
+    _ad_checker = AdChecker(config) if checks else None
+
+def init_transform_worker(config: dict, checks: bool = False):
+    """Pool initializer. Forked workers drop the metrics they inherited, so merging them back counts nothing twice."""
+    metrics.pop_snapshot()
+    configure_language_cache(config)
+    configure_json_encoder(config)
+    configure_ad_checker(config, checks)
+
+def close_language_cache():
+    global _language_cache
+    if _language_cache is not None:
+        _language_cache.close()
+        _language_cache = None
 
 def infer_media_mix(media: dict) -> str:
     has_images = bool(media.get("images"))
@@ -140,6 +265,19 @@ def compute_ad_hash(ad: Dict[str, Any]) -> str:
     serialized = json.dumps(fields_to_hash, ensure_ascii=False, sort_keys=True)
     return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
 
+def compute_raw_ad_hash(ad: Dict[str, Any]) -> str:
+    """Compute the `ad_hash` that normalize_ad would assign, without the full normalization."""
+    return compute_ad_hash({
+        "advertiser_name": ad.get("advertiser_name", "").strip(),
+        "ad_text": ad.get("ad_text"),
+        "ad_redirect": ad.get("ad_redirect"),
+        "has_call_to_action": has_non_empty(ad.get("call_to_action_texts", [])),
+        "call_to_action_text": join_texts(ad.get("call_to_action_texts", [])),
+        "has_call_to_actions": has_non_empty(ad.get("call_to_actions", [])),
+        "media_images": ad.get("media", {}).get("images", []),
+        "media_videos": ad.get("media", {}).get("videos", []),
+    })
+
 def normalize_ad(ad: Dict[str, Any]) -> Dict[str, Any]:
     now_iso = datetime.now(timezone.utc).isoformat()
     scraped_at = ad.get("scraped_at")
@@ -180,8 +318,323 @@ def normalize_ad(ad: Dict[str, Any]) -> Dict[str, Any]:
         "normalized_at": now_iso,
     }
     normalized["ad_hash"] = compute_ad_hash(normalized)
+    # Needs every ad seen so far; iter_finished fills it in as lines are written. Kept last, so
+    # its value is the last `null` of the encoded line
+    normalized["creative_cluster_id"] = None
     return normalized
 
+def transform_lines(lines: List[str]) -> List[TransformResult]:
+    """
+    Normalizes a chunk of raw JSONL lines.
+    Returns one (output_line, error_message, checks) result per input line, in input order;
+    checks are None unless configure_ad_checker turned them on.
+    """
+    results = []
+    for line in lines:
+        try:
+            ad = json.loads(line)
+            transformed_ad = normalize_ad(ad)
+            output_line = encode_line(transformed_ad)
+            checks = _ad_checker.check(transformed_ad, output_line) if _ad_checker is not None else None
+            results.append((output_line, None, checks))
+            metrics.inc("transform_ads_total")
+        except json.JSONDecodeError:
+            results.append((None, f"Skipping invalid JSON line: {line}", None))
+            metrics.inc("transform_errors_total", reason="invalid_json")
+        except Exception as e:
+            results.append((None, f"Error transforming ad: {e}", None))
+            metrics.inc("transform_errors_total", reason="normalize")
+    return results
+
+def transform_chunk(lines: List[str]) -> Tuple[List[TransformResult], Dict[str, int], dict]:
+    """
+    Pool entry point: transforms a chunk and hands back this process's cache counters and metrics
+    since the last chunk.
+    """
+    with metrics.timer("transform_chunk_seconds"):
+        results = transform_lines(lines)
+    cache_stats = {}
+    if _language_cache is not None:
+        _language_cache.flush()
+        cache_stats = _language_cache.pop_stats()
+    return results, cache_stats, metrics.pop_snapshot()
+
+def iter_chunks(lines: Iterable[str], chunk_size: int) -> Iterator[List[str]]:
+    it = iter(lines)
+    while chunk := list(islice(it, chunk_size)):
+        yield chunk
+
+def iter_transformed(
+    lines: Iterable[str],
+    workers: int = 1,
+    chunk_size: int = 500,
+    config: Optional[dict] = None,
+    cache_stats: Optional[Counter] = None,
+    checks: bool = False
+) -> Iterator[TransformResult]:
+    """
+    Yields transform results in input order, either inline or from a process pool.
+    Worker processes configure their own language cache from `config`. With `checks`, the
+    results carry the AdChecks for iter_finished, worked out as configured in `config`.
+    """
+    cache_stats = cache_stats if cache_stats is not None else Counter()
+    chunks = iter_chunks(lines, chunk_size)
+    if workers <= 1:
+        configure_ad_checker(config or {}, checks)
+        for chunk in chunks:
+            results, chunk_stats, chunk_metrics = transform_chunk(chunk)
+            cache_stats.update(chunk_stats)
+            metrics.merge(chunk_metrics)
+            yield from results
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_transform_worker,
+        initargs=(config or {}, checks)
+    ) as executor:
+        # Keep a bounded window of chunks in flight so memory does not grow with input size
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(transform_chunk, chunk))
+            if len(pending) >= workers * 2:
+                results, chunk_stats, chunk_metrics = pending.popleft().result()
+                cache_stats.update(chunk_stats)
+                metrics.merge(chunk_metrics)
+                yield from results
+        for future in pending:
+            results, chunk_stats, chunk_metrics = future.result()
+            cache_stats.update(chunk_stats)
+            metrics.merge(chunk_metrics)
+            yield from results
+
+def finish_ad(
+    output_line: str,
+    checks: AdChecks,
+    clusterer: Optional[CreativeClusterer] = None,
+    aggregates: Optional[AggregateStore] = None,
+    validator: Optional[SchemaValidator] = None
+) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Finishes one transformed ad from the checks its worker made: an ad that breaks the schema is
+    quarantined and comes back as an error, the rest get their `creative_cluster_id` when
+    clustering is on and are counted in the aggregate store when that is on.
+    """
+    if validator is not None:
+        reason = validator.tally(checks.invalid_record, checks.invalid_reason)
+        if reason:
+            return None, f"Quarantined ad {checks.library_id} failing the schema: {reason}"
+    if clusterer is not None:
+        with metrics.timer("clustering_seconds"):
+            cluster_id = clusterer.assign_key(checks.ad_hash, checks.creative_key)
+        at = checks.cluster_id_at
+        output_line = output_line[:at] + json.dumps(cluster_id) + output_line[at + 4:]
+    if aggregates is not None:
+        with metrics.timer("aggregation_seconds"):
+            aggregates.add_contribution(str(checks.library_id), checks.contribution)
+    return output_line, None
+
+def needs_checks(*finishers) -> bool:
+    return any(finisher is not None for finisher in finishers)
+
+def iter_finished(
+    results: Iterable[TransformResult],
+    clusterer: Optional[CreativeClusterer] = None,
+    aggregates: Optional[AggregateStore] = None,
+    validator: Optional[SchemaValidator] = None
+) -> Iterator[Tuple[Optional[str], Optional[str]]]:
+    """
+    Passes transform results through in write order as (output_line, error_message) pairs,
+    finishing each ad with finish_ad. Needs results made with `checks` from the same config
+    whenever any of clusterer, aggregates and validator is set.
+    """
+    if not needs_checks(clusterer, aggregates, validator):
+        for output_line, error, _ in results:
+            yield output_line, error
+        return
+    for output_line, error, checks in results:
+        if output_line is not None:
+            output_line, error = finish_ad(output_line, checks, clusterer, aggregates, validator)
+        yield output_line, error
+
+def transform_dataset(
+    config: dict,
+    input_path: str,
+    output_path: str,
+    workers: int,
+    chunk_size: int,
+    cache_stats: Counter,
+    clusterer: Optional[CreativeClusterer] = None,
+    aggregates: Optional[AggregateStore] = None,
+    validator: Optional[SchemaValidator] = None
+):
+    """Full transform between parquet datasets; records go through the same line-based workers."""
+    lines = (json.dumps(ad, ensure_ascii=False) for ad in iter_dataset_records(dataset_dir(input_path), "parsed"))
+    writer = open_ads_writer(output_path, "parquet", "transformed", truncate=True, config=config)
+    try:
+        results = iter_transformed(
+            lines, workers, chunk_size, config, cache_stats, needs_checks(clusterer, aggregates, validator)
+        )
+        for output_line, error in iter_finished(results, clusterer, aggregates, validator):
+            if error:
+                shared_logger.error(error)
+            else:
+                writer.write([json.loads(output_line)])
+    finally:
+        writer.close()
+
+def log_language_cache_stats(cache_stats: Counter):
+    hits = cache_stats["memory_hits"] + cache_stats["disk_hits"]
+    lookups = hits + cache_stats["misses"]
+    hit_rate = hits / lookups if lookups else 0.0
+    shared_logger.info(
+        f"Language cache: {hits}/{lookups} hits ({hit_rate:.1%}), "
+        f"memory={cache_stats['memory_hits']} disk={cache_stats['disk_hits']} "
+        f"misses={cache_stats['misses']} evictions={cache_stats['evictions']}"
+    )
+
+def iter_new_lines(path: str, offset: int) -> Iterator[Tuple[str, int]]:
+    """
+    Yields complete lines after byte `offset`, each with the offset just past it.
+    A trailing line without a newline is left for the next run, since the scraper may still be writing it.
+    """
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for raw in f:
+            if not raw.endswith(b"\n"):
+                break
+            offset += len(raw)
+            yield raw.decode("utf-8"), offset
+
+def compact_transformed(output_path: str, state: TransformState) -> int:
+    """
+    Rewrites the transformed file without lines superseded by upserts, moving the offsets in the
+    state along. Lines are copied as bytes; the state already knows which ad each one holds.
+    Returns the new file size.
+    """
+    stale = state.stale_offsets()
+    tmp_path = output_path + ".tmp"
+
+    def moves(fin, fout):
+        offset = 0
+        for line in fin:
+            if offset not in stale:
+                yield fout.tell(), offset
+                fout.write(line)
+            offset += len(line)
+
+    with open(output_path, "rb") as fin, open(tmp_path, "wb") as fout:
+        state.move_offsets(moves(fin, fout))
+        size = fout.tell()
+    os.replace(tmp_path, output_path)
+    shared_logger.info(f"Compacted {len(stale)} superseded ads out of {output_path}")
+    return size
+
+def transform_incremental(
+    config: dict,
+    input_path: str,
+    output_path: str,
+    workers: int,
+    chunk_size: int,
+    cache_stats: Counter,
+    clusterer: Optional[CreativeClusterer] = None,
+    aggregates: Optional[AggregateStore] = None,
+    validator: Optional[SchemaValidator] = None
+):
+    """
+    Transforms only what was appended to the parsed file since the last checkpoint.
+    Ads whose library_id and ad_hash are already in the transformed file are skipped,
+    changed ads are appended and supersede their previous line, which is compacted out of the
+    file at the end of the run, so every reader sees one line per ad.
+    """
+    state = TransformState(output_path + ".state.sqlite")
+    clusters_path = output_path + ".clusters.npz"
+    start_offset = state.resume_offset(input_path, output_path)
+    if start_offset == 0:
+        open(output_path, "w").close()
+        if aggregates is not None:
+            aggregates.reset()
+    else:
+        if state.needs_compaction():
+            # Left by a run interrupted before it compacted
+            state.save_checkpoint(input_path, start_offset, compact_transformed(output_path, state))
+        # New ads join the clusters already in the file; only without clusters saved for it,
+        # e.g. after a crash, are they hashed again from the file
+        if clusterer is not None and not clusterer.load(clusters_path, os.path.getsize(output_path)):
+            clusterer.seed_from_file(output_path)
+        if aggregates is not None and aggregates.is_empty():
+            aggregates.seed_from_file(output_path)
+    shared_logger.info(f"Incremental transform resuming at byte {start_offset} of {input_path}")
+
+    progress = {"offset": start_offset}
+    pending = deque()
+    seen: Dict[str, str] = {}
+    counts = Counter()
+
+    def changed_lines():
+        for line, end_offset in iter_new_lines(input_path, start_offset):
+            progress["offset"] = end_offset
+            try:
+                ad = json.loads(line)
+                library_id = extract_library_id(ad.get("library_id"))
+                ad_hash = compute_raw_ad_hash(ad)
+            except Exception:
+                # Let transform_lines report the error for this line
+                library_id, ad_hash = None, None
+            if library_id and ad_hash:
+                if ad_hash == (seen.get(library_id) or state.get_hash(library_id)):
+                    counts["unchanged"] += 1
+                    continue
+                seen[library_id] = ad_hash
+            pending.append((library_id, ad_hash, end_offset))
+            yield line
+
+    try:
+        with open(output_path, "ab") as fout:
+            output_size = fout.tell()
+            results = iter_transformed(
+                changed_lines(), workers, chunk_size, config, cache_stats, needs_checks(clusterer, aggregates, validator)
+            )
+            for output_line, error in iter_finished(results, clusterer, aggregates, validator):
+                library_id, ad_hash, end_offset = pending.popleft()
+                if error:
+                    shared_logger.error(error)
+                    continue
+                if not (library_id and ad_hash):
+                    record = json.loads(output_line)
+                    library_id, ad_hash = record["library_id"], record["ad_hash"]
+                data = output_line.encode("utf-8")
+                replaced = state.upsert(library_id, ad_hash, output_size)
+                counts["updated" if replaced else "new"] += 1
+                fout.write(data)
+                output_size += len(data)
+                metrics.inc("bytes_written_total", len(data), path=output_path)
+                if (counts["new"] + counts["updated"]) % 1000 == 0:
+                    fout.flush()
+                    # Aggregates never fall behind the checkpoint; re-adding an ad after a crash is a no-op
+                    if aggregates is not None:
+                        aggregates.flush()
+                    state.save_checkpoint(input_path, end_offset, output_size)
+        state.save_checkpoint(input_path, progress["offset"], output_size)
+
+        if state.needs_compaction():
+            output_size = compact_transformed(output_path, state)
+            state.save_checkpoint(input_path, progress["offset"], output_size)
+        if clusterer is not None:
+            clusterer.save(clusters_path, output_size)
+    finally:
+        state.close()
+
+    if index_enabled(config):
+        # Appends leave the index behind and compaction rewrites the file; either way it catches up here
+        with OffsetIndex(output_path, "transformed") as index:
+            index.refresh()
+
+    shared_logger.info(
+        f"Incremental transform: {counts['new']} new, {counts['updated']} updated, "
+        f"{counts['unchanged']} unchanged"
+    )
+
 def transform(config: dict):
     input_path = os.path.join(
         config["paths"]["parsed_ads_dir"],
@@ -194,16 +647,58 @@ def transform(config: dict):
     )
     ensure_output_file(output_path)
 
-    with open(input_path, "r", encoding="utf-8") as fin, \
-            open(output_path, "w", encoding="utf-8") as fout:
-        for line in fin:
-            try:
-                ad = json.loads(line)
-                transformed_ad = normalize_ad(ad)
-                fout.write(json.dumps(transformed_ad, ensure_ascii=False) + "\n")
-            except json.JSONDecodeError:
-                shared_logger.error(f"Skipping invalid JSON line: {line}")
-            except Exception as e:
-                shared_logger.error(f"Error transforming ad: {e}")
+    transform_cfg = config.get("transform") or {}
+    workers = transform_cfg.get("workers") or 1
+    chunk_size = transform_cfg.get("chunk_size") or 500
+    if workers > 1:
+        shared_logger.info(f"Transforming with {workers} workers, {chunk_size} lines per chunk")
+
+    storage_format = get_storage_format(config)
+    incremental = transform_cfg.get("incremental")
+    if incremental and storage_format != "jsonl":
+        shared_logger.warning("Incremental transform needs jsonl storage; running a full transform")
+        incremental = False
+
+    cache_stats = Counter()
+    clusterer = clusterer_from_config(config)
+    aggregates = aggregates_from_config(config)
+    validator = validator_from_config(config)
+    if aggregates is not None and not incremental:
+        # A full transform rewrites the output, so the aggregates start over with it
+        aggregates.reset()
+    configure_language_cache(config)
+    configure_json_encoder(config)
+    try:
+        if incremental:
+            transform_incremental(
+                config, input_path, output_path, workers, chunk_size, cache_stats, clusterer, aggregates, validator
+            )
+        elif storage_format == "parquet":
+            transform_dataset(
+                config, input_path, output_path, workers, chunk_size, cache_stats, clusterer, aggregates, validator
+            )
+        else:
+            with open(input_path, "r", encoding="utf-8") as fin, \
+                    open_ads_writer(output_path, "jsonl", "transformed", truncate=True, config=config) as writer:
+                results = iter_transformed(
+                    fin, workers, chunk_size, config, cache_stats, needs_checks(clusterer, aggregates, validator)
+                )
+                for output_line, error in iter_finished(results, clusterer, aggregates, validator):
+                    if error:
+                        shared_logger.error(error)
+                    else:
+                        writer.write_lines([output_line])
+    finally:
+        close_language_cache()
+        if aggregates is not None:
+            aggregates.close()
+        if validator is not None:
+            validator.close()
 
-    shared_logger.info(f"Transformed and saved: {output_path}")
+    if cache_stats:
+        log_language_cache_stats(cache_stats)
+    if clusterer is not None:
+        clusterer.log_stats()
+    if validator is not None:
+        validator.log_stats()
+    shared_logger.info(f"Transformed and saved: {output_path if storage_format == 'jsonl' else dataset_dir(output_path)}")
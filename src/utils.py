@@ -1,4 +1,3 @@
-import json
 import os
 from urllib.parse import urlencode
 
@@ -6,10 +5,7 @@ from urllib.parse import urlencode
 def ensure_output_file(path):
     os.makedirs(os.path.dirname(path), exist_ok=True)
 
-def build_ad_library_url(params: dict) -> str:
-    return f"https://www.facebook.com/ads/library/?{urlencode(params)}"
+AD_LIBRARY_URL = "https://www.facebook.com/ads/library/"
 
-def write_batch_to_file(output_file, batch):
-    with open(output_file, "a", encoding="utf-8") as f:
-        for ad in batch:
-            f.write(json.dumps(ad, ensure_ascii=False) + "\n")
+def build_ad_library_url(params: dict, base_url: str = None) -> str:
+    return f"{base_url or AD_LIBRARY_URL}?{urlencode(params)}"
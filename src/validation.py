@@ -0,0 +1,244 @@
+import os
+import re
+
+from datetime import date, datetime, timezone
+from math import isfinite
+from typing import Any, Callable, Dict, List, Optional
+
+from src.logger import shared_logger
+from src.metrics import metrics
+from src.storage import JsonlWriter, jsonl_writer_options, load_ad_schema
+
+
+# Keywords the generated validator understands; anything else in a schema is rejected when compiling
+SUPPORTED_KEYWORDS = {
+    "$schema", "title", "description", "type", "enum", "format", "items", "properties", "required",
+    "additionalProperties",
+}
+
+TYPE_CHECKS = {
+    "string": "type({v}) is str",
+    "number": "(type({v}) is float or type({v}) is int) and isfinite({v})",
+    "integer": "type({v}) is int",
+    "boolean": "type({v}) is bool",
+    "null": "{v} is None",
+    "array": "type({v}) is list",
+    "object": "type({v}) is dict",
+}
+
+_DATE = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+Validator = Callable[[Dict[str, Any]], Optional[str]]
+
+
+def is_date(value: str) -> bool:
+    if not _DATE.fullmatch(value):
+        return False
+    try:
+        date.fromisoformat(value)
+    except ValueError:
+        return False
+    return True
+
+def is_datetime(value: str) -> bool:
+    if not _DATE.match(value) or len(value) < 11 or value[10] not in "Tt ":
+        return False
+    try:
+        datetime.fromisoformat(value)
+    except ValueError:
+        return False
+    return True
+
+FORMAT_CHECKS = {"date": "is_date", "date-time": "is_datetime"}
+
+# Failure messages; only called for invalid records
+
+def type_error(label: str, expected: str, value: Any) -> str:
+    return f"{label}: expected {expected}, got {type(value).__name__} {value!r:.80}"
+
+def enum_error(label: str, value: Any, allowed: tuple) -> str:
+    return f"{label}: {value!r:.80} is not one of {list(allowed)}"
+
+def format_error(label: str, value_format: str, value: Any) -> str:
+    return f"{label}: {value!r:.80} is not a valid {value_format}"
+
+
+class _ValidatorSource:
+    """Emits the body of a validate(record) function, one schema node at a time."""
+
+    def __init__(self):
+        self.lines: List[str] = []
+        self.constants: Dict[str, Any] = {}
+        self._depth = 0
+
+    def constant(self, value: Any) -> str:
+        name = f"C{len(self.constants)}"
+        self.constants[name] = value
+        return name
+
+    def emit(self, indent: int, line: str):
+        self.lines.append("    " * indent + line)
+
+    def node(self, schema: dict, v: str, label: str, indent: int):
+        unsupported = set(schema) - SUPPORTED_KEYWORDS
+        if unsupported:
+            raise ValueError(f"{label}: unsupported schema keywords {sorted(unsupported)}")
+        types = schema.get("type")
+        types = [types] if isinstance(types, str) else list(types or [])
+        unknown = [t for t in types if t not in TYPE_CHECKS]
+        if unknown:
+            raise ValueError(f"{label}: unsupported types {unknown}")
+        if types:
+            check = " or ".join(f"({TYPE_CHECKS[t].format(v=v)})" for t in types)
+            self.emit(indent, f"if not ({check}):")
+            self.emit(indent + 1, f"return type_error({label or 'record'!r}, {' or '.join(types)!r}, {v})")
+
+        if "enum" in schema:
+            allowed = self.constant(tuple(schema["enum"]))
+            self.emit(indent, f"if {v} not in {allowed}:")
+            self.emit(indent + 1, f"return enum_error({label!r}, {v}, {allowed})")
+
+        if "format" in schema:
+            value_format = schema["format"]
+            if value_format not in FORMAT_CHECKS:
+                raise ValueError(f"{label}: unsupported format {value_format!r}")
+
+            def format_check(i: int):
+                self.emit(i, f"if not {FORMAT_CHECKS[value_format]}({v}):")
+                self.emit(i + 1, f"return format_error({label!r}, {value_format!r}, {v})")
+            self.guarded(types, "string", v, indent, format_check)
+
+        if "items" in schema:
+            def items(i: int):
+                self._depth += 1
+                item = f"v{self._depth}"
+                self.emit(i, f"for {item} in {v}:")
+                self.node(schema["items"], item, f"{label}[]", i + 1)
+            self.guarded(types, "array", v, indent, items)
+
+        if "properties" in schema or "required" in schema or "additionalProperties" in schema:
+            self.guarded(types, "object", v, indent, lambda i: self.properties(schema, v, label, i))
+
+    def guarded(self, types: List[str], type_name: str, v: str, indent: int, body: Callable[[int], Any]):
+        """Keyword checks that only apply to one type, behind a type test when others are allowed."""
+        if types == [type_name]:
+            body(indent)
+        else:
+            self.emit(indent, f"if {TYPE_CHECKS[type_name].format(v=v)}:")
+            body(indent + 1)
+
+    def properties(self, schema: dict, v: str, label: str, indent: int):
+        properties = schema.get("properties") or {}
+        required = frozenset(schema.get("required") or ())
+        prefix = f"{label}." if label else ""
+        keys = self.constant(required)
+        self.emit(indent, f"if not {keys} <= {v}.keys():")
+        self.emit(
+            indent + 1,
+            f"return {prefix + 'missing required properties: '!r} + ', '.join(sorted({keys} - {v}.keys()))"
+        )
+        additional = schema.get("additionalProperties", True)
+        if additional is not True:
+            if additional is not False:
+                raise ValueError(f"{label or 'record'}: only boolean additionalProperties are supported")
+            allowed = self.constant(frozenset(properties))
+            self.emit(indent, f"if not {v}.keys() <= {allowed}:")
+            self.emit(
+                indent + 1,
+                f"return {prefix + 'unexpected properties: '!r} + ', '.join(sorted({v}.keys() - {allowed}))"
+            )
+        for name, prop in properties.items():
+            self._depth += 1
+            value = f"v{self._depth}"
+            if name in required:
+                self.emit(indent, f"{value} = {v}[{name!r}]")
+                self.node(prop, value, prefix + name, indent)
+            else:
+                self.emit(indent, f"{value} = {v}.get({name!r}, MISSING)")
+                self.emit(indent, f"if {value} is not MISSING:")
+                self.node(prop, value, prefix + name, indent + 1)
+
+
+def compile_validator(schema: dict) -> Validator:
+    """
+    Generates one Python function that checks a record against `schema` and compiles it once.
+    The function returns the first violation as a readable reason, or None for a valid record.
+    Covers the JSON Schema subset in SUPPORTED_KEYWORDS and fails loudly on anything else,
+    so a schema change the validator cannot follow is caught at startup, not in the data.
+    """
+    source = _ValidatorSource()
+    source.emit(0, "def validate(record):")
+    source.node(schema, "record", "", 1)
+    source.emit(1, "return None")
+    code = "\n".join(source.lines)
+    namespace = {
+        "MISSING": object(), "isfinite": isfinite, "is_date": is_date, "is_datetime": is_datetime,
+        "type_error": type_error, "enum_error": enum_error, "format_error": format_error, **source.constants,
+    }
+    exec(compile(code, "<ad schema validator>", "exec"), namespace)
+    validate = namespace["validate"]
+    validate.source = code
+    return validate
+
+
+class SchemaValidator:
+    """
+    Checks transformed records against ad_scheama.json before they are written.
+    Invalid records go to the quarantine file with the reason instead of the output.
+    """
+
+    def __init__(self, quarantine_path: str, writer_options: Optional[Dict[str, Any]] = None):
+        self.validate = compile_validator(load_ad_schema())
+        self.quarantine_path = quarantine_path
+        self._writer_options = writer_options or {}
+        self._quarantine: Optional[JsonlWriter] = None
+        self.checked = 0
+        self.invalid = 0
+
+    def check(self, record: Dict[str, Any]) -> Optional[str]:
+        """Returns None for a valid record; otherwise quarantines it and returns the reason."""
+        return self.tally(record, self.validate(record))
+
+    def tally(self, record: Optional[Dict[str, Any]], reason: Optional[str]) -> Optional[str]:
+        """
+        Counts a record validated elsewhere, e.g. in a transform worker, and quarantines it when
+        `reason` is set. Only an invalid record needs to be passed.
+        """
+        self.checked += 1
+        if reason is None:
+            return None
+        self.invalid += 1
+        metrics.inc("validation_invalid_total", field=reason.split(":", 1)[0])
+        if self._quarantine is None:
+            self._quarantine = JsonlWriter(self.quarantine_path, **self._writer_options)
+        self._quarantine.write([{
+            "error": reason,
+            "stage": "validate",
+            "record": record,
+            "quarantined_at": datetime.now(timezone.utc).isoformat(),
+        }])
+        return reason
+
+    def close(self):
+        if self._quarantine is not None:
+            self._quarantine.close()
+            self._quarantine = None
+
+    def log_stats(self):
+        if self.invalid:
+            shared_logger.warning(
+                f"Schema validation quarantined {self.invalid}/{self.checked} ads to {self.quarantine_path}"
+            )
+        else:
+            shared_logger.info(f"Schema validation: all {self.checked} ads valid")
+
+
+def validator_from_config(config: dict) -> Optional[SchemaValidator]:
+    validation_cfg = config.get("validation") or {}
+    if not validation_cfg.get("enabled"):
+        return None
+    quarantine_path = os.path.join(
+        config["paths"]["quarantine_dir"],
+        validation_cfg.get("quarantine_file") or f"invalid_{config['paths']['output_file']}"
+    )
+    return SchemaValidator(quarantine_path, jsonl_writer_options(config, rotate=True))
@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+# Tests import the pipeline as `src.*`, the same way main.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+@pytest.fixture
+def fixtures_dir() -> str:
+    return FIXTURES_DIR
+
+
+@pytest.fixture(scope="session")
+def chromium():
+    """Skips the test unless Playwright and its Chromium build are installed."""
+    try:
+        from playwright.sync_api import sync_playwright
+    except ImportError:
+        pytest.skip("playwright is not installed")
+    with sync_playwright() as p:
+        executable = p.chromium.executable_path
+    if not os.path.exists(executable):
+        pytest.skip("no Playwright Chromium installed (python -m playwright install chromium)")
+    return executable
@@ -0,0 +1,31 @@
+import random
+
+from src.offset_index import OffsetIndex, lookup_ads
+from src.storage import open_ads_writer
+
+
+CONFIG = {"offset_index": {"enabled": True}, "writer": {"buffer_bytes": 200}}
+
+
+def test_writer_creates_missing_file_before_indexing(tmp_path):
+    path = str(tmp_path / "new" / "parsed.jsonl")
+    writer = open_ads_writer(path, "jsonl", "parsed", config=CONFIG)
+    writer.write([{"library_id": "Library ID: 1", "ad_text": "a"}])
+    writer.close()
+    assert [ad["ad_text"] for ad in lookup_ads(path, "parsed", "library_id", "1")] == ["a"]
+
+
+def test_interleaved_writers_share_one_index(tmp_path):
+    path = str(tmp_path / "ads.jsonl")
+    writers = [open_ads_writer(path, "jsonl", "transformed", config=CONFIG) for _ in range(2)]
+    rng = random.Random(0)
+    # Enough keys to grow the index while both writers have it open
+    for i in range(2000):
+        rng.choice(writers).write([{"library_id": str(i), "ad_hash": f"h{i}", "pad": "x" * rng.randint(1, 50)}])
+    for writer in writers:
+        writer.close()
+
+    with OffsetIndex(path, "transformed") as index:
+        assert index.status() == "fresh"
+        for i in range(0, 2000, 7):
+            assert [ad["ad_hash"] for ad in index.lookup("library_id", str(i))] == [f"h{i}"]
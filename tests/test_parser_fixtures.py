@@ -0,0 +1,64 @@
+import asyncio
+import json
+import os
+
+from lxml import html as lxml_html
+
+from src.constants import AD_CARD_SELECTOR
+from src.offline_parser import parse_html_records, query_selector_all
+
+
+def load_fixtures(fixtures_dir: str):
+    """The stand-in page with four cards, and the ads expected from the first three; the last one is broken."""
+    with open(os.path.join(fixtures_dir, "ad_cards.html"), "r", encoding="utf-8") as f:
+        page = f.read()
+    with open(os.path.join(fixtures_dir, "ad_cards.json"), "r", encoding="utf-8") as f:
+        expected = json.load(f)
+    return page, expected
+
+def fixture_cards(page: str) -> list:
+    return query_selector_all(lxml_html.document_fromstring(page), AD_CARD_SELECTOR)
+
+def check_results(results: list, expected: list):
+    assert len(results) == len(expected) + 1
+    assert [result.get("ad") for result in results[:-1]] == expected
+    assert "error" in results[-1] and results[-1]["html"]
+
+
+def test_offline_parser_matches_fixtures(fixtures_dir):
+    page, expected = load_fixtures(fixtures_dir)
+    records = [{"outer_html": lxml_html.tostring(card, encoding="unicode")} for card in fixture_cards(page)]
+    check_results(parse_html_records(records), expected)
+
+
+def test_offline_parser_reparses_quarantined_inner_html(fixtures_dir):
+    page, expected = load_fixtures(fixtures_dir)
+    records = [
+        {"html": (card.text or "") + "".join(lxml_html.tostring(child, encoding="unicode") for child in card)}
+        for card in fixture_cards(page)
+    ]
+    check_results(parse_html_records(records), expected)
+
+
+def test_browser_parsers_match_fixtures(chromium, fixtures_dir):
+    from playwright.async_api import async_playwright
+    from src.parser import parse_ad_handles, parse_ads_in_page
+
+    page_html, expected = load_fixtures(fixtures_dir)
+
+    async def parse_in_browser():
+        async with async_playwright() as p:
+            browser = await p.chromium.launch()
+            try:
+                page = await browser.new_page()
+                await page.set_content(page_html)
+                total, in_page = await parse_ads_in_page(page, AD_CARD_SELECTOR, 0)
+                by_handle = await parse_ad_handles(await page.query_selector_all(AD_CARD_SELECTOR))
+            finally:
+                await browser.close()
+        return total, in_page, by_handle
+
+    total, in_page, by_handle = asyncio.run(parse_in_browser())
+    assert total == len(expected) + 1
+    check_results(in_page, expected)
+    check_results(by_handle, expected)
@@ -0,0 +1,50 @@
+import os
+
+import numpy as np
+import pytest
+
+from src.ads_analysis import (
+    DEFAULT_SCORE_WEIGHTS,
+    calculate_proxy_score,
+    calculate_proxy_scores,
+    load_ads_data,
+    select_top_ads,
+    stream_top_ads
+)
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_PATH = os.path.join(REPO_ROOT, "data", "transformed", "us_microlearning_ads.jsonl")
+
+
+@pytest.fixture
+def ads():
+    df = load_ads_data(SAMPLE_PATH)
+    # Gaps the sample does not have: a missing duration and a missing status
+    df["is_active"] = df["is_active"].astype(object)
+    df.loc[df.index[:3], "run_duration_hours"] = np.nan
+    df.loc[df.index[3:6], "is_active"] = np.nan
+    df.loc[df.index[6:9], "is_active"] = None
+    return df
+
+
+@pytest.mark.parametrize("weights", [
+    DEFAULT_SCORE_WEIGHTS,
+    {"text_len": 0.1, "media_mix": 0.2, "is_active": 0.6, "duration": 0.1},
+])
+def test_vectorized_scores_match_row_wise(ads, weights):
+    expected = ads.apply(calculate_proxy_score, axis=1, weights=weights).to_numpy(dtype=np.float64)
+    np.testing.assert_array_equal(calculate_proxy_scores(ads, weights).to_numpy(), expected)
+
+
+def test_missing_status_scores_as_inactive(ads):
+    inactive = ads.loc[ads.index[3:9]].assign(is_active=False)
+    for _, row in ads.loc[ads.index[3:9]].iterrows():
+        assert calculate_proxy_score(row) == calculate_proxy_score(inactive.loc[row.name])
+
+
+def test_chunked_top_ads_match_full_sort(ads):
+    expected = select_top_ads(ads.copy(), DEFAULT_SCORE_WEIGHTS, 100)
+    chunks = (ads.iloc[start:start + 97] for start in range(0, len(ads), 97))
+    streamed = stream_top_ads(chunks, DEFAULT_SCORE_WEIGHTS, 100, 97)
+    assert streamed["library_id"].tolist() == expected["library_id"].tolist()
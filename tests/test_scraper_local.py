@@ -0,0 +1,102 @@
+import asyncio
+import copy
+import functools
+import json
+import os
+import threading
+
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from src.config import load_config
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+QUERIES = [
+    {"name": "alpha", "q": "alpha", "seed": "1"},
+    {"name": "beta", "q": "beta", "seed": "2"},
+    {"name": "gamma", "q": "gamma", "seed": "3"},
+]
+ADS_PER_QUERY = 15
+
+
+class RecordingHandler(SimpleHTTPRequestHandler):
+    """Serves the stand-in Ad Library and remembers every path the browser asked for."""
+
+    requested = []
+
+    def do_GET(self):
+        self.requested.append(self.path.split("?", 1)[0])
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def ad_library(fixtures_dir):
+    handler = functools.partial(RecordingHandler, directory=os.path.join(fixtures_dir, "ad_library"))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    RecordingHandler.requested = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}/index.html", RecordingHandler.requested
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def scrape_config(tmp_path, base_url: str) -> dict:
+    config = copy.deepcopy(load_config(os.path.join(REPO_ROOT, "config.yaml")))
+    config["paths"].update({
+        "parsed_ads_dir": str(tmp_path / "parsed"),
+        "quarantine_dir": str(tmp_path / "quarantine"),
+        "captured_dir": str(tmp_path / "captured"),
+        "storage_format": "jsonl",
+        "per_query_output": True,
+    })
+    config["scraper"].update({
+        "base_url": base_url,
+        "channel": None,
+        "headless": True,
+        "max_ads": 100,
+        "max_scroll_tries": 2,
+        "scroll_timeout_ms": 1500,
+        "batch_size": 5,
+        "concurrency": 2,
+        "max_retries": 0,
+        "capture_html": False,
+    })
+    config["scraper"]["resource_blocking"].update({"enabled": True, "mode": "block"})
+    config["queries"] = QUERIES
+    config["offset_index"] = {"enabled": False}
+    config["metrics"] = {"enabled": False}
+    return config
+
+
+@pytest.mark.parametrize("extraction", ["in_page", "handles"])
+def test_concurrent_queries_scrape_stand_in_with_blocking(chromium, ad_library, tmp_path, extraction):
+    from src.scraper import scrape_ads
+
+    base_url, requested = ad_library
+    config = scrape_config(tmp_path, base_url)
+    config["scraper"]["extraction"] = extraction
+    asyncio.run(scrape_ads(config))
+
+    for query in QUERIES:
+        with open(tmp_path / "parsed" / f"{query['name']}.jsonl", "r", encoding="utf-8") as f:
+            ads = [json.loads(line) for line in f]
+        assert len(ads) == ADS_PER_QUERY
+        seed = int(query["seed"])
+        expected_ids = [seed * 1000 + page * 100 + i for page in range(3) for i in range(5)]
+        assert [ad["library_id"] for ad in ads] == [f"Library ID: {i}" for i in expected_ids]
+        assert {ad["query"] for ad in ads} == {query["name"]}
+        # Media URLs are still read off the cards, without downloading them
+        assert ads[0]["media"]["images"][0].endswith(f"/media/{expected_ids[0]}.jpg")
+
+    # More results loaded through the allowed API; media, fonts and analytics never reached the server
+    assert requested.count("/api/graphql/page2.json") == len(QUERIES)
+    assert not [path for path in requested if path.startswith(("/media/", "/fonts/", "/ajax/bz"))]
@@ -0,0 +1,161 @@
+import copy
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+import pytest
+
+from benchmarks.synthetic import write_synthetic_ads
+from src.config import load_config
+from src.job_queue import default_worker_id
+from src.sharding import (
+    JOB_HANDLERS,
+    enqueue_jobs,
+    follow_up_jobs,
+    main_path,
+    merge_shards,
+    open_queue,
+    run_worker,
+    shard_path
+)
+from src.transformer import iter_transformed
+from src.utils import ensure_output_file
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="needs fork and SIGKILL")
+
+
+def jobs_config(tmp_path) -> dict:
+    config = copy.deepcopy(load_config(os.path.join(REPO_ROOT, "config.yaml")))
+    config["paths"].update({
+        "output_file": "ads.jsonl",
+        "storage_format": "jsonl",
+        "parsed_ads_dir": str(tmp_path / "parsed"),
+        "transformed_ads_dir": str(tmp_path / "transformed"),
+        "quarantine_dir": str(tmp_path / "quarantine"),
+    })
+    config["transform"]["language_cache"] = {"enabled": False}
+    config["aggregates"] = {"enabled": False}
+    config["offset_index"] = {"enabled": False}
+    config["metrics"] = {"enabled": False}
+    config["jobs"] = {
+        "queue_path": str(tmp_path / "jobs" / "queue.sqlite"),
+        "shards_dir": str(tmp_path / "jobs" / "shards"),
+        "lease_s": 1,
+        "heartbeat_s": 0.2,
+        "retry_backoff_s": 0,
+        "transform_chunk_lines": 25,
+        "poll_s": 0.05,
+    }
+    return config
+
+def read_jsonl(path: str) -> list:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+def hanging_worker(config: dict):
+    """A worker that claims a transform job and never finishes it."""
+    JOB_HANDLERS["transform"] = lambda config, queue, job: time.sleep(3600)
+    run_worker(config)
+
+
+def test_killed_worker_job_is_retried_and_merged_once(tmp_path):
+    config = jobs_config(tmp_path)
+    parsed_path = main_path(config, "parsed")
+    write_synthetic_ads(parsed_path, str(tmp_path / "expected.jsonl"), rows=200, seed=1)
+    assert enqueue_jobs(config, "transform") == 8
+
+    context = multiprocessing.get_context("fork")
+    doomed = context.Process(target=hanging_worker, args=(config,))
+    doomed.start()
+    doomed_id = default_worker_id().rsplit("-", 1)[0] + f"-{doomed.pid}"
+    with open_queue(config) as queue:
+        deadline = time.time() + 30
+        while not any(job["worker"] == doomed_id for job in queue.jobs(state="running")):
+            assert time.time() < deadline, "the hanging worker never claimed a job"
+            time.sleep(0.05)
+    os.kill(doomed.pid, signal.SIGKILL)
+    doomed.join()
+
+    workers = [context.Process(target=run_worker, args=(config,)) for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+
+    with open_queue(config) as queue:
+        assert queue.counts() == {"pending": 0, "running": 0, "done": 8, "failed": 0}
+        assert sorted(job["attempts"] for job in queue.jobs()) == [1] * 7 + [2]
+
+    assert merge_shards(config) == {"transformed": 200}
+    with open(parsed_path, "r", encoding="utf-8") as f:
+        expected = [json.loads(line)["ad_hash"] for line, error, _ in iter_transformed(f.readlines(), config=config)]
+    merged = read_jsonl(main_path(config, "transformed"))
+    assert [ad["ad_hash"] for ad in merged] == expected
+
+
+def test_merge_appends_scrape_shards_to_parsed_history(tmp_path):
+    config = jobs_config(tmp_path)
+    parsed_path = main_path(config, "parsed")
+    ads_path = str(tmp_path / "generated.jsonl")
+    write_synthetic_ads(ads_path, str(tmp_path / "generated_transformed.jsonl"), rows=80, seed=2)
+    with open(ads_path, "r", encoding="utf-8") as f:
+        lines = f.readlines()
+    ensure_output_file(parsed_path)
+    with open(parsed_path, "w", encoding="utf-8") as f:
+        f.writelines(lines[:50])
+
+    enqueue_jobs(config, "scrape")
+    with open_queue(config) as queue:
+        job = queue.claim("scraper")
+        shard = shard_path(config, "parsed", job.key, job.attempts)
+        ensure_output_file(shard)
+        with open(shard, "w", encoding="utf-8") as f:
+            f.writelines(lines[40:])
+        output = {"path": shard}
+        assert queue.complete(job, "scraper", output, follow_up_jobs(config, job, output))
+        # A worker whose lease was taken over neither completes the job nor enqueues transforms
+        assert not queue.complete(job, "stale", output, follow_up_jobs(config, job, output))
+        transforms = queue.jobs(kind="transform")
+        assert len(transforms) == 2
+        assert all(os.path.basename(shard) + "@" in transform["key"] for transform in transforms)
+
+    merged = merge_shards(config)
+    assert merged["parsed"] == 30
+    assert read_jsonl(parsed_path) == [json.loads(line) for line in lines]
+
+def test_merge_keeps_one_creative_run_under_several_library_ids(tmp_path):
+    config = jobs_config(tmp_path)
+    parsed_path = main_path(config, "parsed")
+    write_synthetic_ads(parsed_path, str(tmp_path / "expected.jsonl"), rows=60, seed=3)
+    with open(parsed_path, "r", encoding="utf-8") as f:
+        ads = [json.loads(line) for line in f]
+    # The same creative re-posted under new library IDs, as advertisers do
+    reposts = [dict(ad, library_id=ad["library_id"] + "9") for ad in ads[:20]]
+    with open(parsed_path, "a", encoding="utf-8") as f:
+        f.writelines(json.dumps(ad) + "\n" for ad in reposts)
+
+    enqueue_jobs(config, "transform")
+    run_worker(config)
+    assert merge_shards(config) == {"transformed": 80}
+    merged = read_jsonl(main_path(config, "transformed"))
+    assert len({(ad["library_id"], ad["ad_hash"]) for ad in merged}) == 80
+    assert len({ad["ad_hash"] for ad in merged}) == 60
+
+    enqueue_jobs(config, "scrape")
+    with open_queue(config) as queue:
+        job = queue.claim("scraper")
+        shard = shard_path(config, "parsed", job.key, job.attempts)
+        ensure_output_file(shard)
+        with open(shard, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(dict(ad, library_id=ad["library_id"] + "8")) + "\n" for ad in ads[:10])
+            f.writelines(json.dumps(ad) + "\n" for ad in reposts[:5])
+        assert queue.complete(job, "scraper", {"path": shard})
+    # Only the already parsed reposts are duplicates
+    assert merge_shards(config)["parsed"] == 10